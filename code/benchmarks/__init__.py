@@ -0,0 +1 @@
+"""Offline benchmarks for docgen_agent, with local stand-ins for NVIDIA and Tavily."""
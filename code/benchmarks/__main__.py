@@ -0,0 +1,5 @@
+"""Run the benchmark scenarios; see benchmarks.scenarios for the options."""
+
+from .scenarios import main
+
+main()
@@ -0,0 +1,50 @@
+"""Latency and failure behavior of the stand-in model and search services."""
+
+import math
+import random
+from dataclasses import dataclass, field
+
+
+@dataclass
+class Latency:
+    """A log-normal latency distribution, in seconds.
+
+    median is the typical latency and sigma the spread; the p95 is about
+    median * exp(1.645 * sigma). A median of 0 means no delay at all.
+    """
+
+    median: float = 0.0
+    sigma: float = 0.5
+
+    def sample(self, rng: random.Random) -> float:
+        if self.median <= 0:
+            return 0.0
+        return rng.lognormvariate(math.log(self.median), self.sigma)
+
+
+@dataclass
+class Behavior:
+    """How a stand-in service responds.
+
+    error_rate is the share of requests failing with a 5xx and
+    rate_limit_rate the share answered with a 429 and a Retry-After of
+    retry_after seconds.
+    """
+
+    latency: Latency = field(default_factory=Latency)
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    retry_after: float = 1.0
+    seed: int = 0
+
+    def __post_init__(self):
+        self.rng = random.Random(self.seed)
+
+    def outcome(self) -> str:
+        """Draw "ok", "error" or "rate_limited" for the next request."""
+        draw = self.rng.random()
+        if draw < self.rate_limit_rate:
+            return "rate_limited"
+        if draw < self.rate_limit_rate + self.error_rate:
+            return "error"
+        return "ok"
@@ -0,0 +1,113 @@
+"""A stand-in for tavily's AsyncTavilyClient."""
+
+import asyncio
+import hashlib
+import time
+from typing import Any
+
+from tavily.errors import UsageLimitExceededError
+
+from .behavior import Behavior
+from .fixtures import FixtureStore, Mode
+
+_SENTENCES = [
+    "GPUs run thousands of threads in parallel, suiting the matrix math of training.",
+    "High bandwidth memory keeps the compute units fed during large batch training.",
+    "Tensor cores accelerate mixed precision matrix multiplication.",
+    "Multi-GPU training relies on fast interconnects to exchange gradients.",
+    "Software libraries such as cuDNN and NCCL expose the hardware to frameworks.",
+    "Inference benefits from the same parallelism at lower precision.",
+    "Power efficiency per operation is a major factor in data center cost.",
+    "Cloud providers offer GPU instances billed by the hour.",
+]
+
+
+class SearchServiceError(Exception):
+    """A synthetic 5xx from the search service."""
+
+    status_code = 503
+
+
+class FakeAsyncTavilyClient:
+    """Answers search() with synthetic, recorded or real results.
+
+    Synthetic results are deterministic for a query, with results_per_query
+    sources of about content_chars characters each. A share of queries
+    (overlap) is mapped onto a small set of shared URLs, as real searches for
+    related sections return many of the same pages.
+    """
+
+    def __init__(
+        self,
+        behavior: Behavior | None = None,
+        mode: Mode = "synthetic",
+        fixtures: FixtureStore | None = None,
+        client: Any = None,
+        results_per_query: int = 5,
+        content_chars: int = 600,
+        overlap: float = 0.3,
+        replay_speed: float = 1.0,
+    ):
+        if mode != "synthetic" and fixtures is None:
+            raise ValueError(f"{mode} mode needs a fixture store.")
+        if mode == "record" and client is None:
+            raise ValueError("record mode needs a real client to record.")
+        self.behavior = behavior or Behavior()
+        self.mode = mode
+        self.fixtures = fixtures
+        self.client = client
+        self.results_per_query = results_per_query
+        self.content_chars = content_chars
+        self.overlap = overlap
+        self.replay_speed = replay_speed
+        self.calls = 0
+        self.errors = 0
+        self.rate_limited = 0
+
+    def _results(self, query: str) -> dict[str, Any]:
+        digest = int(hashlib.sha1(query.encode("utf-8")).hexdigest(), 16)
+        shared = (digest % 1000) / 1000 < self.overlap
+        results = []
+        for rank in range(self.results_per_query):
+            page = f"shared-{rank}" if shared else f"{digest % 10**8}-{rank}"
+            content = " ".join(
+                _SENTENCES[(digest + rank + i) % len(_SENTENCES)]
+                for i in range(self.content_chars // 80 + 1)
+            )[: self.content_chars]
+            results.append(
+                {
+                    "url": f"https://example.com/{page}",
+                    "title": f"{query.title()} ({rank + 1})",
+                    "content": content,
+                    "score": round(1 - rank / self.results_per_query, 3),
+                    "raw_content": None,
+                }
+            )
+        return {"query": query, "results": results, "response_time": 0.0}
+
+    async def search(self, query: str, **kwargs: Any) -> dict[str, Any]:
+        self.calls += 1
+        request = {"query": query, **kwargs}
+        if self.mode == "record":
+            started = time.monotonic()
+            response = await self.client.search(query, **kwargs)
+            assert self.fixtures is not None
+            self.fixtures.record(request, response, time.monotonic() - started)
+            return response
+
+        outcome = self.behavior.outcome()
+        if outcome == "rate_limited":
+            self.rate_limited += 1
+            raise UsageLimitExceededError("Synthetic rate limit.")
+        if outcome == "error":
+            self.errors += 1
+            raise SearchServiceError("Synthetic search failure.")
+
+        if self.mode == "replay":
+            assert self.fixtures is not None
+            entry = self.fixtures.get(request)
+            if entry is not None:
+                await asyncio.sleep(entry["latency"] / self.replay_speed)
+                return entry["response"]
+        await asyncio.sleep(self.behavior.latency.sample(self.behavior.rng))
+        return self._results(query)
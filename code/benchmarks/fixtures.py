@@ -0,0 +1,57 @@
+"""Recorded responses of the real services, replayed by the stand-ins."""
+
+import hashlib
+import json
+import threading
+from pathlib import Path
+from typing import Any, Literal
+
+Mode = Literal["synthetic", "record", "replay"]
+
+
+def request_key(request: Any) -> str:
+    """A stable key for a request body."""
+    encoded = json.dumps(request, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class FixtureStore:
+    """Responses keyed by request, appended to a JSONL file as they are recorded.
+
+    Each line holds the request key, the response and the latency it had, so
+    a replay can reproduce both the content and the timing of a real run.
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: dict[str, dict[str, Any]] = {}
+        if self.path.exists():
+            with self.path.open(encoding="utf-8") as lines:
+                for line in lines:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._entries[entry["key"]] = entry
+
+    def get(self, request: Any) -> dict[str, Any] | None:
+        """The recorded response and latency for request, if there is one."""
+        with self._lock:
+            entry = self._entries.get(request_key(request))
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def record(self, request: Any, response: Any, latency: float) -> None:
+        entry = {"key": request_key(request), "response": response, "latency": latency}
+        with self._lock:
+            self._entries[entry["key"]] = entry
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with self.path.open("a", encoding="utf-8") as lines:
+                lines.write(json.dumps(entry) + "\n")
+
+    def __len__(self) -> int:
+        return len(self._entries)
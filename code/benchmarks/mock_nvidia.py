@@ -0,0 +1,368 @@
+"""A local OpenAI-compatible chat completions server standing in for NVIDIA.
+
+In "synthetic" mode it answers the way the report graphs expect: report plans
+for guided JSON requests, a configurable number of search tool call rounds for
+requests with tools, and section text otherwise. "record" forwards requests to
+the real endpoint and saves the responses; "replay" serves the saved ones,
+with their recorded latency.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Any
+
+import aiohttp
+from aiohttp import web
+
+from .behavior import Behavior
+from .fixtures import FixtureStore, Mode
+
+_LOGGER = logging.getLogger(__name__)
+
+UPSTREAM_URL = "https://integrate.api.nvidia.com/v1"
+_SECTION_NAME = re.compile(r"Section name: (.*)")
+_TOPIC = re.compile(r"(?:Topic for this section|Overall report topic):\s*\n?(.*)")
+_WORDS = (
+    "accelerated computing parallel throughput memory bandwidth tensor cores "
+    "mixed precision training clusters interconnect scaling efficiency models "
+    "inference latency frameworks kernels datasets batch optimizer gradients"
+).split()
+# characters of content per streamed chunk, about four tokens
+_CHUNK_CHARS = 16
+
+
+@dataclass
+class ServerStats:
+    requests: int = 0
+    errors: int = 0
+    rate_limited: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+    def as_dict(self) -> dict[str, int]:
+        return dict(self.__dict__)
+
+
+def _text(words: int, seed: str) -> str:
+    offset = int(hashlib.sha1(seed.encode("utf-8")).hexdigest(), 16)
+    return " ".join(_WORDS[(offset + i) % len(_WORDS)] for i in range(words))
+
+
+class MockNvidiaServer:
+    """Serve /v1/chat/completions and /v1/models from a background thread.
+
+    The server runs on its own event loop so it keeps answering while the
+    benchmark's loop is busy, including the blocking model listing request
+    ChatNVIDIA makes for structured output against a local endpoint.
+    """
+
+    def __init__(
+        self,
+        behavior: Behavior | None = None,
+        mode: Mode = "synthetic",
+        fixtures: FixtureStore | None = None,
+        upstream: str = UPSTREAM_URL,
+        sections: int = 5,
+        search_rounds: int = 1,
+        queries_per_call: int = 3,
+        completion_words: int = 300,
+        replay_speed: float = 1.0,
+        stream_delay: float = 0.0,
+    ):
+        if mode != "synthetic" and fixtures is None:
+            raise ValueError(f"{mode} mode needs a fixture store.")
+        self.behavior = behavior or Behavior()
+        self.mode = mode
+        self.fixtures = fixtures
+        self.upstream = upstream.rstrip("/")
+        self.sections = sections
+        self.search_rounds = search_rounds
+        self.queries_per_call = queries_per_call
+        self.completion_words = completion_words
+        self.replay_speed = replay_speed
+        # seconds between streamed chunks of content, for a model that
+        # streams its response instead of sending it in one piece
+        self.stream_delay = stream_delay
+        self.stats = ServerStats()
+        self.base_url = ""
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._runner: web.AppRunner | None = None
+        self._thread: threading.Thread | None = None
+
+    # ---------------------------
+    # SYNTHETIC RESPONSES
+    # ---------------------------
+    def _plan(self, system: str) -> dict[str, Any]:
+        topic = _TOPIC.search(system)
+        subject = topic.group(1).strip() if topic else "the topic"
+        sections = [
+            {
+                "name": "Introduction",
+                "description": f"Overview of {subject}.",
+                "research": False,
+                "content": "",
+            }
+        ]
+        for index in range(1, max(self.sections - 1, 1)):
+            sections.append(
+                {
+                    "name": f"Aspect {index}",
+                    "description": f"{_text(6, f'{subject}{index}')} of {subject}.",
+                    "research": True,
+                    "content": "",
+                }
+            )
+        if self.sections > 1:
+            sections.append(
+                {
+                    "name": "Conclusion",
+                    "description": f"Summary and comparison table for {subject}.",
+                    "research": False,
+                    "content": "",
+                }
+            )
+        return {
+            "content": json.dumps(
+                {"title": f"Report on {subject}", "sections": sections}
+            )
+        }
+
+    def _tool_round(
+        self, system: str, messages: list[dict[str, Any]]
+    ) -> dict[str, Any]:
+        # tool call ids carry a tag of the system prompt, so rounds are counted
+        # per task even when a section inherits the topic research transcript
+        tag = hashlib.sha1(system.encode("utf-8")).hexdigest()[:8]
+        rounds = sum(
+            1
+            for message in messages
+            if message.get("role") == "assistant"
+            and any(
+                call.get("id", "").startswith(f"call_{tag}")
+                for call in message.get("tool_calls") or []
+            )
+        )
+        if rounds >= self.search_rounds:
+            return {"content": "The research gathered so far is sufficient."}
+        name = _SECTION_NAME.search(system) or _TOPIC.search(system)
+        subject = name.group(1).strip() if name else "topic"
+        queries = [
+            f"{subject} {_text(3, f'{tag}{rounds}{i}')}"
+            for i in range(self.queries_per_call)
+        ]
+        return {
+            "content": "",
+            "tool_calls": [
+                {
+                    "id": f"call_{tag}_{rounds}",
+                    "type": "function",
+                    "function": {
+                        "name": "search_tavily",
+                        "arguments": json.dumps(
+                            {"queries": queries, "topic": "general"}
+                        ),
+                    },
+                }
+            ],
+        }
+
+    def _section(self, system: str) -> dict[str, Any]:
+        name = _SECTION_NAME.search(system)
+        title = name.group(1).strip() if name else "Answer"
+        return {"content": f"## {title}\n\n{_text(self.completion_words, system)}"}
+
+    def _synthetic(self, body: dict[str, Any]) -> dict[str, Any]:
+        messages = body.get("messages", [])
+        system = next(
+            (m.get("content") or "" for m in messages if m.get("role") == "system"), ""
+        )
+        if (body.get("nvext") or {}).get("guided_json") or body.get("response_format"):
+            message = self._plan(system)
+        elif body.get("tools"):
+            message = self._tool_round(system, messages)
+        else:
+            message = self._section(system)
+        completion = message["content"] + json.dumps(message.get("tool_calls", ""))
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", ""),
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", **message},
+                    "finish_reason": (
+                        "tool_calls" if message.get("tool_calls") else "stop"
+                    ),
+                }
+            ],
+            "usage": {
+                "prompt_tokens": len(json.dumps(messages)) // 4,
+                "completion_tokens": len(completion) // 4,
+                "total_tokens": (len(json.dumps(messages)) + len(completion)) // 4,
+            },
+        }
+
+    # ---------------------------
+    # HANDLERS
+    # ---------------------------
+    async def _forward(
+        self, request: web.Request, body: dict[str, Any]
+    ) -> dict[str, Any]:
+        headers = {
+            name: request.headers[name]
+            for name in ("Authorization", "x-api-key")
+            if name in request.headers
+        }
+        started = time.monotonic()
+        async with aiohttp.ClientSession() as session:
+            async with session.post(
+                f"{self.upstream}/chat/completions",
+                json={**body, "stream": False},
+                headers=headers,
+            ) as upstream:
+                upstream.raise_for_status()
+                response = await upstream.json()
+        assert self.fixtures is not None
+        self.fixtures.record(body, response, time.monotonic() - started)
+        return response
+
+    async def _respond(
+        self, request: web.Request, body: dict[str, Any]
+    ) -> dict[str, Any]:
+        if self.mode == "record":
+            return await self._forward(request, body)
+        if self.mode == "replay":
+            assert self.fixtures is not None
+            entry = self.fixtures.get({**body, "stream": False})
+            if entry is not None:
+                await asyncio.sleep(entry["latency"] / self.replay_speed)
+                return entry["response"]
+            _LOGGER.warning("No recorded response, answering synthetically.")
+        await asyncio.sleep(self.behavior.latency.sample(self.behavior.rng))
+        return self._synthetic(body)
+
+    async def _chat(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.stats.requests += 1
+        if self.mode != "record":
+            outcome = self.behavior.outcome()
+            if outcome == "rate_limited":
+                self.stats.rate_limited += 1
+                return web.json_response(
+                    {
+                        "status": 429,
+                        "title": "Too Many Requests",
+                        "detail": "Rate limit exceeded.",
+                    },
+                    status=429,
+                    headers={"Retry-After": f"{self.behavior.retry_after:g}"},
+                )
+            if outcome == "error":
+                self.stats.errors += 1
+                return web.json_response(
+                    {
+                        "status": 500,
+                        "title": "Internal Server Error",
+                        "detail": "Synthetic failure.",
+                    },
+                    status=500,
+                )
+        response = await self._respond(request, {**body, "stream": False})
+        usage = response.get("usage") or {}
+        self.stats.prompt_tokens += usage.get("prompt_tokens", 0)
+        self.stats.completion_tokens += usage.get("completion_tokens", 0)
+        if not body.get("stream"):
+            return web.json_response(response)
+        return await self._stream(request, response)
+
+    async def _stream(
+        self, request: web.Request, response: dict[str, Any]
+    ) -> web.StreamResponse:
+        stream = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await stream.prepare(request)
+        message = response["choices"][0]["message"]
+        content = message.get("content") or ""
+        pieces = (
+            [
+                content[i : i + _CHUNK_CHARS]
+                for i in range(0, len(content), _CHUNK_CHARS)
+            ]
+            if self.stream_delay and content
+            else [message.get("content")]
+        )
+        delta: dict[str, Any] = {"role": "assistant", "content": pieces[0]}
+        if message.get("tool_calls"):
+            delta["tool_calls"] = [
+                {"index": index, **call}
+                for index, call in enumerate(message["tool_calls"])
+            ]
+        chunks = [
+            {"index": 0, "delta": delta, "finish_reason": None},
+            *(
+                {"index": 0, "delta": {"content": piece}, "finish_reason": None}
+                for piece in pieces[1:]
+            ),
+            {
+                "index": 0,
+                "delta": {},
+                "finish_reason": response["choices"][0]["finish_reason"],
+            },
+        ]
+        for position, choice in enumerate(chunks):
+            if position and self.stream_delay:
+                await asyncio.sleep(self.stream_delay)
+            chunk = {**response, "object": "chat.completion.chunk", "choices": [choice]}
+            await stream.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        await stream.write(b"data: [DONE]\n\n")
+        await stream.write_eof()
+        return stream
+
+    async def _models(self, request: web.Request) -> web.Response:
+        return web.json_response({"object": "list", "data": []})
+
+    # ---------------------------
+    # LIFECYCLE
+    # ---------------------------
+    def start(self) -> str:
+        """Start serving on a free local port, returning the base URL."""
+        ready = threading.Event()
+
+        async def serve() -> None:
+            app = web.Application()
+            app.router.add_post("/v1/chat/completions", self._chat)
+            app.router.add_get("/v1/models", self._models)
+            app.router.add_route("HEAD", "/v1", self._models)
+            self._runner = web.AppRunner(app, access_log=None)
+            await self._runner.setup()
+            site = web.TCPSite(self._runner, "127.0.0.1", 0)
+            await site.start()
+            port = self._runner.addresses[0][1]
+            self.base_url = f"http://127.0.0.1:{port}/v1"
+            ready.set()
+
+        def run() -> None:
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(serve())
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name="mock-nvidia", daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self.base_url
+
+    def stop(self) -> None:
+        if self._loop is None or self._runner is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        if self._thread is not None:
+            self._thread.join()
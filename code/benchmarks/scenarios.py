@@ -0,0 +1,425 @@
+"""Benchmark scenarios driving the graphs against the local stand-ins.
+
+Run from the code directory, for example:
+
+    python -m benchmarks report --sections 3 6 --concurrency 1 4 --runs 8
+    python -m benchmarks researcher author ask --runs 20 --model-latency 0.3
+    python -m benchmarks memory --sections 5 10 20 --runs 4 --search-rounds 3
+
+Each scenario runs at every combination of --sections and --concurrency and
+reports p50/p95 latency, throughput, model tokens, request counts and peak
+memory. The memory scenario writes reports one at a time and reports the peak
+resident memory of each. With --mode record the stand-ins pass requests through to the real
+NVIDIA and Tavily APIs and save the responses under --fixtures; --mode replay
+serves those responses again, with their recorded latency, without network.
+"""
+
+import argparse
+import asyncio
+import gc
+import itertools
+import json
+import logging
+import os
+import resource
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+from pathlib import Path
+from typing import Any, Awaitable, Callable
+
+from .behavior import Behavior, Latency
+from .fake_tavily import FakeAsyncTavilyClient
+from .fixtures import FixtureStore
+from .mock_nvidia import MockNvidiaServer
+
+_LOGGER = logging.getLogger(__name__)
+
+SCENARIOS = ("report", "researcher", "author", "ask", "memory")
+# Scenarios whose results depend on the number of sections in a plan.
+SECTIONED = ("report", "memory")
+
+
+def percentile(values: list[float], q: float) -> float:
+    """The q-th percentile of values, interpolating between samples."""
+    if not values:
+        return 0.0
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[round(q) - 1]
+
+
+def _document(tokens: int) -> str:
+    paragraph = (
+        "Graphics processors execute many threads at once and have high memory "
+        "bandwidth, which makes them a good fit for the matrix operations used "
+        "when training neural networks. "
+    )
+    paragraphs = []
+    while sum(map(len, paragraphs)) < tokens * 4:
+        paragraphs.append(f"Part {len(paragraphs) + 1}. " + paragraph * 3)
+    return "\n\n".join(paragraphs)
+
+
+def _rss() -> int:
+    """The resident set size of this process, in bytes."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # the peak so far, where there is no /proc; ru_maxrss is in kilobytes
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RssSampler:
+    """Samples the resident set size on a thread, keeping the peak."""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self) -> None:
+        while not self._stop.is_set():
+            self.peak = max(self.peak, _rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self) -> "RssSampler":
+        self.peak = _rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, _rss())
+
+
+class Bench:
+    """The stand-ins and the package under test, wired together."""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        fixtures = Path(args.fixtures) if args.fixtures else None
+        self.model_fixtures = (
+            FixtureStore(fixtures / "model.jsonl") if fixtures else None
+        )
+        self.search_fixtures = (
+            FixtureStore(fixtures / "search.jsonl") if fixtures else None
+        )
+        self.server = MockNvidiaServer(
+            Behavior(
+                Latency(args.model_latency, args.latency_sigma),
+                error_rate=args.error_rate,
+                rate_limit_rate=args.rate_limit_rate,
+                seed=args.seed,
+            ),
+            mode=args.mode,
+            fixtures=self.model_fixtures,
+            search_rounds=args.search_rounds,
+            replay_speed=args.replay_speed,
+            stream_delay=args.stream_delay,
+        )
+        base_url = self.server.start()
+
+        # the package reads its settings at import, so configure it first
+        os.environ["NVIDIA_BASE_URL"] = base_url
+        os.environ.setdefault(
+            "DOCGEN_CACHE_DIR", tempfile.mkdtemp(prefix="docgen-bench-")
+        )
+        os.environ.setdefault("LLM_CACHE", "0")
+        os.environ.setdefault("SEARCH_CACHE", "0")
+        if args.mode != "record":
+            os.environ.setdefault("NVIDIA_API_KEY", "benchmark")
+            os.environ.setdefault(
+                "LLM_REQUESTS_PER_MINUTE", str(args.requests_per_minute)
+            )
+            os.environ.setdefault("LLM_TOKENS_PER_MINUTE", str(10**9))
+            os.environ.setdefault(
+                "SEARCH_REQUESTS_PER_MINUTE", str(args.requests_per_minute)
+            )
+
+        import docgen_agent
+        from docgen_agent import clients
+
+        self.package = docgen_agent
+        real_tavily = clients.tavily
+        self.search = FakeAsyncTavilyClient(
+            Behavior(
+                Latency(args.search_latency, args.latency_sigma),
+                error_rate=args.error_rate,
+                rate_limit_rate=args.rate_limit_rate,
+                seed=args.seed + 1,
+            ),
+            mode=args.mode,
+            fixtures=self.search_fixtures,
+            client=types.SimpleNamespace(
+                search=lambda query, **kwargs: real_tavily().search(query, **kwargs)
+            ),
+            replay_speed=args.replay_speed,
+        )
+        clients.tavily = lambda: self.search
+        # peak resident memory of each report of the memory scenario, in bytes
+        self.report_peaks: list[int] = []
+
+    # ---------------------------
+    # SCENARIOS
+    # ---------------------------
+    async def report(self, runs: int, concurrency: int) -> list[float]:
+        jobs = (
+            (
+                f"Benchmark topic {i}: GPUs for AI training",
+                "Introduction, one "
+                "section per aspect, conclusion with a comparison table.",
+            )
+            for i in range(runs)
+        )
+        latencies = []
+        async for result in self.package.async_write_reports(
+            jobs, report_concurrency=concurrency
+        ):
+            if not result.ok:
+                _LOGGER.warning("Report %d failed: %s", result.index, result.error)
+            latencies.append(result.seconds)
+        return latencies
+
+    async def memory(self, runs: int, concurrency: int) -> list[float]:
+        """Reports one at a time, recording the peak memory of each."""
+        latencies = []
+        for i in range(runs):
+            gc.collect()
+            with RssSampler() as rss:
+                started = time.monotonic()
+                try:
+                    await self.package.async_write_report(
+                        f"Benchmark topic {i}: GPUs for AI training",
+                        "Introduction, one section per aspect, conclusion.",
+                    )
+                except Exception as err:
+                    _LOGGER.warning("Report %d failed: %s", i, err)
+                latencies.append(time.monotonic() - started)
+            self.report_peaks.append(rss.peak)
+        return latencies
+
+    async def _each(
+        self, runs: int, concurrency: int, run: Callable[[int], Awaitable[Any]]
+    ) -> list[float]:
+        slots = asyncio.Semaphore(concurrency)
+        latencies: list[float] = []
+
+        async def timed(index: int) -> None:
+            async with slots:
+                started = time.monotonic()
+                try:
+                    await run(index)
+                except Exception as err:
+                    _LOGGER.warning("Run %d failed: %s", index, err)
+                latencies.append(time.monotonic() - started)
+
+        await asyncio.gather(*(timed(index) for index in range(runs)))
+        return latencies
+
+    async def researcher(self, runs: int, concurrency: int) -> list[float]:
+        from docgen_agent import research, researcher
+
+        return await self._each(
+            runs,
+            concurrency,
+            lambda i: researcher.graph.ainvoke(
+                researcher.ResearcherState(topic=f"GPUs for AI training, part {i}"),
+                {"configurable": {"research_pool": research.ResearchPool()}},
+            ),
+        )
+
+    async def author(self, runs: int, concurrency: int) -> list[float]:
+        from docgen_agent import author, research
+
+        pool = research.ResearchPool()
+        return await self._each(
+            runs,
+            concurrency,
+            lambda i: author.graph.ainvoke(
+                author.SectionWriterState(
+                    index=i,
+                    section=author.Section(
+                        name=f"Aspect {i}",
+                        description=f"Aspect {i} of GPUs for AI training.",
+                        research=True,
+                        content="",
+                    ),
+                    topic="GPUs for AI training",
+                ),
+                {"configurable": {"research_pool": pool}},
+            ),
+        )
+
+    async def ask(self, runs: int, concurrency: int) -> list[float]:
+        from docgen_agent import ask
+
+        document = _document(self.args.document_tokens)
+        return await self._each(
+            runs,
+            concurrency,
+            lambda i: ask.graph.ainvoke(
+                ask.ResearcherState(
+                    topic=f"Why are GPUs good for training? ({i % 3})",
+                    document=document,
+                )
+            ),
+        )
+
+    # ---------------------------
+    # MEASUREMENT
+    # ---------------------------
+    async def measure(
+        self, scenario: str, sections: int, concurrency: int
+    ) -> dict[str, Any]:
+        self.server.sections = sections
+        self.server.stats = type(self.server.stats)()
+        searches = self.search.calls
+        self.report_peaks = []
+        if self.args.trace_memory:
+            tracemalloc.start()
+        started = time.monotonic()
+        latencies = await getattr(self, scenario)(self.args.runs, concurrency)
+        elapsed = time.monotonic() - started
+        traced_peak = 0
+        if self.args.trace_memory:
+            traced_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        stats = self.server.stats
+        return {
+            "scenario": scenario,
+            "sections": sections if scenario in SECTIONED else "-",
+            "concurrency": concurrency,
+            "runs": len(latencies),
+            "p50_s": round(percentile(latencies, 50), 3),
+            "p95_s": round(percentile(latencies, 95), 3),
+            "throughput_per_s": round(len(latencies) / elapsed, 3) if elapsed else 0.0,
+            "model_requests": stats.requests,
+            "prompt_tokens": stats.prompt_tokens,
+            "completion_tokens": stats.completion_tokens,
+            "searches": self.search.calls - searches,
+            # ru_maxrss is in kilobytes on Linux
+            "peak_rss_mb": round(
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+            ),
+            "traced_peak_mb": round(traced_peak / 2**20, 1),
+            "report_peak_rss_mb": (
+                round(max(self.report_peaks) / 2**20, 1) if self.report_peaks else "-"
+            ),
+            "report_peaks_rss_mb": [
+                round(peak / 2**20, 1) for peak in self.report_peaks
+            ],
+        }
+
+    async def run(self) -> list[dict[str, Any]]:
+        from docgen_agent import clients
+
+        results = []
+        try:
+            for scenario, sections, concurrency in itertools.product(
+                self.args.scenarios, self.args.sections, self.args.concurrency
+            ):
+                if scenario not in SECTIONED and sections != self.args.sections[0]:
+                    continue
+                result = await self.measure(scenario, sections, concurrency)
+                _print_row(result)
+                results.append(result)
+        finally:
+            await clients.aclose()
+            self.server.stop()
+        for name, store in (
+            ("model", self.model_fixtures),
+            ("search", self.search_fixtures),
+        ):
+            if store is not None:
+                print(
+                    f"{name} fixtures: {len(store)} recorded, "
+                    f"{store.hits} replayed, {store.misses} missing"
+                )
+        return results
+
+
+_COLUMNS = (
+    ("scenario", 10),
+    ("sections", 8),
+    ("concurrency", 11),
+    ("runs", 5),
+    ("p50_s", 8),
+    ("p95_s", 8),
+    ("throughput_per_s", 16),
+    ("model_requests", 14),
+    ("prompt_tokens", 13),
+    ("completion_tokens", 17),
+    ("searches", 8),
+    ("peak_rss_mb", 11),
+    ("report_peak_rss_mb", 18),
+)
+
+
+def _print_row(result: dict[str, Any]) -> None:
+    if not getattr(_print_row, "header", False):
+        print(" ".join(name.rjust(width) for name, width in _COLUMNS))
+        _print_row.header = True  # type: ignore[attr-defined]
+    print(" ".join(str(result[name]).rjust(width) for name, width in _COLUMNS))
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description="Benchmark the report graphs against local stand-ins.",
+    )
+    parser.add_argument(
+        "scenarios",
+        nargs="*",
+        choices=SCENARIOS,
+        default=["report"],
+        metavar="scenario",
+    )
+    parser.add_argument("--runs", type=int, default=8)
+    parser.add_argument("--sections", type=int, nargs="+", default=[5])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--model-latency", type=float, default=0.2, help="median, s")
+    parser.add_argument("--search-latency", type=float, default=0.1, help="median, s")
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--stream-delay",
+        type=float,
+        default=0.0,
+        help="seconds between streamed chunks of model output",
+    )
+    parser.add_argument("--search-rounds", type=int, default=1)
+    parser.add_argument("--document-tokens", type=int, default=20_000)
+    parser.add_argument(
+        "--requests-per-minute",
+        type=float,
+        default=100_000,
+        help="client rate limit; high by default to measure orchestration only",
+    )
+    parser.add_argument(
+        "--mode", choices=("synthetic", "record", "replay"), default="synthetic"
+    )
+    parser.add_argument("--fixtures", help="directory of recorded responses")
+    parser.add_argument("--replay-speed", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace-memory", action="store_true")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+    if args.mode != "synthetic" and not args.fixtures:
+        parser.error(f"--mode {args.mode} needs --fixtures")
+    return args
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    results = asyncio.run(Bench(args).run())
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
@@ -1,20 +1,258 @@
 """Main entry point for the report generation workflow."""
 
 import asyncio
-from typing import Any
+import logging
+import os
+import time
+import uuid
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Awaitable, Iterable, Iterator, TypeVar
 
-from .agent import AgentState, graph
+from langchain_core.runnables import RunnableConfig
+from langgraph.graph.state import CompiledStateGraph
+
+from . import checkpoint, clients, research, scheduler, telemetry
+from .agent import AgentState, SectionPipeline, graph, workflow
+from .clients import warm_up
+
+_LOGGER = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Defaults for write_reports: how many reports are in flight at once, and how
+# many sections are being written at once across all of them.
+REPORT_CONCURRENCY = int(os.getenv("REPORT_CONCURRENCY", "4"))
+SECTION_CONCURRENCY = int(os.getenv("SECTION_CONCURRENCY", "8"))
+
+
+def run_config(
+    run_id: str,
+    tracer: telemetry.RunTracer | None = None,
+    section_slots: scheduler.PrioritySlots | None = None,
+    priority: int = 0,
+) -> RunnableConfig:
+    """The config of a report run, for the graph of open_durable_graph.
+
+    Runs that share section_slots are given section writers by priority,
+    lowest first.
+    """
+    configurable: dict[str, Any] = {
+        "thread_id": run_id,
+        "research_pool": research.ResearchPool(),
+        "section_pipeline": SectionPipeline(),
+    }
+    if section_slots is not None:
+        configurable["section_slots"] = section_slots
+        configurable["priority"] = priority
+    config: RunnableConfig = {"configurable": configurable}
+    if tracer is not None:
+        config["callbacks"] = [tracer]
+    return config
+
+
+async def _closing(call: Awaitable[T]) -> T:
+    """Await call, then close the connections it opened on this event loop."""
+    try:
+        return await call
+    finally:
+        await clients.aclose()
+
+
+@asynccontextmanager
+async def open_durable_graph() -> AsyncIterator[CompiledStateGraph]:
+    """Compile the report graph against the shared checkpointer."""
+    async with checkpoint.checkpointer() as saver:
+        yield workflow.compile(checkpointer=saver)
 
 
 async def async_write_report(
-    topic: str, report_structure: str
+    topic: str, report_structure: str, run_id: str | None = None
 ) -> Any | dict[str, Any] | None:
-    """Write a report."""
+    """Write a report, checkpointing progress so it can be resumed."""
+    run_id = run_id or uuid.uuid4().hex
+    _LOGGER.info("Starting report run %s.", run_id)
     state = AgentState(topic=topic, report_structure=report_structure)
-    result = await graph.ainvoke(state)
+    async with open_durable_graph() as durable_graph, telemetry.trace_run(
+        run_id
+    ) as tracer:
+        result = await durable_graph.ainvoke(state, run_config(run_id, tracer))
+    await asyncio.to_thread(checkpoint.clear, run_id)
     return result
 
 
-def write_report(topic: str, report_structure: str) -> Any | dict[str, Any] | None:
+def write_report(
+    topic: str, report_structure: str, run_id: str | None = None
+) -> Any | dict[str, Any] | None:
     """Write a report."""
-    return asyncio.run(async_write_report(topic, report_structure))
+    return asyncio.run(_closing(async_write_report(topic, report_structure, run_id)))
+
+
+async def async_resume_report(run_id: str) -> Any | dict[str, Any] | None:
+    """Finish an interrupted report run, rewriting only its unfinished sections."""
+    async with open_durable_graph() as durable_graph:
+        snapshot = await durable_graph.aget_state(run_config(run_id))
+        if not snapshot.values:
+            raise ValueError(f"No report run found with id {run_id}.")
+        if not snapshot.next:
+            _LOGGER.info("Report run %s already finished.", run_id)
+            return snapshot.values
+        _LOGGER.info("Resuming report run %s at %s.", run_id, ", ".join(snapshot.next))
+        async with telemetry.trace_run(run_id) as tracer:
+            result = await durable_graph.ainvoke(None, run_config(run_id, tracer))
+    await asyncio.to_thread(checkpoint.clear, run_id)
+    return result
+
+
+def resume_report(run_id: str) -> Any | dict[str, Any] | None:
+    """Resume a report."""
+    return asyncio.run(_closing(async_resume_report(run_id)))
+
+
+async def astream_report(
+    topic: str, report_structure: str, run_id: str | None = None
+) -> AsyncIterator[dict[str, Any]]:
+    """Write a report, yielding its progress as it happens.
+
+    Events are dicts with a "type" of:
+      plan - the report outline, once the planner has produced it.
+      token - a chunk of section text from the writer, with its section index;
+        sections start while the plan streams, so tokens may precede "plan".
+      section - a finished section and its index, in completion order.
+      report - the finished report.
+    """
+    run_id = run_id or uuid.uuid4().hex
+    _LOGGER.info("Starting report run %s.", run_id)
+    state = AgentState(topic=topic, report_structure=report_structure)
+    async with open_durable_graph() as durable_graph, telemetry.trace_run(
+        run_id
+    ) as tracer:
+        config = run_config(run_id, tracer)
+        async for event in report_events(durable_graph, state, config):
+            yield event
+        snapshot = await durable_graph.aget_state(config)
+    await asyncio.to_thread(checkpoint.clear, run_id)
+    yield {"type": "report", "report": snapshot.values.get("report")}
+
+
+async def report_events(
+    durable_graph: CompiledStateGraph, state: AgentState, config: RunnableConfig
+) -> AsyncIterator[dict[str, Any]]:
+    """Run the report graph, yielding the plan, token and section events."""
+    async for event in durable_graph.astream_events(state, config, version="v2"):
+        kind = event["event"]
+        metadata = event.get("metadata", {})
+        if kind == "on_custom_event" and event["name"] == "report_plan":
+            yield {"type": "plan", **event["data"]}
+        elif kind == "on_custom_event" and event["name"] == "section":
+            yield {"type": "section", **event["data"]}
+        elif (
+            kind == "on_chat_model_stream"
+            and metadata.get("langgraph_node") == "writer"
+        ):
+            chunk = event["data"]["chunk"]
+            if chunk.content:
+                yield {
+                    "type": "token",
+                    "index": metadata.get("section_index"),
+                    "content": chunk.content,
+                }
+
+
+@dataclass
+class ReportResult:
+    """The outcome of one job of a write_reports batch."""
+
+    index: int
+    topic: str
+    run_id: str
+    report: str | None = None
+    error: BaseException | None = None
+    seconds: float = 0.0
+    # where the run's time went, see telemetry.RunTracer.summary
+    summary: dict[str, Any] | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+async def async_write_reports(
+    jobs: Iterable[tuple[str, str]],
+    report_concurrency: int | None = None,
+    section_concurrency: int | None = None,
+) -> AsyncIterator[ReportResult]:
+    """Write a batch of (topic, report_structure) reports on one event loop.
+
+    Reports share the checkpointer, the model and search rate limiters and a
+    pool of section writers. Up to report_concurrency reports are in flight;
+    while the earliest ones write their sections, later ones research and plan,
+    which keeps the model quota busy. Results are yielded as reports finish. A
+    failed report is yielded with its error and its run id, so it can be
+    resumed with resume_report, and does not stop the rest of the batch.
+    """
+    report_concurrency = report_concurrency or REPORT_CONCURRENCY
+    section_slots = scheduler.PrioritySlots(section_concurrency or SECTION_CONCURRENCY)
+    pending = iter(enumerate(jobs))
+    results: asyncio.Queue[ReportResult | None] = asyncio.Queue()
+
+    async def worker(durable_graph: CompiledStateGraph) -> None:
+        # jobs are pulled lazily, so a long job file is never loaded up front
+        for index, (topic, report_structure) in pending:
+            run_id = uuid.uuid4().hex
+            result = ReportResult(index=index, topic=topic, run_id=run_id)
+            started = time.monotonic()
+            _LOGGER.info("Starting report run %s (job %d).", run_id, index)
+            tracer = None
+            try:
+                async with telemetry.trace_run(run_id) as tracer:
+                    state = AgentState(topic=topic, report_structure=report_structure)
+                    # earlier jobs get section writers first
+                    config = run_config(run_id, tracer, section_slots, index)
+                    values = await durable_graph.ainvoke(state, config)
+                result.report = values.get("report")
+                await asyncio.to_thread(checkpoint.clear, run_id)
+            except Exception as err:
+                _LOGGER.error("Report job %d (%s) failed: %s", index, topic, err)
+                result.error = err
+            if tracer is not None:
+                result.summary = tracer.summary()
+            result.seconds = time.monotonic() - started
+            await results.put(result)
+        await results.put(None)
+
+    async with open_durable_graph() as durable_graph:
+        workers = [
+            asyncio.create_task(worker(durable_graph))
+            for _ in range(report_concurrency)
+        ]
+        try:
+            running = len(workers)
+            while running:
+                result = await results.get()
+                if result is None:
+                    running -= 1
+                    continue
+                yield result
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+
+def write_reports(
+    jobs: Iterable[tuple[str, str]],
+    report_concurrency: int | None = None,
+    section_concurrency: int | None = None,
+) -> Iterator[ReportResult]:
+    """Write a batch of reports, yielding each result as it finishes."""
+    batch = async_write_reports(jobs, report_concurrency, section_concurrency)
+    with asyncio.Runner() as runner:
+        try:
+            while True:
+                try:
+                    yield runner.run(anext(batch))
+                except StopAsyncIteration:
+                    return
+        finally:
+            runner.run(_closing(batch.aclose()))
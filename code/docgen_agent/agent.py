@@ -5,32 +5,63 @@ The main agent that orchestrates the report generation process.
 import asyncio
 import logging
 import os
-from typing import Annotated, Any, Sequence, cast
+from typing import (
+    Annotated,
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Coroutine,
+    Iterator,
+    Sequence,
+    TypeVar,
+    cast,
+)
+from uuid import UUID
 
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.callbacks.manager import adispatch_custom_event
 from langchain_core.runnables import RunnableConfig
-from langchain_nvidia_ai_endpoints import ChatNVIDIA
+from langchain_core.runnables.config import merge_configs
+from langchain_core.utils.json import parse_partial_json
 from langgraph.graph import END, START, StateGraph
 from langgraph.graph.message import add_messages
-from pydantic import BaseModel
-
-from . import author, researcher
+from pydantic import BaseModel, ValidationError
+
+from . import (
+    author,
+    checkpoint,
+    history,
+    memo,
+    research,
+    researcher,
+    resilience,
+    routing,
+    semantic,
+    structured,
+    telemetry,
+    tools,
+)
 from .prompts import report_planner_instructions
 
 _LOGGER = logging.getLogger(__name__)
 _MAX_LLM_RETRIES = 3
 _QUERIES_PER_SECTION = 5
-_THROTTLE_LLM_CALLS = os.getenv("THROTTLE_LLM_CALLS", "0")
+# Start writing each section as soon as the streaming plan has it.
+PIPELINED_PLANNING = os.getenv("PIPELINED_PLANNING", "1") == "1"
 
-import os
+T = TypeVar("T")
 
-llm = ChatNVIDIA(
-    model="nvidia/llama-3.3-nemotron-super-49b-v1.5",
-    temperature=0,
-    base_url="https://integrate.api.nvidia.com/v1",
-    headers={"x-api-key": os.environ["NVIDIA_API_KEY"]}
-)
 
+class SectionsFailed(RuntimeError):
+    """Sections failed after their retries; the finished ones are kept."""
 
+    def __init__(self, failures: dict[str, BaseException]):
+        self.failures = failures
+        super().__init__(
+            "Sections could not be written: "
+            + "; ".join(f"{name}: {err}" for name, err in failures.items())
+        )
 
 
 class Report(BaseModel):
@@ -43,7 +74,10 @@ class AgentState(BaseModel):
     report_structure: str
     report_plan: Report | None = None
     report: str | None = None
+    # messages to start the topic research from
     messages: Annotated[Sequence[Any], add_messages] = []
+    # digest of the topic research transcript, see history
+    research: str | None = None
 
 
 async def topic_research(state: AgentState, config: RunnableConfig):
@@ -58,31 +92,371 @@ async def topic_research(state: AgentState, config: RunnableConfig):
 
     research = await researcher.graph.ainvoke(researcher_state, config)
 
-    return {"messages": research.get("messages", [])}
+    # stored once and shared by reference with the planner and every section
+    return {
+        "research": await history.put(research.get("messages", []), _run_id(config))
+    }
+
+
+class SectionPipeline:
+    """Sections the planner started while its plan was still streaming.
+
+    The orchestrator takes a started section over if the final plan has the
+    same section at that index, and cancels it otherwise, for instance when
+    a planner retry came up with a different plan.
+    """
+
+    def __init__(self):
+        # the research pool as it was when planning started; every section
+        # is matched against it, however early it was started
+        self.research: research.ResearchPool | None = None
+        self._started: dict[int, tuple[author.Section, asyncio.Task]] = {}
+
+    def start(
+        self,
+        index: int,
+        section: author.Section,
+        writer: Coroutine[Any, Any, author.Section],
+    ) -> None:
+        self._started[index] = (section, asyncio.ensure_future(writer))
+
+    def take(self, index: int, section: author.Section) -> asyncio.Task | None:
+        """The task writing section at index, if one was started for it."""
+        started = self._started.pop(index, None)
+        if started is None:
+            return None
+        if started[0] != section:
+            _discard(started[1])
+            return None
+        return started[1]
+
+    def cancel(self) -> None:
+        for _, task in self._started.values():
+            _discard(task)
+        self._started.clear()
+
+
+def _discard(task: asyncio.Task) -> None:
+    if not task.done():
+        task.cancel()
+    elif not task.cancelled():
+        # nobody awaits it, so retrieve its error for asyncio not to log it
+        task.exception()
+
+
+def get_pipeline(config: RunnableConfig | None) -> SectionPipeline | None:
+    """The section pipeline of the report being written, if there is one."""
+    if not config or not PIPELINED_PLANNING:
+        return None
+    return config.get("configurable", {}).get("section_pipeline")
+
+
+class _PlanStream(BaseCallbackHandler):
+    """Hands each section of a streaming plan on as soon as it is complete."""
+
+    run_inline = True
+
+    def __init__(self, on_section: Callable[[int, author.Section], None]):
+        self.on_section = on_section
+        self.started = 0
+        self._text: dict[UUID, str] = {}
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any) -> None:
+        # a retry streams a new response under a new run id
+        text = self._text[run_id] = self._text.get(run_id, "") + token
+        # a section is complete once the next one opens, and parsing the
+        # partial plan is only worth it then
+        if "{" not in token:
+            return
+        # reasoning models think before they answer, as in structured.parse_json
+        answer = text.rsplit("</think>", 1)[-1]
+        if "<think>" in answer or "{" not in answer:
+            return
+        plan = parse_partial_json(answer[answer.index("{") :])
+        sections = plan.get("sections") if isinstance(plan, dict) else None
+        if not isinstance(sections, list):
+            return
+        for index in range(self.started, len(sections) - 1):
+            try:
+                section = author.Section.model_validate(sections[index])
+            except ValidationError:
+                return
+            self.on_section(index, section)
+            self.started = index + 1
+
+    # streaming callback handlers have these; with them, the chat model
+    # streams its response to on_llm_new_token even when it is invoked
+    def tap_output_aiter(
+        self, run_id: UUID, output: AsyncIterator[T]
+    ) -> AsyncIterator[T]:
+        return output
+
+    def tap_output_iter(self, run_id: UUID, output: Iterator[T]) -> Iterator[T]:
+        return output
+
+
+async def _plan(
+    messages: list[Any], planner_config: RunnableConfig, config: RunnableConfig
+) -> Report:
+    """Generate the report plan, patching a malformed one instead of redoing it."""
+    for attempt in range(_MAX_LLM_RETRIES):
+        response = await routing.invoke_model(
+            "report_planner",
+            messages,
+            planner_config,
+            bind=structured.guided(Report),
+            attempts=_MAX_LLM_RETRIES,
+        )
+        # plans leave the content of their sections blank
+        plan = await structured.recover(
+            Report,
+            response,
+            messages,
+            config,
+            name="report_planner",
+            defaults={"content": ""},
+        )
+        if plan is not None and plan.sections:
+            return plan
+        _LOGGER.warning(
+            "No usable report plan, regenerating it. Attempt %d of %d.",
+            attempt + 1,
+            _MAX_LLM_RETRIES,
+        )
+        # which also keeps the response cache from serving the same answer
+        messages = [
+            *messages,
+            {
+                "role": "user",
+                "content": "That was not a valid report plan. Answer with the "
+                "report plan as a single JSON object.",
+            },
+        ]
+    raise resilience.EmptyResponseError("No usable report plan from report_planner.")
 
 
 async def report_planner(state: AgentState, config: RunnableConfig):
-    """Call the model."""
+    """Plan the report, starting each section as soon as the plan has it."""
     _LOGGER.info("Calling report planner.")
 
-    model = llm.with_structured_output(Report)  # type: ignore
-
     system_prompt = report_planner_instructions.format(
         topic=state.topic,
         report_structure=state.report_structure,
     )
-    for count in range(_MAX_LLM_RETRIES):
-        messages = [{"role": "system", "content": system_prompt}] + list(state.messages)
-        response = await model.ainvoke(messages, config)
-        if response:
-            response = cast(Report, response)
-            state.report_plan = response
-            return state
-        _LOGGER.debug(
-            "Retrying LLM call. Attempt %d of %d", count + 1, _MAX_LLM_RETRIES
-        )
+    system_prompt += structured.instructions(Report)
+    messages = [
+        {"role": "system", "content": system_prompt},
+        *history.load(await _research(state, config)),
+    ]
+
+    planner_config = config
+    pipeline = get_pipeline(config)
+    if pipeline is not None:
+        pool = research.get_pool(config)
+        pipeline.research = pool.snapshot() if pool is not None else None
+
+        def start(index: int, section: author.Section) -> None:
+            _LOGGER.info("Starting section %s while planning.", section.name)
+            pipeline.start(
+                index,
+                section,
+                _section(state, index, section, pipeline.research, config),
+            )
+
+        planner_config = merge_configs(config, {"callbacks": [_PlanStream(start)]})
+
+    try:
+        report_plan = await _plan(messages, planner_config, config)
+    except BaseException:
+        if pipeline is not None:
+            pipeline.cancel()
+        raise
+    await adispatch_custom_event(
+        "report_plan", {"plan": report_plan.model_dump()}, config=config
+    )
+    return {"report_plan": report_plan}
+
+
+def _run_id(config: RunnableConfig) -> str | None:
+    """The id of a checkpointed run, None for a run that cannot be resumed."""
+    return config.get("configurable", {}).get("thread_id")
+
 
-    raise RuntimeError("Failed to call model after %d attempts.", _MAX_LLM_RETRIES)
+async def _research(state: AgentState, config: RunnableConfig) -> str | None:
+    """The digest of the topic research, storing the seed messages without one."""
+    return state.research or await history.put(state.messages, _run_id(config))
+
+
+async def _pooled_research(
+    pool: research.ResearchPool, section: author.Section
+) -> list[dict[str, Any]]:
+    """A message carrying the pooled sources relevant to a section."""
+    sources = pool.relevant(f"{section.name} {section.description}")
+    if not sources:
+        return []
+    # ranking may load an embedding model, so it runs in a thread
+    records = await asyncio.to_thread(
+        tools.source_records,
+        {"results": sources},
+        query=f"{section.name} {section.description}",
+    )
+    return [
+        {
+            "role": "user",
+            "content": "Research already gathered for this report that may be "
+            "relevant to this section:",
+            "sources": records,
+        }
+    ]
+
+
+async def _finished_section(
+    index: int, section: author.Section, config: RunnableConfig
+) -> dict[str, Any]:
+    """Report a section as done, for streaming consumers of the graph."""
+    await adispatch_custom_event(
+        "section", {"index": index, "section": section.model_dump()}, config=config
+    )
+    return {"index": index, "section": section}
+
+
+async def _deliver(
+    index: int, writer: Awaitable[author.Section], config: RunnableConfig
+) -> dict[str, Any]:
+    """Wait for a section of the final plan, keeping it for resumed runs."""
+    section = await writer
+    run_id = _run_id(config)
+    if run_id is not None:
+        await asyncio.to_thread(
+            checkpoint.section_store.save, run_id, index, section.model_dump()
+        )
+    return await _finished_section(index, section, config)
+
+
+async def _write_section(
+    section_writer_state: author.SectionWriterState,
+    config: RunnableConfig,
+    memo_key: str,
+) -> author.Section:
+    """Write one section, remembering it for reruns once it is done."""
+    index = section_writer_state.index
+    section = section_writer_state.section
+    # tag the author run so streamed tokens can be traced back to the section
+    # and searches can be ranked against what the section is about
+    config = merge_configs(
+        config,
+        {
+            "run_name": telemetry.SECTION_RUN_NAME,
+            "metadata": {
+                "section_index": index,
+                "section_description": f"{section.name}: {section.description}",
+            },
+        },
+    )
+    # batch runs share a pool of section writers across all of their reports
+    configurable = config.get("configurable", {})
+    slots = configurable.get("section_slots")
+    if slots is None:
+        result = await author.graph.ainvoke(section_writer_state, config)
+    else:
+        async with slots.slot(configurable.get("priority", 0)):
+            result = await author.graph.ainvoke(section_writer_state, config)
+    memo.save(memo_key, result["section"])
+    if section.research:
+        await asyncio.to_thread(
+            semantic.sections.add,
+            section_writer_state.topic,
+            result["section"],
+            [*history.load(section_writer_state.research), *result["messages"]],
+            configurable.get("thread_id"),
+        )
+    return result["section"]
+
+
+async def _similar_section(
+    topic: str,
+    section: author.Section,
+    messages: Sequence[Any],
+    config: RunnableConfig,
+) -> author.Section | None:
+    """A section from a related report, reused as is or refreshed for this one."""
+    # sections this run wrote are siblings of section, not earlier versions
+    run_id = config.get("configurable", {}).get("thread_id")
+    match = await asyncio.to_thread(semantic.sections.lookup, topic, section, run_id)
+    if match is None:
+        telemetry.metrics.inc("docgen_semantic_cache_total", outcome="miss")
+        return None
+    # only a fresh section under the very same name is taken word for word,
+    # anything else goes through a model call that checks it against the
+    # section it is meant to be
+    if match.fresh and match.section.name == section.name:
+        _LOGGER.info(
+            "Reusing section %s from a related report (similarity %.2f): %s",
+            match.section.name,
+            match.similarity,
+            section.name,
+        )
+        telemetry.metrics.inc("docgen_semantic_cache_total", outcome="reuse")
+        return section.model_copy(update={"content": match.section.content})
+    _LOGGER.info(
+        "Refreshing section %s from a related report (similarity %.2f): %s",
+        match.section.name,
+        match.similarity,
+        section.name,
+    )
+    telemetry.metrics.inc("docgen_semantic_cache_total", outcome="refresh")
+    # the earlier section's own sources stand in for the research it skips
+    messages = [
+        {
+            "role": "user",
+            "content": "Research the earlier section was written from:",
+            "sources": match.sources,
+        },
+        *messages,
+    ]
+    refreshed = await author.refresh(
+        section, topic, match.section.content, messages, config
+    )
+    await asyncio.to_thread(semantic.sections.add, topic, refreshed, messages, run_id)
+    return refreshed
+
+
+async def _section(
+    state: AgentState,
+    index: int,
+    section: author.Section,
+    pool: research.ResearchPool | None,
+    config: RunnableConfig,
+) -> author.Section:
+    """Reuse a section from an earlier run or a related report, or write it."""
+    # with a research pool, each section starts from the pooled sources that
+    # match it instead of the whole topic research transcript (a resumed run
+    # starts with an empty pool and falls back to the transcript)
+    reference = (
+        await history.put(await _pooled_research(pool, section), _run_id(config))
+        if pool is not None and pool.sources
+        else await _research(state, config)
+    )
+    messages = history.load(reference)
+    memo_key = memo.section_key(state.topic, section, messages)
+    remembered = memo.load(memo_key)
+    if remembered is not None:
+        _LOGGER.info("Reusing section from an earlier run: %s", section.name)
+        return remembered
+    # researched sections of paraphrased topics are reused across reports
+    if section.research:
+        similar = await _similar_section(state.topic, section, messages, config)
+        if similar is not None:
+            memo.save(memo_key, similar)
+            return similar
+    _LOGGER.info("Creating author agent for section: %s", section.name)
+    section_writer_state = author.SectionWriterState(
+        index=index,
+        section=section,
+        topic=state.topic,
+        research=reference,
+    )
+    return await _write_section(section_writer_state, config, memo_key)
 
 
 async def section_author_orchestrator(state: AgentState, config: RunnableConfig):
@@ -92,37 +466,72 @@ async def section_author_orchestrator(state: AgentState, config: RunnableConfig)
 
     _LOGGER.info("Orchestrating the section authoring process.")
 
+    # checkpointed runs keep every finished section, so a resumed run only
+    # writes the ones that were still missing
+    run_id = _run_id(config)
+    finished = (
+        await asyncio.to_thread(checkpoint.section_store.load, run_id) if run_id else {}
+    )
+
+    pool = research.get_pool(config)
+    # sections the planner started are matched against the pool as it was
+    # then, so the rest are too
+    pipeline = get_pipeline(config)
+    seed = pipeline.research if pipeline is not None else None
+    seed = seed if seed is not None else pool
+
+    # sections are also remembered across runs, so a rerun of the topic
+    # rewrites only the sections whose outline or research changed
+    _LOGGER.info(
+        "Plan against the last one for this topic: %s.",
+        memo.diff_plan(state.topic, state.report_plan.sections),
+    )
+
     writers = []
     for idx, section in enumerate(state.report_plan.sections):
-        _LOGGER.info("Creating author agent for section: %s", section.name)
-
-        section_writer_state = author.SectionWriterState(
-            index=idx,
-            section=section,
-            topic=state.topic,
-            messages=state.messages,
+        if idx in finished:
+            _LOGGER.info("Reusing finished section: %s", section.name)
+            writers.append(
+                _finished_section(
+                    idx, author.Section.model_validate(finished[idx]), config
+                )
+            )
+            continue
+        started = pipeline.take(idx, section) if pipeline is not None else None
+        writer = started or _section(state, idx, section, seed, config)
+        writers.append(_deliver(idx, writer, config))
+    if pipeline is not None:
+        # started for a section the final plan does not have
+        pipeline.cancel()
+
+    # Sections are written concurrently; the shared LLM scheduler keeps the
+    # model calls within the rate limits. A section that fails after its
+    # retries does not take the finished sections down with it: they are in
+    # the section store, and a resumed run writes only the failed ones.
+    all_sections = await asyncio.gather(*writers, return_exceptions=True)
+
+    sections = []
+    failures: dict[str, BaseException] = {}
+    for planned, section in zip(state.report_plan.sections, all_sections):
+        if isinstance(section, BaseException):
+            _LOGGER.error("Failed to write section %s: %s", planned.name, section)
+            failures[planned.name] = section
+            continue
+        content = cast(dict[str, Any], section)["section"].content
+        _LOGGER.info("Finished section: %s", planned.name)
+        sections.append(planned.model_copy(update={"content": content}))
+
+    _LOGGER.info("Call statistics: %s", resilience.report())
+    if pool is not None:
+        _LOGGER.info(
+            "Research pool: %d searches, %d reused, %d sources.",
+            pool.stats.searches,
+            pool.stats.reused,
+            len(pool.sources),
         )
-        writers.append(author.graph.ainvoke(section_writer_state, config))
-
-    all_sections = []
-    if _THROTTLE_LLM_CALLS == "1":
-        # Throttle LLM calls by writing one section at a time
-        _LOGGER.info("Throttling LLM calls.")
-        for writer in writers:
-            all_sections.append(await writer)
-            await asyncio.sleep(30)
-    else:
-        # Without throttling, write all sections at once
-        all_sections = await asyncio.gather(*writers)
-    all_sections = cast(list[dict[str, Any]], all_sections)
-
-    for section in all_sections:
-        index = section["index"]
-        content = section["section"].content
-        state.report_plan.sections[index].content = content
-        _LOGGER.info("Finished section: %s", state.report_plan.sections[index].name)
-
-    return state
+    if failures:
+        raise SectionsFailed(failures)
+    return {"report_plan": state.report_plan.model_copy(update={"sections": sections})}
 
 
 async def report_author(state: AgentState, config: RunnableConfig):
@@ -132,13 +541,10 @@ async def report_author(state: AgentState, config: RunnableConfig):
 
     _LOGGER.info("Authoring the report.")
 
-    output = f"# {state.report_plan.title}\n\n"
-    for section in state.report_plan.sections:
-        output += section.content
-        output += "\n\n"
-
-    state.report = output
-    return state
+    output = f"# {state.report_plan.title}\n\n" + "".join(
+        f"{section.content}\n\n" for section in state.report_plan.sections
+    )
+    return {"report": output}
 
 
 workflow = StateGraph(AgentState)
@@ -1,6 +1,6 @@
 # code/docgen_agent/ask.py
 
-import json
+import asyncio
 import logging
 import os
 from typing import Annotated, Any, Sequence
@@ -9,21 +9,16 @@ from pydantic import BaseModel, Field
 from langchain_core.runnables import RunnableConfig
 from langgraph.graph import START, END, StateGraph
 from langgraph.graph.message import add_messages
-from langchain_nvidia_ai_endpoints import ChatNVIDIA
 
-from . import tools
+from . import cache, ranking, routing, scheduler, tools
 from .prompts import askvision_prompt
 
 _LOGGER = logging.getLogger(__name__)
 _MAX_LLM_RETRIES = 3
 
-# Initialize LLM (always)
-llm = ChatNVIDIA(
-    model="nvidia/llama-3.3-nemotron-super-49b-v1.5",
-    temperature=0,
-    base_url="https://integrate.api.nvidia.com/v1",
-    headers={"x-api-key": os.environ["NVIDIA_API_KEY"]}
-)
+# Documents longer than this many tokens are cut down to the chunks most
+# relevant to the question.
+DOCUMENT_TOKEN_BUDGET = int(os.getenv("ASK_DOCUMENT_TOKENS", "3000"))
 
 
 # ---------------------------
@@ -37,22 +32,59 @@ class ResearcherState(BaseModel):
 
 
 # ---------------------------
-# TOOL NODE
+# DOCUMENT INDEX
 # ---------------------------
-async def tool_node(state: ResearcherState):
-    _LOGGER.info("Executing tool calls.")
-    outputs = []
-    for tool_call in state.messages[-1].tool_calls:
-        _LOGGER.info("Executing tool call: %s", tool_call["name"])
-        tool = getattr(tools, tool_call["name"])
-        tool_result = await tool.ainvoke(tool_call["args"])
-        outputs.append({
-            "role": "tool",
-            "content": json.dumps(tool_result),
-            "name": tool_call["name"],
-            "tool_call_id": tool_call["id"],
-        })
-    return {"messages": outputs}
+class DocumentIndex:
+    """A document split into chunks once, to pick excerpts for each question."""
+
+    def __init__(self, document: str):
+        self.chunks = ranking.chunk_text(document)
+        self.bm25 = ranking.BM25Index(self.chunks)
+        self._vectors: Any = None
+
+    def scores(self, question: str) -> list[float]:
+        if ranking.RANKING_MODE == "embedding":
+            if self._vectors is None:
+                self._vectors = ranking.embed(self.chunks)
+            query = ranking.embed([question]) if self._vectors is not None else None
+            if query is not None:
+                return (self._vectors @ query[0]).tolist()
+        return self.bm25.scores(question)
+
+    def excerpt(self, question: str, max_tokens: int) -> str:
+        """The chunks most relevant to question within max_tokens, in page order."""
+        scores = self.scores(question)
+        ranked = sorted(range(len(self.chunks)), key=lambda i: scores[i], reverse=True)
+        chosen = []
+        used = 0
+        for index in ranked:
+            tokens = scheduler.estimate_tokens(self.chunks[index])
+            if used + tokens > max_tokens:
+                continue
+            chosen.append(index)
+            used += tokens
+        return "\n\n[...]\n\n".join(self.chunks[index] for index in sorted(chosen))
+
+
+# follow-up questions about the same page reuse its index
+document_indexes = cache.MemoryCache(max_entries=32)
+
+
+def document_index(document: str) -> DocumentIndex:
+    """The index of document, built on first use."""
+    key = cache.make_key("document", document)
+    index = document_indexes.get(key)
+    if index is None:
+        index = DocumentIndex(document)
+        document_indexes.set(key, index)
+    return index
+
+
+def relevant_document(document: str, question: str) -> str:
+    """The document, or its excerpts most relevant to question if it is too long."""
+    if scheduler.estimate_tokens(document) <= DOCUMENT_TOKEN_BUDGET:
+        return document
+    return document_index(document).excerpt(question, DOCUMENT_TOKEN_BUDGET)
 
 
 # ---------------------------
@@ -60,22 +92,24 @@ async def tool_node(state: ResearcherState):
 # ---------------------------
 async def call_model(state: ResearcherState, config: RunnableConfig) -> dict[str, Any]:
     _LOGGER.info("Calling model.")
-    system_prompt = askvision_prompt.format(
-        document=state.document,
-        question=state.topic
+    # ranking may load an embedding model, so it runs in a thread
+    document = await asyncio.to_thread(relevant_document, state.document, state.topic)
+    system_prompt = askvision_prompt.format(document=document, question=state.topic)
+
+    messages = [{"role": "system", "content": system_prompt}] + list(state.messages)
+    response = await routing.invoke_model(
+        "ask",
+        messages,
+        config,
+        # Only bind tools if you allow queries
+        bind=(
+            (lambda llm: llm.bind_tools([tools.search_tavily]))
+            if state.number_of_queries > 0
+            else None
+        ),
+        attempts=_MAX_LLM_RETRIES,
     )
-
-    # Only bind tools if you allow queries
-    model = llm.bind_tools([tools.search_tavily]) if state.number_of_queries > 0 else llm
-
-    for count in range(_MAX_LLM_RETRIES):
-        messages = [{"role": "system", "content": system_prompt}] + list(state.messages)
-        response = await model.ainvoke(messages, config)
-        if response:
-            return {"messages": [response]}
-        _LOGGER.debug("Retrying LLM call. Attempt %d of %d", count + 1, _MAX_LLM_RETRIES)
-
-    raise RuntimeError("Failed to call model after retries")
+    return {"messages": [response]}
 
 
 # ---------------------------
@@ -83,7 +117,9 @@ async def call_model(state: ResearcherState, config: RunnableConfig) -> dict[str
 # ---------------------------
 def has_tool_calls(state: ResearcherState) -> bool:
     messages = state.messages
-    return bool(messages and hasattr(messages[-1], "tool_calls") and messages[-1].tool_calls)
+    return bool(
+        messages and hasattr(messages[-1], "tool_calls") and messages[-1].tool_calls
+    )
 
 
 # ---------------------------
@@ -91,7 +127,7 @@ def has_tool_calls(state: ResearcherState) -> bool:
 # ---------------------------
 workflow = StateGraph(ResearcherState)
 workflow.add_node("agent", call_model)
-workflow.add_node("tools", tool_node)
+workflow.add_node("tools", tools.tool_node)
 workflow.add_edge(START, "agent")
 workflow.add_conditional_edges("agent", has_tool_calls, {True: "tools", False: END})
 workflow.add_edge("tools", "agent")
@@ -1,33 +1,23 @@
 """Authoring workflow for writing sections of a report."""
 
-import json
 import logging
 from typing import Annotated, Any, Sequence
 
 from langchain_core.runnables import RunnableConfig
-from langchain_nvidia_ai_endpoints import ChatNVIDIA
 from langgraph.graph import END, START, StateGraph
 from langgraph.graph.message import add_messages
 from pydantic import BaseModel
 
-from . import tools
-from .prompts import section_research_prompt, section_writing_prompt
+from . import budget, history, routing, tools
+from .prompts import (
+    section_refresh_prompt,
+    section_research_prompt,
+    section_writing_prompt,
+)
 
 _LOGGER = logging.getLogger(__name__)
 _MAX_LLM_RETRIES = 3
 
-import os
-
-llm = ChatNVIDIA(
-    model="nvidia/llama-3.3-nemotron-super-49b-v1.5",
-    temperature=0,
-    base_url="https://integrate.api.nvidia.com/v1",
-    headers={"x-api-key": os.environ["NVIDIA_API_KEY"]}
-)
-
-
-llm_with_tools = llm.bind_tools([tools.search_tavily])
-
 
 class Section(BaseModel):
     name: str
@@ -40,26 +30,11 @@ class SectionWriterState(BaseModel):
     index: int = -1
     section: Section
     topic: str  # Overall report topic for context
+    # digest of the research the section is written from, see history
+    research: str | None = None
+    # the section's own research rounds
     messages: Annotated[Sequence[Any], add_messages] = []
-
-
-async def tool_node(state: SectionWriterState):
-    """Execute tool calls for research."""
-    _LOGGER.info("Executing tool calls for section: %s", state.section.name)
-    outputs = []
-    for tool_call in state.messages[-1].tool_calls:
-        _LOGGER.info("Executing tool call: %s", tool_call["name"])
-        tool = getattr(tools, tool_call["name"])
-        tool_result = await tool.ainvoke(tool_call["args"])
-        outputs.append(
-            {
-                "role": "tool",
-                "content": json.dumps(tool_result),
-                "name": tool_call["name"],
-                "tool_call_id": tool_call["id"],
-            }
-        )
-    return {"messages": outputs}
+    loop: budget.LoopProgress = budget.LoopProgress()
 
 
 async def research_model(
@@ -74,18 +49,20 @@ async def research_model(
         overall_topic=state.topic,
     )
 
-    for count in range(_MAX_LLM_RETRIES):
-        messages = [{"role": "system", "content": system_prompt}] + list(state.messages)
-        response = await llm_with_tools.ainvoke(messages, config)
-
-        if response:
-            return {"messages": [response]}
-
-        _LOGGER.debug(
-            "Retrying LLM call. Attempt %d of %d", count + 1, _MAX_LLM_RETRIES
-        )
-
-    raise RuntimeError("Failed to call model after %d attempts.", _MAX_LLM_RETRIES)
+    messages = [
+        {"role": "system", "content": system_prompt},
+        *history.load(state.research),
+        *state.messages,
+    ]
+    response = await routing.invoke_model(
+        "research_model",
+        messages,
+        config,
+        bind=lambda llm: llm.bind_tools([tools.search_tavily]),
+        research=state.section.research,
+        attempts=_MAX_LLM_RETRIES,
+    )
+    return {"messages": [response], "loop": budget.start(state.loop)}
 
 
 async def writing_model(
@@ -100,21 +77,54 @@ async def writing_model(
         overall_topic=state.topic,
     )
 
-    for count in range(_MAX_LLM_RETRIES):
-        messages = [{"role": "system", "content": system_prompt}] + list(state.messages)
-        response = await llm.ainvoke(messages, config)
-
-        if response:
-            # Update the section content with the written content
-            updated_section = state.section.model_copy()
-            updated_section.content = str(response.content) if response.content else ""
-            return {"section": updated_section, "messages": [response]}
-
-        _LOGGER.debug(
-            "Retrying LLM call. Attempt %d of %d", count + 1, _MAX_LLM_RETRIES
-        )
+    messages = [
+        {"role": "system", "content": system_prompt},
+        *history.load(state.research),
+        *state.messages,
+    ]
+    response = await routing.invoke_model(
+        "writing_model",
+        messages,
+        config,
+        research=state.section.research,
+        attempts=_MAX_LLM_RETRIES,
+    )
 
-    raise RuntimeError("Failed to call model after %d attempts.", _MAX_LLM_RETRIES)
+    # Update the section content with the written content
+    updated_section = state.section.model_copy()
+    updated_section.content = str(response.content) if response.content else ""
+    return {"section": updated_section, "messages": [response]}
+
+
+async def refresh(
+    section: Section,
+    topic: str,
+    previous: str,
+    messages: Sequence[Any],
+    config: RunnableConfig | None = None,
+) -> Section:
+    """Rewrite a section reused from a related report for this one, without research.
+
+    messages hold the sources the earlier section was written from, and any
+    research gathered for this report.
+    """
+    _LOGGER.info("Refreshing section: %s", section.name)
+    system_prompt = section_refresh_prompt.format(
+        section_name=section.name,
+        section_description=section.description,
+        overall_topic=topic,
+        previous=previous,
+    )
+    response = await routing.invoke_model(
+        "section_refresh",
+        [{"role": "system", "content": system_prompt}, *messages],
+        config,
+        research=section.research,
+        attempts=_MAX_LLM_RETRIES,
+    )
+    return section.model_copy(
+        update={"content": str(response.content) if response.content else previous}
+    )
 
 
 def needs_research(state: SectionWriterState) -> str:
@@ -134,7 +144,7 @@ def has_tool_calls(state: SectionWriterState) -> bool:
 workflow = StateGraph(SectionWriterState)
 
 workflow.add_node("agent", research_model)
-workflow.add_node("tools", tool_node)
+workflow.add_node("tools", budget.tool_node("author"))
 workflow.add_node("writer", writing_model)
 
 workflow.add_conditional_edges(
@@ -153,7 +163,17 @@ workflow.add_conditional_edges(
         False: "writer",
     },
 )
-workflow.add_edge("tools", "agent")
+# research ends early once its budget is spent or new rounds stop finding much
+workflow.add_conditional_edges(
+    "tools",
+    budget.should_stop,
+    {
+        True: "writer",
+        False: "agent",
+    },
+)
 workflow.add_edge("writer", END)
 
-graph = workflow.compile()
+# Runs inside the report graph's nodes, several at a time; progress is saved
+# by the report graph, so this graph never uses a checkpointer.
+graph = workflow.compile(checkpointer=False)
@@ -0,0 +1,185 @@
+"""Round, tool call, token and time budgets for the model and tool loops."""
+
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable
+
+from langchain_core.runnables import RunnableConfig
+from pydantic import BaseModel
+
+from . import history, scheduler, sources, tools
+
+_LOGGER = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class LoopBudget:
+    """Limits on one agent and tools loop.
+
+    Research also stops once a round converges, finding fewer than
+    min_new_sources sources or fewer than min_new_tokens tokens of content
+    that earlier rounds had not already found.
+    """
+
+    max_rounds: int
+    max_tool_calls: int
+    max_prompt_tokens: int
+    deadline_seconds: float
+    min_new_sources: int = 1
+    min_new_tokens: int = 200
+
+
+def _from_env(name: str, budget: LoopBudget) -> LoopBudget:
+    prefix = name.upper()
+    return LoopBudget(
+        max_rounds=int(os.getenv(f"{prefix}_MAX_ROUNDS", budget.max_rounds)),
+        max_tool_calls=int(
+            os.getenv(f"{prefix}_MAX_TOOL_CALLS", budget.max_tool_calls)
+        ),
+        max_prompt_tokens=int(
+            os.getenv(f"{prefix}_MAX_PROMPT_TOKENS", budget.max_prompt_tokens)
+        ),
+        deadline_seconds=float(
+            os.getenv(f"{prefix}_DEADLINE_SECONDS", budget.deadline_seconds)
+        ),
+        min_new_sources=int(
+            os.getenv(f"{prefix}_MIN_NEW_SOURCES", budget.min_new_sources)
+        ),
+        min_new_tokens=int(
+            os.getenv(f"{prefix}_MIN_NEW_TOKENS", budget.min_new_tokens)
+        ),
+    )
+
+
+# Defaults per graph, each overridable with <GRAPH>_MAX_ROUNDS and friends, or
+# per run with a {"loop_budgets": {graph: LoopBudget}} configurable.
+LOOP_BUDGETS = {
+    "researcher": _from_env(
+        "researcher",
+        LoopBudget(
+            max_rounds=3,
+            max_tool_calls=10,
+            max_prompt_tokens=24_000,
+            deadline_seconds=180,
+        ),
+    ),
+    "author": _from_env(
+        "author",
+        LoopBudget(
+            max_rounds=3,
+            max_tool_calls=8,
+            max_prompt_tokens=24_000,
+            deadline_seconds=240,
+        ),
+    ),
+}
+
+
+class LoopProgress(BaseModel):
+    """How much of its budget a loop has used so far."""
+
+    started_at: float | None = None
+    rounds: int = 0
+    tool_calls: int = 0
+    seen_urls: list[str] = []
+    stop_reason: str | None = None
+
+
+def get_budget(graph: str, config: RunnableConfig | None) -> LoopBudget:
+    """The budget of graph for this run."""
+    overrides = (config or {}).get("configurable", {}).get("loop_budgets") or {}
+    return overrides.get(graph) or LOOP_BUDGETS[graph]
+
+
+def start(progress: LoopProgress) -> LoopProgress:
+    """Start the loop's clock, if it is not already running."""
+    if progress.started_at is not None:
+        return progress
+    return progress.model_copy(update={"started_at": time.monotonic()})
+
+
+def _sources(messages: list[Any]) -> dict[str, sources.SourceRecord]:
+    found: dict[str, sources.SourceRecord] = {}
+    for message in messages:
+        for source in sources.of(message):
+            found.setdefault(source["url"], source)
+    return found
+
+
+def _stop_reason(
+    budget: LoopBudget, progress: LoopProgress, messages: list[Any], new: dict
+) -> str | None:
+    if progress.rounds >= budget.max_rounds:
+        return f"reached {budget.max_rounds} rounds"
+    if progress.tool_calls >= budget.max_tool_calls:
+        return f"reached {budget.max_tool_calls} tool calls"
+    started = progress.started_at
+    if started is not None and time.monotonic() - started >= budget.deadline_seconds:
+        return f"passed its {budget.deadline_seconds:g}s deadline"
+    if scheduler.estimate_tokens(messages) >= budget.max_prompt_tokens:
+        return f"reached {budget.max_prompt_tokens} prompt tokens"
+    new_tokens = sum(source["tokens"] for source in new.values())
+    if len(new) < budget.min_new_sources or new_tokens < budget.min_new_tokens:
+        return f"converged ({len(new)} new sources, ~{new_tokens} new tokens)"
+    return None
+
+
+def tool_node(
+    graph: str,
+) -> Callable[[Any, RunnableConfig], Awaitable[dict[str, Any]]]:
+    """A tools node for graph that keeps within its loop budget.
+
+    Calls beyond the remaining tool call budget are answered with a note
+    instead of being run, so every call still gets a result. After the round,
+    the progress records whether the loop should stop; see should_stop.
+    """
+
+    async def node(state: Any, config: RunnableConfig) -> dict[str, Any]:
+        budget = get_budget(graph, config)
+        progress = start(state.loop)
+        tool_calls = state.messages[-1].tool_calls
+        allowed = max(budget.max_tool_calls - progress.tool_calls, 0)
+        _LOGGER.info("Executing %d tool calls.", len(tool_calls))
+        outputs = await tools.execute_tool_calls(tool_calls[:allowed], config)
+        outputs += [
+            {
+                "role": "tool",
+                "content": "Skipped: the search budget for this task is used up.",
+                "name": tool_call["name"],
+                "tool_call_id": tool_call["id"],
+            }
+            for tool_call in tool_calls[allowed:]
+        ]
+
+        # the research the task was handed, see history
+        handed = history.load(getattr(state, "research", None))
+        if progress.rounds == 0:
+            # sources handed in with the task count as already found
+            seen = set(_sources([*handed, *state.messages]))
+        else:
+            seen = set(progress.seen_urls)
+        found = _sources(outputs)
+        new = {url: source for url, source in found.items() if url not in seen}
+        progress = progress.model_copy(
+            update={
+                "rounds": progress.rounds + 1,
+                "tool_calls": progress.tool_calls + len(tool_calls),
+                "seen_urls": [*seen, *new],
+            }
+        )
+        reason = _stop_reason(
+            budget, progress, [*handed, *state.messages, *outputs], new
+        )
+        if reason is not None:
+            _LOGGER.info("Stopping %s research: %s.", graph, reason)
+            progress = progress.model_copy(update={"stop_reason": reason})
+        return {"messages": outputs, "loop": progress}
+
+    return node
+
+
+def should_stop(state: Any) -> bool:
+    """Whether the last tools round ended the loop."""
+    return state.loop.stop_reason is not None
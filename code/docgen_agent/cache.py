@@ -0,0 +1,404 @@
+"""Caching layers shared by the report generation workflow."""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Protocol, Sequence
+
+from langchain_core.caches import RETURN_VAL_TYPE, BaseCache
+from langchain_core.load import dumps, loads
+
+_LOGGER = logging.getLogger(__name__)
+
+CACHE_DIR = Path(
+    os.getenv(
+        "DOCGEN_CACHE_DIR",
+        Path(__file__).resolve().parents[2] / "data" / "scratch",
+    )
+)
+
+
+# A hit only records its access time when the stored one is older than this,
+# so reads do not turn into a disk write each.
+ACCESS_RESOLUTION = float(os.getenv("CACHE_ACCESS_RESOLUTION", "60"))
+# Writes between sweeps of the expired entries, which also recount the size
+# of what other processes wrote to the same file.
+SWEEP_INTERVAL = int(os.getenv("CACHE_SWEEP_INTERVAL", "100"))
+
+
+def make_key(*parts: Any) -> str:
+    """Build a stable, content-addressed cache key from JSON-able parts."""
+    payload = json.dumps(parts, sort_keys=True, default=str, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class CacheStats:
+    """Counters describing how a cache has been used."""
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def as_dict(self) -> dict[str, Any]:
+        return {**asdict(self), "hit_rate": self.hit_rate}
+
+
+class CacheBackend(Protocol):
+    """The interface every cache layer implements."""
+
+    stats: CacheStats
+
+    def get(self, key: str) -> Any | None: ...
+
+    def set(self, key: str, value: Any, ttl: float | None = None) -> None: ...
+
+    def clear(self) -> None: ...
+
+
+class MemoryCache:
+    """An in-process LRU cache with per-entry expiry."""
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self.stats = CacheStats()
+        self._entries: OrderedDict[str, tuple[float | None, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Any | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self._entries[key]
+                self.stats.expirations += 1
+                self.stats.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats.hits += 1
+            return value
+
+    def set(self, key: str, value: Any, ttl: float | None = None) -> None:
+        expires_at = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class DiskCache:
+    """A size-bounded SQLite cache of JSON values that survives restarts."""
+
+    def __init__(self, path: str | Path, max_bytes: int = 256 * 1024 * 1024):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # with WAL, commits skip the fsync; a crash can lose the last
+        # entries but not corrupt the cache
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " expires_at REAL,"
+            " accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed_at)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires_at)"
+        )
+        self._conn.commit()
+        # kept up to date on every write instead of summed over the table
+        self._total = self._size()
+        self._writes = 0
+
+    def _size(self) -> int:
+        (total,) = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM cache"
+        ).fetchone()
+        return total
+
+    def get(self, key: str) -> Any | None:
+        entry = self.get_entry(key)
+        return entry[0] if entry is not None else None
+
+    def get_entry(self, key: str) -> tuple[Any, float | None] | None:
+        """Return the value and its expiry time, or None on a miss."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at, accessed_at FROM cache WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                self.stats.misses += 1
+                return None
+            value, expires_at, accessed_at = row
+            if expires_at is not None and expires_at <= now:
+                self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self._conn.commit()
+                self.stats.expirations += 1
+                self.stats.misses += 1
+                return None
+            # eviction only needs a rough recency order
+            if now - accessed_at >= ACCESS_RESOLUTION:
+                self._conn.execute(
+                    "UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key)
+                )
+                self._conn.commit()
+            self.stats.hits += 1
+        return json.loads(value), expires_at
+
+    def set(self, key: str, value: Any, ttl: float | None = None) -> None:
+        now = time.time()
+        data = json.dumps(value, default=str)
+        expires_at = now + ttl if ttl is not None else None
+        with self._lock:
+            replaced = self._conn.execute(
+                "SELECT size FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)",
+                (key, data, len(data), expires_at, now),
+            )
+            self._total += len(data) - (replaced[0] if replaced else 0)
+            self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now: float) -> None:
+        """Keep the cache within its bound, sweeping expired entries now and then."""
+        self._writes += 1
+        if self._writes % SWEEP_INTERVAL == 0:
+            expired = self._conn.execute(
+                "DELETE FROM cache WHERE expires_at <= ?", (now,)
+            ).rowcount
+            self.stats.expirations += max(expired, 0)
+            self._total = self._size()
+        while self._total > self.max_bytes:
+            rows = self._conn.execute(
+                "SELECT key, size FROM cache ORDER BY accessed_at LIMIT 64"
+            ).fetchall()
+            if not rows:
+                self._total = 0
+                return
+            for key, size in rows:
+                if self._total <= self.max_bytes:
+                    return
+                self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self._total -= size
+                self.stats.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM cache")
+            self._conn.commit()
+            self._total = 0
+
+
+class TieredCache:
+    """An in-process LRU in front of an on-disk store."""
+
+    def __init__(self, memory: MemoryCache, disk: DiskCache | None = None):
+        self.memory = memory
+        self.disk = disk
+        self.stats = CacheStats()
+
+    def get(self, key: str) -> Any | None:
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            entry = self.disk.get_entry(key)
+            if entry is not None:
+                value, expires_at = entry
+                ttl = expires_at - time.time() if expires_at is not None else None
+                self.memory.set(key, value, ttl)
+        if value is None:
+            self.stats.misses += 1
+        else:
+            self.stats.hits += 1
+        return value
+
+    def set(self, key: str, value: Any, ttl: float | None = None) -> None:
+        self.memory.set(key, value, ttl)
+        if self.disk is not None:
+            self.disk.set(key, value, ttl)
+
+    def clear(self) -> None:
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+
+def tiered_cache(name: str, max_entries: int, max_bytes: int) -> TieredCache:
+    """Create a memory + disk cache, falling back to memory only on disk errors."""
+    memory = MemoryCache(max_entries=max_entries)
+    try:
+        disk = DiskCache(CACHE_DIR / f"{name}.sqlite", max_bytes=max_bytes)
+    except (OSError, sqlite3.Error) as err:
+        _LOGGER.warning("Disk cache %s unavailable, using memory only: %s", name, err)
+        disk = None
+    return TieredCache(memory, disk)
+
+
+# Message fields that change between otherwise identical runs.
+_VOLATILE_MESSAGE_FIELDS = ("id", "response_metadata", "usage_metadata")
+# Model settings that do not affect the response.
+_VOLATILE_MODEL_FIELDS = ("headers", "api_key", "base_url")
+
+
+def _normalize_prompt(prompt: str) -> Any:
+    """Strip per-run ids and metadata from a serialized message list."""
+    try:
+        messages = json.loads(prompt)
+    except ValueError:
+        return prompt
+    if not isinstance(messages, list):
+        return messages
+    for message in messages:
+        kwargs = message.get("kwargs", {}) if isinstance(message, dict) else {}
+        for field in _VOLATILE_MESSAGE_FIELDS:
+            kwargs.pop(field, None)
+    return messages
+
+
+def _normalize_llm_string(llm_string: str) -> Any:
+    """Keep the model name, sampling settings and bound tools/schemas."""
+    model, sep, params = llm_string.partition("---")
+    try:
+        serialized = json.loads(model)
+    except ValueError:
+        return llm_string
+    kwargs = serialized.get("kwargs", {}) if isinstance(serialized, dict) else {}
+    for field in _VOLATILE_MODEL_FIELDS:
+        kwargs.pop(field, None)
+    return [serialized, params]
+
+
+def _is_empty(generations: Sequence[Any]) -> bool:
+    """Check whether a response is one the callers would retry."""
+    for generation in generations:
+        message = getattr(generation, "message", None)
+        if getattr(generation, "text", "") or getattr(message, "tool_calls", None):
+            return False
+        if message is not None and message.content:
+            return False
+    return True
+
+
+class ResponseCache(BaseCache):
+    """A content-addressed cache of chat model responses.
+
+    Responses are keyed on the model name and settings given at construction,
+    the messages with their per-run ids removed, and whatever the runnable binds
+    at call time, which covers tool schemas and structured output schemas.
+    Empty responses are never stored so that the retry loops in the graph nodes
+    still retry.
+    """
+
+    # Set LLM_CACHE=0, or flip this at runtime, to skip the cache entirely.
+    bypass = os.getenv("LLM_CACHE", "1") != "1"
+
+    def __init__(
+        self,
+        backend: CacheBackend,
+        model: dict[str, Any] | None = None,
+        ttl: float | None = None,
+    ):
+        self.backend = backend
+        self.model = model or {}
+        self.ttl = ttl
+
+    @property
+    def stats(self) -> CacheStats:
+        return self.backend.stats
+
+    def key(self, prompt: str, llm_string: str) -> str:
+        return make_key(
+            "llm",
+            self.model,
+            _normalize_prompt(prompt),
+            _normalize_llm_string(llm_string),
+        )
+
+    def lookup(self, prompt: str, llm_string: str) -> RETURN_VAL_TYPE | None:
+        if self.bypass:
+            return None
+        value = self.backend.get(self.key(prompt, llm_string))
+        if value is None:
+            return None
+        generations = loads(value, allowed_objects="core")
+        # let tracing tell a replayed response from a model call; response
+        # metadata is left out of the cache keys, so this does not change them
+        for generation in generations:
+            message = getattr(generation, "message", None)
+            if message is not None:
+                message.response_metadata["cache_hit"] = True
+        return generations
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        if self.bypass or _is_empty(return_val):
+            return
+        self.backend.set(self.key(prompt, llm_string), dumps(return_val), self.ttl)
+
+    # the backend may read and write SQLite, which is kept off the event loop
+    async def alookup(self, prompt: str, llm_string: str) -> RETURN_VAL_TYPE | None:
+        if self.bypass:
+            return None
+        return await asyncio.to_thread(self.lookup, prompt, llm_string)
+
+    async def aupdate(
+        self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE
+    ) -> None:
+        if self.bypass or _is_empty(return_val):
+            return
+        await asyncio.to_thread(self.update, prompt, llm_string, return_val)
+
+    def clear(self, **kwargs: Any) -> None:
+        self.backend.clear()
+
+
+def _response_backend() -> CacheBackend:
+    """Pick the response cache backend from the LLM_CACHE_BACKEND variable."""
+    if os.getenv("LLM_CACHE_BACKEND", "disk") == "memory":
+        return MemoryCache(max_entries=512)
+    return tiered_cache("llm_responses", max_entries=512, max_bytes=512 * 1024 * 1024)
+
+
+response_store = _response_backend()
+
+
+def response_cache(model: str, **settings: Any) -> ResponseCache:
+    """Create a response cache for one model configuration on the shared store."""
+    return ResponseCache(response_store, model={"model": model, **settings})
@@ -0,0 +1,76 @@
+"""Durable storage for resumable report runs."""
+
+import json
+import sqlite3
+import threading
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Any, AsyncIterator
+
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+from . import cache, history
+
+CHECKPOINT_PATH = cache.CACHE_DIR / "checkpoints.sqlite"
+# Kept apart from the checkpointer's database: sections are saved from a
+# thread, which would otherwise wait on the write lock the async checkpointer
+# holds until the event loop lets it commit.
+SECTIONS_PATH = cache.CACHE_DIR / "sections.sqlite"
+
+
+class SectionStore:
+    """Finished sections of each report run, saved as soon as they complete.
+
+    The graph checkpointer only saves state between nodes, so sections written
+    inside section_author_orchestrator are kept here until the node finishes.
+    """
+
+    def __init__(self, path: str | Path):
+        self._lock = threading.Lock()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sections ("
+            " run_id TEXT NOT NULL,"
+            " idx INTEGER NOT NULL,"
+            " section TEXT NOT NULL,"
+            " PRIMARY KEY (run_id, idx))"
+        )
+        self._conn.commit()
+
+    def save(self, run_id: str, index: int, section: dict[str, Any]) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sections VALUES (?, ?, ?)",
+                (run_id, index, json.dumps(section)),
+            )
+            self._conn.commit()
+
+    def load(self, run_id: str) -> dict[int, dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT idx, section FROM sections WHERE run_id = ?", (run_id,)
+            ).fetchall()
+        return {idx: json.loads(section) for idx, section in rows}
+
+    def clear(self, run_id: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM sections WHERE run_id = ?", (run_id,))
+            self._conn.commit()
+
+
+section_store = SectionStore(SECTIONS_PATH)
+
+
+def clear(run_id: str) -> None:
+    """Forget what a run kept to be resumed, once it has finished."""
+    section_store.clear(run_id)
+    history.release(run_id)
+
+
+@asynccontextmanager
+async def checkpointer() -> AsyncIterator[AsyncSqliteSaver]:
+    """Open the SQLite checkpointer shared by all report runs."""
+    async with AsyncSqliteSaver.from_conn_string(str(CHECKPOINT_PATH)) as saver:
+        yield saver
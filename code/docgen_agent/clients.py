@@ -0,0 +1,163 @@
+"""Model and search clients, created on first use and shared by every graph."""
+
+import asyncio
+import inspect
+import logging
+import os
+import threading
+import weakref
+from typing import Any
+
+import aiohttp
+import httpx
+from langchain_nvidia_ai_endpoints import ChatNVIDIA
+from tavily import AsyncTavilyClient
+
+from . import cache, sources
+
+_LOGGER = logging.getLogger(__name__)
+
+MODEL = os.getenv("NVIDIA_MODEL", "nvidia/llama-3.3-nemotron-super-49b-v1.5")
+NVIDIA_BASE_URL = os.getenv("NVIDIA_BASE_URL", "https://integrate.api.nvidia.com/v1")
+TAVILY_BASE_URL = os.getenv("TAVILY_BASE_URL", "https://api.tavily.com")
+
+# Connection pool limits, shared by all model calls and by all searches.
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "32"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "16"))
+HTTP_KEEPALIVE_SECONDS = float(os.getenv("HTTP_KEEPALIVE_SECONDS", "30"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "300"))
+
+_lock = threading.Lock()
+_models: dict[tuple, ChatNVIDIA] = {}
+# HTTP sessions are bound to the event loop they were opened on
+_sessions: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+_tavily: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+class _PooledSession:
+    """The loop's shared aiohttp session, as handed to ChatNVIDIA.
+
+    ChatNVIDIA opens a session for every request and closes it afterwards, so
+    closing is ignored here to keep the connections alive between calls.
+    """
+
+    def __init__(self, session: aiohttp.ClientSession):
+        self._session = session
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._session, name)
+
+    async def close(self) -> None:
+        pass
+
+
+def _nvidia_session() -> aiohttp.ClientSession:
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=HTTP_MAX_CONNECTIONS,
+                keepalive_timeout=HTTP_KEEPALIVE_SECONDS,
+            ),
+            timeout=aiohttp.ClientTimeout(
+                connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT
+            ),
+        )
+        _sessions[loop] = session
+    return session
+
+
+def chat_model(model: str = MODEL, **settings: Any) -> ChatNVIDIA:
+    """The shared, response-cached chat model for model and settings."""
+    key = (model, tuple(sorted(settings.items())))
+    with _lock:
+        llm = _models.get(key)
+        if llm is None:
+            api_key = os.getenv("NVIDIA_API_KEY")
+            llm = ChatNVIDIA(
+                model=model,
+                base_url=NVIDIA_BASE_URL,
+                headers={"x-api-key": api_key} if api_key else {},
+                cache=cache.response_cache(model, **settings),
+                **settings,
+            )
+            llm._client.get_async_session_fn = lambda: _PooledSession(_nvidia_session())
+            _models[key] = llm
+        return llm
+
+
+class _SharedClient:
+    """Hands out a shared httpx client to code that opens one per request."""
+
+    def __init__(self, client: httpx.AsyncClient):
+        self._client = client
+
+    async def __aenter__(self) -> httpx.AsyncClient:
+        return self._client
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        pass
+
+
+def tavily() -> AsyncTavilyClient:
+    """The search client of the running event loop."""
+    return _tavily_clients()[0]
+
+
+def _tavily_clients() -> tuple[AsyncTavilyClient, httpx.AsyncClient]:
+    loop = asyncio.get_running_loop()
+    clients = _tavily.get(loop)
+    if clients is None:
+        http = httpx.AsyncClient(
+            base_url=TAVILY_BASE_URL,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=HTTP_KEEPALIVE_SECONDS,
+            ),
+            timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        )
+        api_key = os.getenv("TAVILY_API_KEY")
+        if "client" in inspect.signature(AsyncTavilyClient).parameters:
+            client = AsyncTavilyClient(
+                api_key=api_key, api_base_url=TAVILY_BASE_URL, client=http
+            )
+        else:
+            # older releases open a new httpx client for every request
+            client = AsyncTavilyClient(api_key=api_key, api_base_url=TAVILY_BASE_URL)
+            http.headers.update(client._client_creator().headers)
+            client._client_creator = lambda: _SharedClient(http)
+        clients = _tavily[loop] = (client, http)
+    return clients
+
+
+async def warm_up() -> None:
+    """Open pooled connections and load the tokenizer before the first report."""
+    chat_model()
+    _, search = _tavily_clients()
+
+    async def touch(name: str, request: Any) -> None:
+        try:
+            async with request:
+                pass
+        except Exception as err:
+            _LOGGER.debug("Warm-up of the %s connection failed: %s", name, err)
+
+    await asyncio.gather(
+        touch("model", _nvidia_session().head(NVIDIA_BASE_URL)),
+        touch("search", search.stream("HEAD", "/")),
+        sources.load_tokenizer(),
+    )
+
+
+async def aclose() -> None:
+    """Close the connections opened on the running event loop."""
+    loop = asyncio.get_running_loop()
+    session = _sessions.pop(loop, None)
+    if session is not None:
+        await session.close()
+    clients = _tavily.pop(loop, None)
+    if clients is not None:
+        await clients[1].aclose()
@@ -0,0 +1,116 @@
+"""Keep the message history sent to the model within a per-node token budget."""
+
+import logging
+from typing import Any, Sequence
+
+from . import scheduler, sources
+
+_LOGGER = logging.getLogger(__name__)
+
+# Prompt token budgets per model call site. Query generation only needs to
+# know what was already searched; the planner and writers need the content.
+NODE_BUDGETS = {
+    "researcher": 8_000,
+    "research_model": 8_000,
+    "report_planner": 24_000,
+    "writing_model": 24_000,
+    "ask": 16_000,
+}
+DEFAULT_BUDGET = 16_000
+# The most recent tool rounds are never compacted.
+KEEP_RECENT_ROUNDS = 1
+
+
+def _role(message: Any) -> str:
+    if isinstance(message, dict):
+        return message.get("role", "")
+    return getattr(message, "type", "")
+
+
+def _content(message: Any) -> str:
+    content = (
+        message.get("content", "")
+        if isinstance(message, dict)
+        else getattr(message, "content", "")
+    )
+    return content if isinstance(content, str) else str(content)
+
+
+def _with_content(message: Any, content: str) -> Any:
+    if isinstance(message, dict):
+        return {**message, "content": content}
+    return message.model_copy(update={"content": content})
+
+
+def _tokens(messages: Sequence[Any]) -> int:
+    return scheduler.estimate_tokens(messages)
+
+
+def compact_tool_output(message: Any) -> Any:
+    """Replace a tool output with references to the sources it found."""
+    records = sources.of(message)
+    if not records:
+        return _with_content(message, "[Earlier tool output removed to save space.]")
+    return sources.without(message, sources.references(records))
+
+
+def _rounds(messages: list[Any]) -> list[list[int]]:
+    """Group the indexes of each tool call message with its tool results."""
+    rounds: list[list[int]] = []
+    for index, message in enumerate(messages):
+        if getattr(message, "tool_calls", None) or (
+            isinstance(message, dict) and message.get("tool_calls")
+        ):
+            rounds.append([index])
+        elif _role(message) == "tool" and rounds:
+            rounds[-1].append(index)
+    return rounds
+
+
+def fit(node: str, messages: Sequence[Any], budget: int | None = None) -> list[Any]:
+    """Fit messages into the node's token budget.
+
+    The source records messages carry are rendered into their content. Within
+    budget nothing else changes. Otherwise, oldest
+    first, tool outputs are reduced to source references, then whole tool
+    call rounds are dropped, and as a last resort the longest remaining
+    message is truncated. A leading system message is always kept.
+    """
+    budget = budget or NODE_BUDGETS.get(node, DEFAULT_BUDGET)
+    messages = list(messages)
+    before = _tokens(messages)
+    if before <= budget:
+        return sources.assemble(messages)
+
+    rounds = _rounds(messages)
+    old_rounds = rounds[: max(len(rounds) - KEEP_RECENT_ROUNDS, 0)]
+
+    for tool_round in old_rounds:
+        for index in tool_round[1:]:
+            messages[index] = compact_tool_output(messages[index])
+        if _tokens(messages) <= budget:
+            break
+
+    dropped: set[int] = set()
+    for tool_round in old_rounds:
+        if _tokens([m for i, m in enumerate(messages) if i not in dropped]) <= budget:
+            break
+        dropped.update(tool_round)
+    messages = sources.assemble([m for i, m in enumerate(messages) if i not in dropped])
+
+    overflow = _tokens(messages) - budget
+    if overflow > 0:
+        start = 1 if messages and _role(messages[0]) == "system" else 0
+        candidates = range(start, len(messages))
+        if candidates:
+            longest = max(candidates, key=lambda i: len(_content(messages[i])))
+            content = _content(messages[longest])
+            keep = max(len(content) - overflow * 4, 0)
+            messages[longest] = _with_content(
+                messages[longest], content[:keep] + "\n... [truncated]"
+            )
+
+    _LOGGER.info(
+        "Fit %s context from ~%d to ~%d tokens.", node, before, _tokens(messages)
+    )
+    return messages
@@ -0,0 +1,166 @@
+"""Research transcripts stored once and shared by reference.
+
+A transcript is stored under the digest of its content and graph states carry
+only the digest. Every section written from the same research shares one copy
+of its messages, checkpoints hold the digest instead of the transcript, and a
+run resumed in another process loads the transcript from disk.
+
+Transcripts are not a cache: a checkpoint may point to one for as long as its
+run can be resumed. Each is pinned by the runs that stored it and released
+with the rest of a run's resumable state, see checkpoint.clear; transcripts of
+runs without a run id are deleted once they are MAX_AGE_SECONDS old.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Sequence
+
+from langchain_core.messages import (
+    BaseMessage,
+    convert_to_messages,
+    messages_from_dict,
+    messages_to_dict,
+)
+
+from . import cache
+
+_LOGGER = logging.getLogger(__name__)
+
+HISTORY_PATH = cache.CACHE_DIR / "research_transcripts.sqlite"
+MAX_AGE_SECONDS = float(os.getenv("HISTORY_MAX_AGE", str(7 * 24 * 3600)))
+
+# Message fields that differ between runs with the same research.
+_VOLATILE_FIELDS = ("id", "response_metadata", "usage_metadata")
+
+
+class TranscriptStore:
+    """Transcripts by digest in SQLite, kept while a run pins them."""
+
+    def __init__(self, path: str | Path):
+        self._lock = threading.Lock()
+        try:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        except (OSError, sqlite3.Error) as err:
+            # still never evicted, but lost with the process
+            _LOGGER.warning("Research history kept in memory only: %s", err)
+            self._conn = sqlite3.connect(":memory:", check_same_thread=False)
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS transcripts ("
+            " digest TEXT PRIMARY KEY,"
+            " messages TEXT NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS pins ("
+            " digest TEXT NOT NULL,"
+            " run TEXT NOT NULL,"
+            " PRIMARY KEY (digest, run))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS pins_run ON pins (run)")
+        self._conn.execute(
+            "DELETE FROM transcripts WHERE created_at < ?"
+            " AND digest NOT IN (SELECT digest FROM pins)",
+            (time.time() - MAX_AGE_SECONDS,),
+        )
+        self._conn.commit()
+
+    def put(
+        self, digest: str, serialized: list[dict[str, Any]], run: str | None
+    ) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO transcripts VALUES (?, ?, ?)",
+                (digest, json.dumps(serialized, default=str), time.time()),
+            )
+            if run is not None:
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO pins VALUES (?, ?)", (digest, run)
+                )
+            self._conn.commit()
+
+    def get(self, digest: str) -> list[dict[str, Any]] | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT messages FROM transcripts WHERE digest = ?", (digest,)
+            ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def release(self, run: str) -> None:
+        """Unpin run's transcripts, deleting those no other run pins."""
+        with self._lock:
+            digests = [
+                row[0]
+                for row in self._conn.execute(
+                    "SELECT digest FROM pins WHERE run = ?", (run,)
+                )
+            ]
+            self._conn.execute("DELETE FROM pins WHERE run = ?", (run,))
+            self._conn.executemany(
+                "DELETE FROM transcripts WHERE digest = ?"
+                " AND digest NOT IN (SELECT digest FROM pins)",
+                ((digest,) for digest in digests),
+            )
+            self._conn.commit()
+
+
+# Transcripts in use, as shared immutable tuples of messages.
+_loaded = cache.MemoryCache(max_entries=64)
+_stored = TranscriptStore(HISTORY_PATH)
+
+
+def _digest(serialized: list[dict[str, Any]]) -> str:
+    return cache.make_key(
+        "history",
+        [
+            {
+                **message,
+                "data": {
+                    key: value
+                    for key, value in message["data"].items()
+                    if key not in _VOLATILE_FIELDS
+                },
+            }
+            for message in serialized
+        ],
+    )
+
+
+async def put(messages: Sequence[Any], run: str | None = None) -> str | None:
+    """Store a transcript for run, returning the digest it is shared by."""
+    if not messages:
+        return None
+    converted = tuple(convert_to_messages(messages))
+    serialized = messages_to_dict(converted)
+    digest = _digest(serialized)
+    _loaded.set(digest, converted)
+    # pinned even when already stored, the run may outlive the one that stored it
+    await asyncio.to_thread(_stored.put, digest, serialized, run)
+    return digest
+
+
+def load(digest: str | None) -> tuple[BaseMessage, ...]:
+    """The transcript stored under digest; None stands for no research."""
+    if digest is None:
+        return ()
+    messages = _loaded.get(digest)
+    if messages is None:
+        serialized = _stored.get(digest)
+        if serialized is None:
+            raise LookupError(f"Research history {digest} is not stored.")
+        messages = tuple(messages_from_dict(serialized))
+        _loaded.set(digest, messages)
+    return messages
+
+
+def release(run: str) -> None:
+    """Let go of the transcripts run stored, once it cannot be resumed."""
+    _stored.release(run)
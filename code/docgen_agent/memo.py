@@ -0,0 +1,102 @@
+"""Finished sections kept across runs, so a rerun only rewrites what changed.
+
+A section is remembered under its topic, name, description, research flag
+and a fingerprint of the research it was handed. A rerun with a tweaked
+report structure reuses every section the new plan leaves as it was, and
+rewrites the ones that changed or whose research did.
+"""
+
+import logging
+import os
+from dataclasses import dataclass, field
+from typing import Any, Sequence
+
+from . import cache, sources
+from .author import Section
+
+_LOGGER = logging.getLogger(__name__)
+
+MEMO_ENABLED = os.getenv("SECTION_MEMO", "1") == "1"
+# How long a section that searched for its own sources stays fresh. Sections
+# without research have no sources of their own to go stale: new pooled
+# research changes their fingerprint instead.
+RESEARCH_TTL = float(os.getenv("SECTION_MEMO_TTL", str(24 * 3600)))
+
+sections: cache.CacheBackend = cache.tiered_cache(
+    "section_memo", max_entries=256, max_bytes=64 * 1024 * 1024
+)
+
+
+def sources_fingerprint(messages: Sequence[Any]) -> str:
+    """A fingerprint of the research messages a section is written from."""
+    return cache.make_key(
+        "sources",
+        [sources.text(message) for message in messages],
+    )
+
+
+def section_key(topic: str, section: Section, messages: Sequence[Any]) -> str:
+    return cache.make_key(
+        "section",
+        topic,
+        section.name,
+        section.description,
+        section.research,
+        sources_fingerprint(messages),
+    )
+
+
+def load(key: str) -> Section | None:
+    """The remembered section for key, if there is a fresh one."""
+    if not MEMO_ENABLED:
+        return None
+    value = sections.get(key)
+    return Section.model_validate(value) if value is not None else None
+
+
+def save(key: str, section: Section) -> None:
+    if not MEMO_ENABLED or not section.content:
+        return
+    ttl = RESEARCH_TTL if section.research else None
+    sections.set(key, section.model_dump(), ttl=ttl)
+
+
+@dataclass
+class PlanDiff:
+    """Section names of a plan compared with the last plan for its topic."""
+
+    unchanged: list[str] = field(default_factory=list)
+    changed: list[str] = field(default_factory=list)
+    added: list[str] = field(default_factory=list)
+    removed: list[str] = field(default_factory=list)
+
+    def __str__(self) -> str:
+        return ", ".join(
+            f"{len(names)} {label}" + (f" ({', '.join(names)})" if names else "")
+            for label, names in (
+                ("unchanged", self.unchanged),
+                ("changed", self.changed),
+                ("new", self.added),
+                ("removed", self.removed),
+            )
+        )
+
+
+def diff_plan(topic: str, plan: Sequence[Section]) -> PlanDiff:
+    """Compare plan with the last one stored for topic, then store plan."""
+    key = cache.make_key("plan", topic)
+    previous = (sections.get(key) if MEMO_ENABLED else None) or {}
+    current = {
+        section.name: [section.description, section.research] for section in plan
+    }
+    diff = PlanDiff(removed=[name for name in previous if name not in current])
+    for name, outline in current.items():
+        if name not in previous:
+            diff.added.append(name)
+        elif previous[name] != outline:
+            diff.changed.append(name)
+        else:
+            diff.unchanged.append(name)
+    if MEMO_ENABLED:
+        sections.set(key, current)
+    return diff
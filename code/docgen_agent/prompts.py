@@ -28,6 +28,18 @@ Consider which sections require web research. For example, introduction and conc
 
 ###############################################################################
 
+structured_patch_prompt: Final[str] = """Your earlier answer is below. Some of its fields are missing or invalid:
+
+{problems}
+
+Reply with a JSON object holding a corrected value for each of these fields, keyed by the field paths listed above. Keep everything else of your earlier answer as it is and do not repeat it.
+
+Your earlier answer:
+
+{answer}"""
+
+###############################################################################
+
 research_prompt: Final[str] = """
 Your goal is to generate targeted web search queries that will gather comprehensive
 information for writing a technical report section.
@@ -89,6 +101,23 @@ If this is a body section, Based on the research information provided in the con
 
 Structure your section with appropriate subsections if needed, and ensure it provides comprehensive coverage of the topic while remaining focused on the section's specific scope.
 
+Write the complete section content as your response - do not include any meta-commentary or explanations about the writing process.
+"""
+
+section_refresh_prompt: Final[str] = """
+You are an expert technical writer. A section written earlier for a closely related report is below, followed in the conversation by the research it was written from and any research gathered since.
+
+Overall report topic: {overall_topic}
+Section name: {section_name}
+Section description: {section_description}
+
+Earlier section:
+===
+{previous}
+===
+
+Revise the earlier section into this section: use this section's name as its heading, cover what its description asks for, and update or correct details the research contradicts. Keep what is still accurate and relevant as it is.
+
 Write the complete section content as your response - do not include any meta-commentary or explanations about the writing process.
 """
 # fmt: on
@@ -0,0 +1,234 @@
+"""Relevance ranking, near-duplicate removal and budgeted packing of sources."""
+
+import hashlib
+import logging
+import math
+import os
+import re
+import threading
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any, Callable, Sequence
+
+from . import sources
+from .research import terms
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed for embedding ranking
+    np = None  # type: ignore[assignment]
+
+_LOGGER = logging.getLogger(__name__)
+
+# "bm25" needs nothing beyond the standard library; "embedding" scores with a
+# local sentence-transformers model and numpy, falling back to bm25 without them
+# or when the model cannot be loaded. Loading the model may download it, so
+# callers on an event loop rank in a thread.
+RANKING_MODE = os.getenv("SOURCE_RANKING", "bm25")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+CHUNK_CHARS = 800
+# SimHash fingerprints this many bits apart or fewer are near-duplicates.
+NEAR_DUPLICATE_BITS = 3
+# Texts with fewer words than this are too short to fingerprint.
+SIMHASH_MIN_WORDS = 8
+
+_PARAGRAPH = re.compile(r"\n\s*\n")
+
+
+@dataclass
+class Chunk:
+    source: dict[str, Any]
+    text: str
+    score: float = 0.0
+
+
+def simhash(text: str) -> int | None:
+    """A 64-bit SimHash of the word 3-shingles of text, None for short text."""
+    words = terms(text)
+    # an empty or short text would share its few shingles with many others
+    if len(words) < SIMHASH_MIN_WORDS:
+        return None
+    shingles = [" ".join(words[i : i + 3]) for i in range(len(words) - 2)]
+    weights = [0] * 64
+    for shingle in shingles:
+        value = int.from_bytes(
+            hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big"
+        )
+        for bit in range(64):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+
+def collapse_near_duplicates(
+    sources: Sequence[dict[str, Any]],
+) -> list[dict[str, Any]]:
+    """Drop sources whose content nearly repeats an earlier source.
+
+    Sources with too little content to fingerprint are always kept.
+    """
+    kept: list[dict[str, Any]] = []
+    fingerprints: list[int] = []
+    for source in sources:
+        text = f"{source.get('content') or ''} {source.get('raw_content') or ''}"
+        fingerprint = simhash(text)
+        if fingerprint is None:
+            kept.append(source)
+            continue
+        if any(
+            bin(fingerprint ^ other).count("1") <= NEAR_DUPLICATE_BITS
+            for other in fingerprints
+        ):
+            _LOGGER.debug("Dropping near-duplicate source: %s", source.get("url"))
+            continue
+        fingerprints.append(fingerprint)
+        kept.append(source)
+    return kept
+
+
+def chunk_text(text: str, chunk_chars: int = CHUNK_CHARS) -> list[str]:
+    """Split text on paragraphs into chunks of at most about chunk_chars."""
+    chunks: list[str] = []
+    current = ""
+    for paragraph in _PARAGRAPH.split(text):
+        paragraph = paragraph.strip()
+        while len(paragraph) > chunk_chars:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(paragraph[:chunk_chars])
+            paragraph = paragraph[chunk_chars:]
+        if current and len(current) + len(paragraph) + 2 > chunk_chars:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class BM25Index:
+    """Okapi BM25 over a fixed set of documents, tokenized once."""
+
+    def __init__(self, documents: Sequence[str], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.counts = [Counter(terms(document)) for document in documents]
+        self.lengths = [sum(counts.values()) for counts in self.counts]
+        self.average_length = (
+            sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+        ) or 1.0
+        self.frequencies = Counter(term for counts in self.counts for term in counts)
+
+    def scores(self, query: str) -> list[float]:
+        """BM25 score of each document for query."""
+        total = len(self.counts)
+        query_terms = set(terms(query))
+        scores = []
+        for counts, length in zip(self.counts, self.lengths):
+            score = 0.0
+            for term in query_terms:
+                if term not in counts:
+                    continue
+                df = self.frequencies[term]
+                idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+                tf = counts[term]
+                norm = 1 - self.b + self.b * length / self.average_length
+                score += idf * tf * (self.k1 + 1) / (tf + self.k1 * norm)
+            scores.append(score)
+        return scores
+
+
+def bm25_scores(
+    query: str, documents: Sequence[str], k1: float = 1.5, b: float = 0.75
+) -> list[float]:
+    """Okapi BM25 score of each document for query."""
+    return BM25Index(documents, k1, b).scores(query)
+
+
+_embedder: Callable[[list[str]], Any] | None = None
+_embedder_tried = False
+_embedder_lock = threading.Lock()
+
+
+def _load_embedder() -> Callable[[list[str]], Any] | None:
+    global _embedder, _embedder_tried
+    with _embedder_lock:
+        if not _embedder_tried:
+            # tried once: a model that failed to load is not downloaded again
+            _embedder_tried = True
+            try:
+                from sentence_transformers import SentenceTransformer
+
+                model = SentenceTransformer(EMBEDDING_MODEL)
+            except ImportError:
+                return None
+            except Exception as err:
+                _LOGGER.warning(
+                    "Embedding model %s unavailable: %r", EMBEDDING_MODEL, err
+                )
+                return None
+            _embedder = lambda texts: model.encode(texts, normalize_embeddings=True)
+    return _embedder
+
+
+def embed(texts: Sequence[str]) -> Any | None:
+    """Unit-length embeddings of texts as a numpy array, or None if unavailable."""
+    encode = _load_embedder() if np is not None else None
+    if encode is None:
+        return None
+    try:
+        vectors = np.asarray(encode(list(texts)), dtype=np.float32)
+    except Exception as err:
+        _LOGGER.warning("Embedding failed: %r", err)
+        return None
+    norms = np.linalg.norm(vectors, axis=1)
+    norms[norms == 0] = 1.0
+    return vectors / norms[:, None]
+
+
+def embedding_scores(query: str, documents: Sequence[str]) -> list[float] | None:
+    """Cosine similarity of each document to query, or None if unavailable."""
+    vectors = embed([query, *documents])
+    if vectors is None:
+        return None
+    return (vectors[1:] @ vectors[0]).tolist()
+
+
+def score(query: str, documents: Sequence[str]) -> list[float]:
+    """Score documents against query with the configured ranking mode."""
+    if RANKING_MODE == "embedding":
+        scores = embedding_scores(query, documents)
+        if scores is not None:
+            return scores
+        _LOGGER.warning("Embedding ranking unavailable, falling back to BM25.")
+    return bm25_scores(query, documents)
+
+
+def rank_chunks(
+    query: str, sources: Sequence[dict[str, Any]], include_raw_content: bool
+) -> list[Chunk]:
+    """Split sources into chunks and order them by relevance to query."""
+    chunks = []
+    for source in sources:
+        if source.get("content"):
+            chunks.append(Chunk(source, source["content"]))
+        if include_raw_content and source.get("raw_content"):
+            chunks.extend(
+                Chunk(source, text) for text in chunk_text(source["raw_content"])
+            )
+    for chunk, value in zip(chunks, score(query, [c.text for c in chunks])):
+        chunk.score = value
+    return sorted(chunks, key=lambda chunk: chunk.score, reverse=True)
+
+
+def pack(chunks: Sequence[Chunk], max_tokens: int) -> list[Chunk]:
+    """Take the best chunks, in order, until the token budget is used up."""
+    packed = []
+    used = 0
+    for chunk in chunks:
+        tokens = sources.count_tokens(chunk.text)
+        if used + tokens > max_tokens:
+            continue
+        packed.append(chunk)
+        used += tokens
+    return packed
@@ -0,0 +1,112 @@
+"""A report-wide pool of research shared by the topic research and every section."""
+
+import asyncio
+import logging
+import re
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable
+
+from langchain_core.runnables import RunnableConfig
+
+_LOGGER = logging.getLogger(__name__)
+
+_WORD = re.compile(r"[a-z0-9]+")
+_STOPWORDS = frozenset(
+    "a an and are as at be by for from how in is it of on or the to vs what "
+    "when where which why with".split()
+)
+RELEVANT_SOURCES = 8
+
+
+def terms(text: str) -> list[str]:
+    """Lowercase word tokens of text with common stopwords removed."""
+    return [word for word in _WORD.findall(text.lower()) if word not in _STOPWORDS]
+
+
+def normalize_query(query: str) -> str:
+    """Reduce a query to its sorted distinct terms, so rephrasings share a key."""
+    return " ".join(sorted(set(terms(query))))
+
+
+@dataclass
+class PoolStats:
+    searches: int = 0
+    reused: int = 0
+
+
+class ResearchPool:
+    """Sources and searches shared by every section of one report.
+
+    Identical or reworded queries are searched once per report, even when
+    sections ask for them at the same time, and every source is kept once by
+    URL so sections can be handed what has already been found.
+    """
+
+    def __init__(self):
+        self.sources: dict[str, dict[str, Any]] = {}
+        self.stats = PoolStats()
+        self._queries: dict[tuple, asyncio.Future] = {}
+
+    async def search(
+        self,
+        query: str,
+        topic: str,
+        days: int | None,
+        fetch: Callable[[], Awaitable[dict[str, Any]]],
+    ) -> dict[str, Any]:
+        """Return the results for query, fetching them only if no section has."""
+        key = (normalize_query(query), topic, days)
+        future = self._queries.get(key)
+        if future is not None:
+            self.stats.reused += 1
+            _LOGGER.info("Reusing research for query: %s", query)
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # the section that owned this search failed, so search again
+                return await self.search(query, topic, days, fetch)
+
+        future = asyncio.get_running_loop().create_future()
+        self._queries[key] = future
+        self.stats.searches += 1
+        try:
+            response = await fetch()
+        except BaseException:
+            del self._queries[key]
+            future.cancel()
+            raise
+        for source in response.get("results", []):
+            self.sources.setdefault(source["url"], source)
+        future.set_result(response)
+        return response
+
+    def snapshot(self) -> "ResearchPool":
+        """A pool holding the sources found so far, to rank them against."""
+        pool = ResearchPool()
+        pool.sources = dict(self.sources)
+        return pool
+
+    def relevant(
+        self, text: str, limit: int = RELEVANT_SOURCES
+    ) -> list[dict[str, Any]]:
+        """The pooled sources that share the most terms with text."""
+        wanted = set(terms(text))
+        if not wanted:
+            return []
+        scored = []
+        for source in self.sources.values():
+            found = set(terms(f"{source.get('title', '')} {source.get('content', '')}"))
+            score = len(wanted & found) / len(wanted)
+            if score > 0:
+                scored.append((score, source))
+        scored.sort(key=lambda pair: pair[0], reverse=True)
+        return [source for _, source in scored[:limit]]
+
+
+def get_pool(config: RunnableConfig | None) -> ResearchPool | None:
+    """The research pool of the report being written, if there is one."""
+    if not config:
+        return None
+    return config.get("configurable", {}).get("research_pool")
@@ -1,33 +1,17 @@
-import json
 import logging
 from typing import Annotated, Any, Sequence
 
 from langchain_core.runnables import RunnableConfig
-from langchain_nvidia_ai_endpoints import ChatNVIDIA
 from langgraph.graph import END, START, StateGraph
 from langgraph.graph.message import add_messages
 from pydantic import BaseModel
 
-from . import tools
+from . import budget, routing, tools
 from .prompts import research_prompt
 
 _LOGGER = logging.getLogger(__name__)
 _MAX_LLM_RETRIES = 3
 
-import os
-
-llm = ChatNVIDIA(
-    model="nvidia/llama-3.3-nemotron-super-49b-v1.5",
-    temperature=0,
-    base_url="https://integrate.api.nvidia.com/v1",
-    headers={"x-api-key": os.environ["NVIDIA_API_KEY"]}
-)
-
-
-
-
-llm_with_tools = llm.bind_tools([tools.search_tavily])
-
 
 class ResearcherState(BaseModel):
     topic: str
@@ -36,24 +20,8 @@ class ResearcherState(BaseModel):
     # how many searches should be done per topic?
     messages: Annotated[Sequence[Any], add_messages] = []
     # a chat log of the research results
-
-
-async def tool_node(state: ResearcherState):
-    _LOGGER.info("Executing tool calls.")
-    outputs = []
-    for tool_call in state.messages[-1].tool_calls:
-        _LOGGER.info("Executing tool call: %s", tool_call["name"])
-        tool = getattr(tools, tool_call["name"])
-        tool_result = await tool.ainvoke(tool_call["args"])
-        outputs.append(
-            {
-                "role": "tool",
-                "content": json.dumps(tool_result),
-                "name": tool_call["name"],
-                "tool_call_id": tool_call["id"],
-            }
-        )
-    return {"messages": outputs}
+    loop: budget.LoopProgress = budget.LoopProgress()
+    # how much of the research budget has been spent
 
 
 async def call_model(
@@ -65,18 +33,15 @@ async def call_model(
         topic=state.topic, number_of_queries=state.number_of_queries
     )
 
-    for count in range(_MAX_LLM_RETRIES):
-        messages = [{"role": "system", "content": system_prompt}] + list(state.messages)
-        response = await llm_with_tools.ainvoke(messages, config)
-
-        if response:
-            return {"messages": [response]}
-
-        _LOGGER.debug(
-            "Retrying LLM call. Attempt %d of %d", count + 1, _MAX_LLM_RETRIES
-        )
-
-    raise RuntimeError("Failed to call model after %d attempts.", _MAX_LLM_RETRIES)
+    messages = [{"role": "system", "content": system_prompt}] + list(state.messages)
+    response = await routing.invoke_model(
+        "researcher",
+        messages,
+        config,
+        bind=lambda llm: llm.bind_tools([tools.search_tavily]),
+        attempts=_MAX_LLM_RETRIES,
+    )
+    return {"messages": [response], "loop": budget.start(state.loop)}
 
 
 def has_tool_calls(state: ResearcherState) -> bool:
@@ -89,7 +54,7 @@ def has_tool_calls(state: ResearcherState) -> bool:
 workflow = StateGraph(ResearcherState)
 
 workflow.add_node("agent", call_model)
-workflow.add_node("tools", tool_node)
+workflow.add_node("tools", budget.tool_node("researcher"))
 
 workflow.add_edge(START, "agent")
 workflow.add_conditional_edges(
@@ -100,5 +65,15 @@ workflow.add_conditional_edges(
         False: END,
     },
 )
-workflow.add_edge("tools", "agent")
-graph = workflow.compile()
+# research ends early once its budget is spent or new rounds stop finding much
+workflow.add_conditional_edges(
+    "tools",
+    budget.should_stop,
+    {
+        True: END,
+        False: "agent",
+    },
+)
+# Runs inside the report graph's nodes, several at a time; progress is saved
+# by the report graph, so this graph never uses a checkpointer.
+graph = workflow.compile(checkpointer=False)
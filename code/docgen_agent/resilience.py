@@ -0,0 +1,273 @@
+"""Retries, timeouts, hedging and circuit breaking for model and search calls."""
+
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Literal, Sequence, TypeVar
+
+from langchain_core.runnables import Runnable, RunnableConfig
+
+from . import scheduler
+
+_LOGGER = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+CALL_TIMEOUT = float(os.getenv("LLM_CALL_TIMEOUT", "300"))
+HEDGE_ENABLED = os.getenv("LLM_HEDGE", "1") == "1"
+# Hedge once a call runs longer than this quantile of its node's latencies.
+HEDGE_QUANTILE = 0.95
+HEDGE_MIN_SAMPLES = 20
+BASE_DELAY = 1.0
+MAX_DELAY = 30.0
+
+ErrorKind = Literal["retryable", "fatal"]
+
+
+class EmptyResponseError(Exception):
+    """The model returned an empty response."""
+
+
+class CircuitOpenError(Exception):
+    """Calls are being refused because the endpoint keeps failing."""
+
+
+def classify_error(err: BaseException) -> ErrorKind:
+    """Decide whether an error is worth retrying."""
+    if isinstance(err, CircuitOpenError):
+        return "fatal"
+    if isinstance(
+        err, (EmptyResponseError, asyncio.TimeoutError, TimeoutError, ConnectionError)
+    ):
+        return "retryable"
+    status = scheduler.status_code(err)
+    if status is not None:
+        return "retryable" if status in (408, 425, 429) or status >= 500 else "fatal"
+    # aiohttp and httpx transport errors do not share a base class with the
+    # builtin ConnectionError, so match them by name
+    if any(
+        base.__name__ in ("ClientError", "TransportError", "TimeoutException")
+        for base in type(err).__mro__
+    ):
+        return "retryable"
+    return "fatal"
+
+
+@dataclass
+class CallStats:
+    """Outcome and latency counters for one named call site."""
+
+    calls: int = 0
+    successes: int = 0
+    failures: int = 0
+    retries: int = 0
+    timeouts: int = 0
+    hedges: int = 0
+    latencies: deque[float] = field(default_factory=lambda: deque(maxlen=500))
+
+    def quantile(self, q: float) -> float | None:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "successes": self.successes,
+            "failures": self.failures,
+            "retries": self.retries,
+            "timeouts": self.timeouts,
+            "hedges": self.hedges,
+            "p50_seconds": self.quantile(0.5),
+            "p95_seconds": self.quantile(0.95),
+        }
+
+
+class CircuitBreaker:
+    """Refuse calls for a while after too many consecutive failures."""
+
+    def __init__(self, failure_threshold: int = 5, reset_after: float = 60.0):
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self._failures = 0
+        self._opened_at: float | None = None
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_after:
+            return "half-open"
+        return "open"
+
+    def before_call(self) -> None:
+        if self.state == "open":
+            raise CircuitOpenError(
+                "Circuit open after %d consecutive failures." % self._failures
+            )
+
+    def record_success(self) -> None:
+        self._failures = 0
+        self._opened_at = None
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        if self.state == "half-open" or self._failures >= self.failure_threshold:
+            self._opened_at = time.monotonic()
+
+
+stats: dict[str, CallStats] = {}
+breakers: dict[str, CircuitBreaker] = {
+    "llm": CircuitBreaker(),
+    "search": CircuitBreaker(),
+}
+
+
+def report() -> dict[str, dict[str, Any]]:
+    """Summarize retries and latencies for every call site seen so far."""
+    return {name: call_stats.as_dict() for name, call_stats in stats.items()}
+
+
+async def _hedged(
+    fn: Callable[[], Awaitable[T]],
+    hedge: Callable[[], Awaitable[T]] | None,
+    hedge_after: float | None,
+    call_stats: CallStats,
+) -> T:
+    """Run fn, starting hedge as well if fn is slower than hedge_after."""
+    tasks = [asyncio.ensure_future(fn())]
+    try:
+        if hedge is not None and hedge_after is not None:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+            if not done:
+                _LOGGER.info(
+                    "Call slower than %.1fs, sending a hedged request.", hedge_after
+                )
+                call_stats.hedges += 1
+                tasks.append(asyncio.ensure_future(hedge()))
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+        # every copy failed, surface the original error
+        return tasks[0].result()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def run(
+    name: str,
+    fn: Callable[[], Awaitable[T]],
+    *,
+    attempts: int = 3,
+    timeout: float | None = CALL_TIMEOUT,
+    breaker: CircuitBreaker | None = None,
+    hedge: Callable[[], Awaitable[T]] | None = None,
+) -> T:
+    """Call fn with per-attempt timeouts, backoff on retryable errors and hedging.
+
+    hedge is the copy of fn to race a slow attempt against, if any. Falsy
+    results count as retryable failures. The last error is re-raised once the
+    attempts are used up.
+    """
+    call_stats = stats.setdefault(name, CallStats())
+    for attempt in range(attempts):
+        if breaker is not None:
+            breaker.before_call()
+        hedge_after = None
+        if (
+            hedge is not None
+            and HEDGE_ENABLED
+            and len(call_stats.latencies) >= HEDGE_MIN_SAMPLES
+        ):
+            hedge_after = call_stats.quantile(HEDGE_QUANTILE)
+        call_stats.calls += 1
+        start = time.monotonic()
+        try:
+            result = await asyncio.wait_for(
+                _hedged(fn, hedge, hedge_after, call_stats), timeout
+            )
+            if not result:
+                raise EmptyResponseError("Empty response from %s." % name)
+        except Exception as err:
+            call_stats.failures += 1
+            if isinstance(err, asyncio.TimeoutError):
+                call_stats.timeouts += 1
+            kind = classify_error(err)
+            if breaker is not None and kind == "retryable":
+                breaker.record_failure()
+            if kind == "fatal" or attempt == attempts - 1:
+                raise
+            call_stats.retries += 1
+            delay = random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2**attempt))
+            _LOGGER.warning(
+                "%s failed (%r), retrying in %.1fs. Attempt %d of %d.",
+                name,
+                err,
+                delay,
+                attempt + 1,
+                attempts,
+            )
+            await asyncio.sleep(delay)
+            continue
+        call_stats.successes += 1
+        call_stats.latencies.append(time.monotonic() - start)
+        if breaker is not None:
+            breaker.record_success()
+        return result
+    raise RuntimeError("Failed to call %s after %d attempts." % (name, attempts))
+
+
+async def invoke_model(
+    name: str,
+    model: Runnable,
+    messages: Sequence[Any],
+    config: RunnableConfig | None = None,
+    attempts: int = 3,
+    limiter: scheduler.Scheduler | None = None,
+    breaker: CircuitBreaker | None = None,
+) -> Any:
+    """Invoke a chat model through the shared scheduler with retries.
+
+    The messages are sent as they are: routing.invoke_model has fit them into
+    the context budget of the named node already. limiter and breaker default
+    to the ones shared by all model calls.
+
+    A slow call is hedged with a copy that runs without callbacks, so tracers
+    and token counts only see the first; calls whose output is being streamed
+    are not hedged at all, their tokens would interleave.
+    """
+    tokens = scheduler.estimate_tokens(messages)
+    limiter = limiter or scheduler.llm_scheduler
+    hedge = None
+    if not _streamed(config):
+        # callbacks=None would inherit the node's callbacks again
+        quiet: RunnableConfig = {**(config or {}), "callbacks": []}
+        hedge = lambda: limiter.run(
+            lambda: model.ainvoke(messages, quiet), tokens=tokens
+        )
+    return await run(
+        name,
+        lambda: limiter.run(lambda: model.ainvoke(messages, config), tokens=tokens),
+        attempts=attempts,
+        breaker=breaker or breakers["llm"],
+        hedge=hedge,
+    )
+
+
+def _streamed(config: RunnableConfig | None) -> bool:
+    """Whether a callback of config streams model output, as astream_events does."""
+    callbacks = (config or {}).get("callbacks")
+    handlers = getattr(callbacks, "handlers", callbacks) or []
+    # streaming handlers tap the output of the runs they watch
+    return any(hasattr(handler, "tap_output_aiter") for handler in handlers)
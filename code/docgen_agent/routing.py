@@ -0,0 +1,215 @@
+"""Pick the model for each call from a declarative routing policy.
+
+A policy is an ordered list of routes. The first route matching the call's
+node, section research flag and prompt size decides which models to try, in
+order: the first one that is not rate limited, not failing and within the
+route's latency SLO is called, and the others are fallbacks for when it
+errors. Set ROUTING_POLICY to a JSON file holding a list of routes to replace
+the default policy, or MODEL_ROUTING=0 to send every call to NVIDIA_MODEL.
+"""
+
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Callable, Sequence
+
+from langchain_core.runnables import Runnable, RunnableConfig
+from langchain_core.runnables.config import merge_configs
+
+from . import clients, context, resilience, scheduler, telemetry
+
+_LOGGER = logging.getLogger(__name__)
+
+ROUTING_ENABLED = os.getenv("MODEL_ROUTING", "1") == "1"
+ROUTING_POLICY = os.getenv("ROUTING_POLICY", "")
+# A small, fast model for calls that do not need the large one.
+SMALL_MODEL = os.getenv("NVIDIA_SMALL_MODEL", "meta/llama-3.1-8b-instruct")
+# Attempts on a model before falling back to the next one of its route; the
+# last model of a route gets the caller's full number of attempts.
+FALLBACK_AFTER_ATTEMPTS = int(os.getenv("ROUTING_FALLBACK_AFTER_ATTEMPTS", "2"))
+
+
+@dataclass(frozen=True)
+class Route:
+    """Which models serve the calls a route matches, preferred model first.
+
+    Unset conditions match every call. latency_slo is in seconds: a model
+    whose recent p95 latency on the node is above it is passed over while
+    another model of the route is left.
+    """
+
+    name: str
+    models: tuple[str, ...]
+    nodes: tuple[str, ...] = ()
+    research: bool | None = None
+    max_prompt_tokens: int | None = None
+    latency_slo: float | None = None
+
+    def matches(self, node: str, research: bool | None, tokens: int) -> bool:
+        return (
+            (not self.nodes or node in self.nodes)
+            and (self.research is None or self.research == research)
+            and (self.max_prompt_tokens is None or tokens <= self.max_prompt_tokens)
+        )
+
+
+DEFAULT_ROUTES = (
+    # writing search queries is short and formulaic
+    Route(
+        "query_generation",
+        (SMALL_MODEL, clients.MODEL),
+        nodes=("researcher", "research_model"),
+        max_prompt_tokens=8_000,
+        latency_slo=10.0,
+    ),
+    # introductions and conclusions summarize the plan, they do no research
+    Route(
+        "unresearched_section",
+        (SMALL_MODEL, clients.MODEL),
+        nodes=("writing_model",),
+        research=False,
+        latency_slo=30.0,
+    ),
+    Route(
+        "short_answer",
+        (SMALL_MODEL, clients.MODEL),
+        nodes=("ask",),
+        max_prompt_tokens=6_000,
+        latency_slo=15.0,
+    ),
+    # filling in the fields a structured answer is missing
+    Route(
+        "structured_patch",
+        (SMALL_MODEL, clients.MODEL),
+        nodes=("structured_patch",),
+        latency_slo=15.0,
+    ),
+    # adapting a section reused from a related report to this one
+    Route(
+        "section_refresh",
+        (SMALL_MODEL, clients.MODEL),
+        nodes=("section_refresh",),
+        latency_slo=30.0,
+    ),
+    Route("default", (clients.MODEL, SMALL_MODEL)),
+)
+
+
+@lru_cache(maxsize=None)
+def policy() -> tuple[Route, ...]:
+    """The routes in effect, loaded once."""
+    if not ROUTING_ENABLED:
+        return (Route("default", (clients.MODEL,)),)
+    if not ROUTING_POLICY:
+        return DEFAULT_ROUTES
+    with open(ROUTING_POLICY, encoding="utf-8") as policy_file:
+        routes = json.load(policy_file)
+    return tuple(
+        Route(
+            **{
+                **route,
+                "models": tuple(route["models"]),
+                "nodes": tuple(route.get("nodes", ())),
+            }
+        )
+        for route in routes
+    ) + (Route("default", (clients.MODEL,)),)
+
+
+def select(node: str, research: bool | None = None, tokens: int = 0) -> Route:
+    """The first route of the policy matching a call."""
+    return next(route for route in policy() if route.matches(node, research, tokens))
+
+
+# recent latencies of each node on each model, for the latency SLOs
+_latencies: dict[tuple[str, str], resilience.CallStats] = {}
+
+
+def _p95(node: str, model: str) -> float | None:
+    call_stats = _latencies.get((node, model))
+    if call_stats is None or len(call_stats.latencies) < resilience.HEDGE_MIN_SAMPLES:
+        return None
+    return call_stats.quantile(0.95)
+
+
+def _breaker(model: str) -> resilience.CircuitBreaker:
+    return resilience.breakers.setdefault(f"llm {model}", resilience.CircuitBreaker())
+
+
+def candidates(route: Route, node: str) -> list[str]:
+    """The models of a route to try, in order.
+
+    Models that are rate limited, behind an open circuit breaker or slower
+    than the route's SLO go last rather than first, so a call still has
+    somewhere to go when every model is struggling.
+    """
+
+    def available(model: str) -> bool:
+        p95 = _p95(node, model)
+        return (
+            scheduler.model_scheduler(model).paused_for == 0
+            and _breaker(model).state != "open"
+            and (route.latency_slo is None or p95 is None or p95 <= route.latency_slo)
+        )
+
+    ordered = sorted(route.models, key=lambda model: not available(model))
+    return list(dict.fromkeys(ordered))
+
+
+async def invoke_model(
+    name: str,
+    messages: Sequence[Any],
+    config: RunnableConfig | None = None,
+    *,
+    bind: Callable[[Runnable], Runnable] | None = None,
+    research: bool | None = None,
+    attempts: int = 3,
+    temperature: float = 0,
+) -> Any:
+    """Invoke the model the policy routes this call to, falling back on errors.
+
+    name is the calling node, as for resilience.invoke_model; bind prepares
+    the chat model, for instance by binding tools or an output schema, and
+    research is the section's research flag where there is one.
+    """
+    messages = context.fit(name, messages)
+    route = select(name, research, scheduler.estimate_tokens(messages))
+    # the route is passed down for the tracer to record with the model call
+    routed = merge_configs(config, {"metadata": {"route": route.name}})
+    models = candidates(route, name)
+    for position, model in enumerate(models):
+        last = position == len(models) - 1
+        llm = clients.chat_model(model, temperature=temperature)
+        started = time.monotonic()
+        try:
+            response = await resilience.invoke_model(
+                name,
+                bind(llm) if bind is not None else llm,
+                messages,
+                routed,
+                attempts=attempts if last else min(attempts, FALLBACK_AFTER_ATTEMPTS),
+                limiter=scheduler.model_scheduler(model),
+                breaker=_breaker(model),
+            )
+        except Exception as err:
+            if last:
+                raise
+            _LOGGER.warning(
+                "%s failed on %s (%r), falling back to %s.",
+                name,
+                model,
+                err,
+                models[position + 1],
+            )
+            telemetry.metrics.inc(
+                "docgen_model_fallbacks_total", node=name, route=route.name, model=model
+            )
+            continue
+        _latencies.setdefault((name, model), resilience.CallStats()).latencies.append(
+            time.monotonic() - started
+        )
+        return response
+    raise RuntimeError(f"Route {route.name} has no models.")
@@ -0,0 +1,488 @@
+"""Write the reports of a JSONL job file across processes and machines.
+
+Each line of the job file is a JSON object with a "topic" and a
+"report_structure", and optionally an "id". The jobs are loaded into a SQLite
+lease queue, which doubles as the progress ledger: workers lease one job at
+a time, renew the lease while they write it, and append the result to the
+output JSONL as soon as it is done. A rerun skips the jobs that are done and
+retries the failed ones that have attempts left, a job whose worker crashed is
+leased again once its lease runs out, and a re-leased job resumes from its
+checkpoint when it is back on the machine that started it. Every lease counts
+as an attempt, so a job that keeps killing its worker fails after
+--max-attempts; a worker that loses its lease abandons the job without writing
+it.
+
+    python -m docgen_agent.runner run jobs.jsonl results.jsonl --processes 4
+    python -m docgen_agent.runner status jobs.jsonl
+
+Workers on several machines share the work through a queue on a shared
+volume (--queue), or each take a static shard of the job file with
+--shard INDEX/COUNT and a queue of their own, by default one per shard.
+"""
+
+import argparse
+import asyncio
+import fcntl
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import suppress
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Iterable, Iterator
+
+from langgraph.graph.state import CompiledStateGraph
+
+from . import (
+    REPORT_CONCURRENCY,
+    SECTION_CONCURRENCY,
+    cache,
+    checkpoint,
+    clients,
+    open_durable_graph,
+    run_config,
+    scheduler,
+    telemetry,
+)
+from .agent import AgentState
+
+_LOGGER = logging.getLogger(__name__)
+
+LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "600"))
+MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+
+
+@dataclass
+class Job:
+    id: str
+    line: int
+    topic: str
+    report_structure: str
+    run_id: str
+    attempt: int
+
+
+def read_jobs(
+    path: str | Path, shard: tuple[int, int] | None = None
+) -> Iterator[tuple[str, int, dict[str, Any]]]:
+    """The (id, line, record) of each job in a job file, or in one shard of it."""
+    with open(path, encoding="utf-8") as jobs:
+        for line, text in enumerate(jobs):
+            if not text.strip():
+                continue
+            if shard is not None and line % shard[1] != shard[0]:
+                continue
+            record = json.loads(text)
+            if not record.get("topic") or not record.get("report_structure"):
+                raise ValueError(
+                    f"{path}:{line + 1} needs a topic and report_structure."
+                )
+            job_id = str(
+                record.get("id")
+                or cache.make_key("job", record["topic"], record["report_structure"])
+            )
+            yield job_id, line, record
+
+
+class LeaseQueue:
+    """The jobs of a job file and their progress, leased out to workers.
+
+    Every worker process opens the same SQLite file; leasing happens in an
+    immediate transaction, so no two workers get the same job. The calls
+    block on the file lock, so async workers make them in a thread.
+    """
+
+    def __init__(
+        self,
+        path: str | Path,
+        lease_seconds: float = LEASE_SECONDS,
+        max_attempts: int = MAX_ATTEMPTS,
+    ):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY,"
+            " line INTEGER NOT NULL,"
+            " topic TEXT NOT NULL,"
+            " report_structure TEXT NOT NULL,"
+            " status TEXT NOT NULL DEFAULT 'pending',"
+            " worker TEXT,"
+            " lease_until REAL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " run_id TEXT,"
+            " error TEXT,"
+            " finished REAL)"
+        )
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def load(self, jobs: Iterable[tuple[str, int, dict[str, Any]]]) -> int:
+        """Add the jobs not in the queue yet, returning how many were added."""
+        with self._lock, self._conn:
+            before = self._conn.total_changes
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO jobs (id, line, topic, report_structure)"
+                " VALUES (?, ?, ?, ?)",
+                (
+                    (job_id, line, record["topic"], record["report_structure"])
+                    for job_id, line, record in jobs
+                ),
+            )
+            return self._conn.total_changes - before
+
+    def mark_done(self, job_ids: Iterable[str]) -> None:
+        """Record jobs as done, for results found in the output but not here."""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "UPDATE jobs SET status = 'done' WHERE id = ? AND status != 'done'",
+                ((job_id,) for job_id in job_ids),
+            )
+
+    def requeue_failed(self) -> int:
+        """Put the failed jobs with attempts left back in the queue."""
+        with self._lock, self._conn:
+            return self._conn.execute(
+                "UPDATE jobs SET status = 'pending', worker = NULL, error = NULL,"
+                " finished = NULL WHERE status = 'failed' AND attempts < ?",
+                (self.max_attempts,),
+            ).rowcount
+
+    def lease(self, worker: str) -> Job | None:
+        """Lease the next pending or abandoned job to worker.
+
+        An abandoned job that has used up its attempts is failed instead: its
+        workers crashed or hung every time.
+        """
+        with self._lock:
+            return self._lease(worker)
+
+    def _lease(self, worker: str) -> Job | None:
+        now = time.time()
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'failed', finished = ?, lease_until = NULL,"
+                " error = 'lease expired on every attempt'"
+                " WHERE status = 'leased' AND lease_until < ? AND attempts >= ?",
+                (now, now, self.max_attempts),
+            )
+            row = self._conn.execute(
+                "SELECT id, line, topic, report_structure, run_id, attempts FROM jobs"
+                " WHERE status = 'pending'"
+                " OR (status = 'leased' AND lease_until < ?)"
+                " ORDER BY line LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                self._conn.execute("COMMIT")
+                return None
+            job_id, line, topic, report_structure, run_id, attempts = row
+            # a job picked up after a crash keeps its run id, to resume it
+            run_id = run_id or uuid.uuid4().hex
+            self._conn.execute(
+                "UPDATE jobs SET status = 'leased', worker = ?, lease_until = ?,"
+                " attempts = attempts + 1, run_id = ? WHERE id = ?",
+                (worker, now + self.lease_seconds, run_id, job_id),
+            )
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        return Job(job_id, line, topic, report_structure, run_id, attempts + 1)
+
+    def renew(self, job: Job, worker: str) -> bool:
+        """Extend worker's lease on job; False if the lease was lost."""
+        # the attempt tells this lease from a later one of the same worker
+        with self._lock, self._conn:
+            updated = self._conn.execute(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ?"
+                " AND attempts = ? AND status = 'leased'",
+                (time.time() + self.lease_seconds, job.id, worker, job.attempt),
+            ).rowcount
+        return bool(updated)
+
+    def finish(self, job: Job, worker: str, error: str | None = None) -> bool:
+        """Record the outcome of job, returning whether it is final.
+
+        A failed job goes back to the queue until it has used max_attempts.
+        """
+        final = error is None or job.attempt >= self.max_attempts
+        status = ("done" if error is None else "failed") if final else "pending"
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished = ?, lease_until = NULL"
+                " WHERE id = ? AND worker = ? AND attempts = ?",
+                (status, error, time.time(), job.id, worker, job.attempt),
+            )
+        return final
+
+    def progress(self) -> dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, COUNT(*) FROM jobs GROUP BY status"
+            ).fetchall()
+        return dict(rows)
+
+
+class ResultLog:
+    """The output JSONL, appended to by every worker process."""
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    def append(self, record: dict[str, Any]) -> None:
+        line = json.dumps(record, default=str) + "\n"
+        with open(self.path, "a", encoding="utf-8") as output:
+            # keeps lines of concurrent workers from interleaving
+            fcntl.flock(output, fcntl.LOCK_EX)
+            try:
+                output.write(line)
+                output.flush()
+            finally:
+                fcntl.flock(output, fcntl.LOCK_UN)
+
+    def done(self) -> set[str]:
+        """Ids of the jobs with a report in the output."""
+        if not self.path.exists():
+            return set()
+        done = set()
+        with open(self.path, encoding="utf-8") as output:
+            for text in output:
+                # a worker killed mid-write leaves a partial last line
+                with suppress(json.JSONDecodeError):
+                    record = json.loads(text)
+                    if record.get("ok"):
+                        done.add(record["id"])
+        return done
+
+
+def prepare(
+    jobs_path: str | Path,
+    output_path: str | Path,
+    queue_path: str | Path,
+    shard: tuple[int, int] | None = None,
+    max_attempts: int = MAX_ATTEMPTS,
+) -> LeaseQueue:
+    """Load the job file into the queue, reconciled with the output so far."""
+    queue = LeaseQueue(queue_path, max_attempts=max_attempts)
+    added = queue.load(read_jobs(jobs_path, shard))
+    # the output is written before the ledger: a worker may have died between
+    queue.mark_done(ResultLog(output_path).done())
+    retried = queue.requeue_failed()
+    _LOGGER.info(
+        "Loaded %d new jobs, retrying %d failed: %s.",
+        added,
+        retried,
+        queue.progress(),
+    )
+    return queue
+
+
+async def _write(
+    job: Job,
+    queue: LeaseQueue,
+    output: ResultLog,
+    worker: str,
+    durable_graph: CompiledStateGraph,
+    section_slots: scheduler.PrioritySlots,
+) -> None:
+    """Write job and record its outcome, unless its lease is lost meanwhile."""
+    lost = False
+    tracer = None
+
+    async def heartbeat(writing: asyncio.Task) -> None:
+        nonlocal lost
+        while True:
+            await asyncio.sleep(queue.lease_seconds / 3)
+            if not await asyncio.to_thread(queue.renew, job, worker):
+                # another worker has the job now, this one must not write it
+                lost = True
+                writing.cancel()
+                return
+
+    async def produce() -> dict[str, Any]:
+        nonlocal tracer
+        async with telemetry.trace_run(job.run_id) as tracer:
+            # jobs earlier in the file get section writers first
+            config = run_config(job.run_id, tracer, section_slots, job.line)
+            snapshot = await durable_graph.aget_state(config)
+            if snapshot.values and not snapshot.next:
+                return snapshot.values
+            if snapshot.values:
+                _LOGGER.info("Resuming job %s at %s.", job.id, ", ".join(snapshot.next))
+                return await durable_graph.ainvoke(None, config)
+            state = AgentState(topic=job.topic, report_structure=job.report_structure)
+            return await durable_graph.ainvoke(state, config)
+
+    started = time.monotonic()
+    writing = asyncio.create_task(produce())
+    renewing = asyncio.create_task(heartbeat(writing))
+    record: dict[str, Any] = {
+        "id": job.id,
+        "line": job.line,
+        "topic": job.topic,
+        "run_id": job.run_id,
+        "worker": worker,
+        "attempt": job.attempt,
+    }
+    error = None
+    try:
+        values = await writing
+        record["report"] = values.get("report")
+    except asyncio.CancelledError:
+        if not lost:
+            writing.cancel()
+            raise
+    except Exception as err:
+        _LOGGER.error("Job %s (%s) failed: %s", job.id, job.topic, err)
+        error = f"{type(err).__name__}: {err}"
+    finally:
+        renewing.cancel()
+    # the lease may have run out since the last renewal
+    if lost or not await asyncio.to_thread(queue.renew, job, worker):
+        _LOGGER.warning("Lost the lease on job %s, abandoning it.", job.id)
+        return
+    record.update(
+        ok=error is None,
+        error=error,
+        seconds=round(time.monotonic() - started, 3),
+        summary=tracer.summary() if tracer is not None else None,
+    )
+    if error is None:
+        output.append(record)
+        await asyncio.to_thread(checkpoint.clear, job.run_id)
+    final = await asyncio.to_thread(queue.finish, job, worker, error)
+    if final and error is not None:
+        output.append(record)
+
+
+async def work(
+    queue: LeaseQueue,
+    output: ResultLog,
+    worker: str,
+    concurrency: int = REPORT_CONCURRENCY,
+    section_concurrency: int = SECTION_CONCURRENCY,
+) -> int:
+    """Write leased jobs until the queue has none left, returning how many."""
+    section_slots = scheduler.PrioritySlots(section_concurrency)
+    written = 0
+
+    async def slot(durable_graph: CompiledStateGraph) -> None:
+        nonlocal written
+        while (job := await asyncio.to_thread(queue.lease, worker)) is not None:
+            _LOGGER.info("Worker %s took job %s (%s).", worker, job.id, job.topic)
+            await _write(job, queue, output, worker, durable_graph, section_slots)
+            written += 1
+
+    try:
+        async with open_durable_graph() as durable_graph:
+            await asyncio.gather(*(slot(durable_graph) for _ in range(concurrency)))
+    finally:
+        await clients.aclose()
+    return written
+
+
+def _process(args: argparse.Namespace, index: int) -> None:
+    logging.basicConfig(level=args.log_level)
+    worker = f"{socket.gethostname()}-{os.getpid()}-{index}"
+    queue = LeaseQueue(args.queue, max_attempts=args.max_attempts)
+    try:
+        written = asyncio.run(
+            work(
+                queue,
+                ResultLog(args.output),
+                worker,
+                args.concurrency,
+                args.section_concurrency,
+            )
+        )
+    finally:
+        queue.close()
+    _LOGGER.info("Worker %s wrote %d jobs.", worker, written)
+
+
+def _shard(value: str) -> tuple[int, int]:
+    index, count = (int(part) for part in value.split("/"))
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError("shard is INDEX/COUNT, 0 <= INDEX < COUNT")
+    return index, count
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m docgen_agent.runner",
+        description="Write the reports of a JSONL job file.",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="write the jobs not done yet")
+    run.add_argument("jobs", help="JSONL file of topic/report_structure records")
+    run.add_argument("output", help="JSONL file the results are appended to")
+    run.add_argument("--processes", type=int, default=1)
+    run.add_argument(
+        "--concurrency",
+        type=int,
+        default=REPORT_CONCURRENCY,
+        help="reports in flight per process",
+    )
+    run.add_argument("--section-concurrency", type=int, default=SECTION_CONCURRENCY)
+    run.add_argument(
+        "--max-attempts",
+        type=int,
+        default=MAX_ATTEMPTS,
+        help="leases of a job before it fails; raise it to retry failed jobs",
+    )
+    status = commands.add_parser("status", help="show the progress of a job file")
+    status.add_argument("jobs")
+    for command in (run, status):
+        command.add_argument("--shard", type=_shard, help="INDEX/COUNT of the jobs")
+        command.add_argument(
+            "--queue", help="lease queue and ledger, by default next to the jobs"
+        )
+        command.add_argument("--log-level", default="INFO")
+    args = parser.parse_args(argv)
+    if args.queue is None:
+        # shards run side by side, each needs a ledger of its own
+        shard = "" if args.shard is None else ".shard-{}-of-{}".format(*args.shard)
+        args.queue = f"{args.jobs}{shard}.queue.sqlite"
+    logging.basicConfig(level=args.log_level)
+
+    if args.command == "status":
+        print(json.dumps(LeaseQueue(args.queue).progress()))
+        return
+
+    prepare(args.jobs, args.output, args.queue, args.shard, args.max_attempts).close()
+    if args.processes == 1:
+        _process(args, 0)
+    else:
+        # spawned, not forked: each worker opens its own connections
+        context = multiprocessing.get_context("spawn")
+        processes = [
+            context.Process(target=_process, args=(args, index))
+            for index in range(args.processes)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    queue = LeaseQueue(args.queue)
+    print(json.dumps(queue.progress()))
+    queue.close()
+
+
+if __name__ == "__main__":
+    main()
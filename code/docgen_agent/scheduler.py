@@ -0,0 +1,287 @@
+"""Shared rate limiting and concurrency control for model and search calls."""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import random
+import re
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Sequence, TypeVar
+
+from . import sources
+
+_LOGGER = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+_STATUS_PATTERN = re.compile(r"^\[(\d{3})\]")
+
+
+def estimate_tokens(messages: Sequence[Any] | str) -> int:
+    """Roughly estimate the prompt tokens of a message list (4 chars per token).
+
+    Source records a message carries count with the tokens they were measured at.
+    """
+    if isinstance(messages, str):
+        return len(messages) // 4 + 1
+    chars = 0
+    tokens = 0
+    for message in messages:
+        content = (
+            message.get("content", "")
+            if isinstance(message, dict)
+            else getattr(message, "content", "")
+        )
+        chars += len(content) if isinstance(content, str) else len(str(content))
+        tokens += sum(source["tokens"] for source in sources.of(message))
+    return chars // 4 + 1 + tokens
+
+
+def status_code(err: BaseException) -> int | None:
+    """Find the HTTP status behind an error raised by one of our clients."""
+    for attr in ("status_code", "status"):
+        value = getattr(err, attr, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(err, "response", None)
+    value = getattr(response, "status_code", None) or getattr(response, "status", None)
+    if isinstance(value, int):
+        return value
+    if type(err).__name__ == "UsageLimitExceededError":
+        # tavily raises this for HTTP 429
+        return 429
+    # ChatNVIDIA raises bare exceptions formatted as "[status] title\ndetail"
+    match = _STATUS_PATTERN.match(str(err))
+    return int(match.group(1)) if match else None
+
+
+def retry_after(err: BaseException) -> float | None:
+    """Read the server's requested delay from an error, if it sent one."""
+    seconds = getattr(err, "retry_after_seconds", None)
+    if seconds is not None:
+        return float(seconds)
+    headers = getattr(getattr(err, "response", None), "headers", None) or {}
+    value = headers.get("Retry-After") or headers.get("retry-after")
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class TokenBucket:
+    """A token bucket that refills continuously at a per-minute rate."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.per_minute = per_minute
+        self._tokens = per_minute
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.per_minute / 60
+        )
+        self._updated = now
+
+    def delay(self, amount: float) -> float:
+        """Take amount from the bucket, returning how long the caller must wait."""
+        self._refill()
+        amount = min(amount, self.capacity)
+        self._tokens -= amount
+        if self._tokens >= 0:
+            return 0.0
+        return -self._tokens * 60 / self.per_minute
+
+
+class Scheduler:
+    """Admit calls within request, token and in-flight limits, retrying on 429.
+
+    The request rate adapts to the server: every 429 halves it and every
+    success restores a little of the configured rate. A 429 also pauses all
+    callers until the Retry-After delay (or a jittered backoff) passes. Other
+    failures are left to the caller; see resilience.run.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        requests_per_minute: float,
+        tokens_per_minute: float | None = None,
+        max_in_flight: int = 8,
+        max_retries: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+    ):
+        self.name = name
+        self.requests_per_minute = requests_per_minute
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.rate_limited = 0
+        self._paused_until = 0.0
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._semaphore: asyncio.Semaphore | None = None
+        self._admission: asyncio.Lock | None = None
+
+    def _primitives(self) -> tuple[asyncio.Semaphore, asyncio.Lock]:
+        # asyncio primitives are bound to one loop and write_report starts a
+        # new loop per call, so recreate them when the loop changes
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._semaphore is None or self._admission is None:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+            self._admission = asyncio.Lock()
+        return self._semaphore, self._admission
+
+    async def _admit(self, tokens: int) -> None:
+        _, admission = self._primitives()
+        async with admission:
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            wait = self.requests.delay(1)
+            if self.tokens is not None and tokens:
+                wait = max(wait, self.tokens.delay(tokens))
+            if wait > 0:
+                _LOGGER.debug("%s scheduler waiting %.1fs for quota.", self.name, wait)
+                await asyncio.sleep(wait)
+
+    @property
+    def paused_for(self) -> float:
+        """Seconds until callers may send again after a 429."""
+        return max(0.0, self._paused_until - time.monotonic())
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def _slow_down(self) -> None:
+        rate = max(1.0, self.requests.per_minute / 2)
+        self.requests.per_minute = rate
+
+    def _speed_up(self) -> None:
+        if self.requests.per_minute < self.requests_per_minute:
+            self.requests.per_minute = min(
+                self.requests_per_minute,
+                self.requests.per_minute + self.requests_per_minute / 20,
+            )
+
+    async def run(self, call: Callable[[], Awaitable[T]], tokens: int = 0) -> T:
+        """Run call once quota allows, retrying when the server reports a 429."""
+        attempt = 0
+        while True:
+            await self._admit(tokens)
+            semaphore, _ = self._primitives()
+            async with semaphore:
+                try:
+                    result = await call()
+                except Exception as err:
+                    if status_code(err) != 429:
+                        raise
+                    self.rate_limited += 1
+                    if attempt >= self.max_retries:
+                        raise
+                    delay = retry_after(err)
+                    if delay is None:
+                        delay = self._backoff(attempt)
+                    attempt += 1
+                    _LOGGER.warning(
+                        "%s call rate limited, retrying in %.1fs (attempt %d of %d).",
+                        self.name,
+                        delay,
+                        attempt,
+                        self.max_retries,
+                    )
+                else:
+                    self._speed_up()
+                    return result
+            # the quota is shared, so every caller waits out the overload
+            self._slow_down()
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+
+
+class PrioritySlots:
+    """A fixed number of slots handed to waiters lowest priority value first.
+
+    Used to share section writers between concurrent reports: sections of the
+    reports started earliest go first, so those reports finish and stream back
+    while later ones are still researching and planning.
+    """
+
+    def __init__(self, slots: int):
+        self.slots = slots
+        self._free = slots
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._order = itertools.count()
+
+    def _wake(self) -> None:
+        while self._free and self._waiters:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                self._free -= 1
+                waiter.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, priority: int = 0) -> AsyncIterator[None]:
+        """Hold one slot for the duration of the block."""
+        if self._free and not self._waiters:
+            self._free -= 1
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiters, (priority, next(self._order), waiter))
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # the slot was granted as we were cancelled; pass it on
+                    self._free += 1
+                    self._wake()
+                raise
+        try:
+            yield
+        finally:
+            self._free += 1
+            self._wake()
+
+
+def _env_number(name: str, default: float) -> float:
+    return float(os.getenv(name, default))
+
+
+def _llm_scheduler(name: str) -> Scheduler:
+    return Scheduler(
+        name,
+        requests_per_minute=_env_number("LLM_REQUESTS_PER_MINUTE", 40),
+        tokens_per_minute=_env_number("LLM_TOKENS_PER_MINUTE", 400_000),
+        # THROTTLE_LLM_CALLS=1 keeps its old meaning of one model call at a time
+        max_in_flight=(
+            1
+            if os.getenv("THROTTLE_LLM_CALLS", "0") == "1"
+            else int(_env_number("LLM_MAX_IN_FLIGHT", 8))
+        ),
+    )
+
+
+llm_scheduler = _llm_scheduler("llm")
+# NVIDIA rate limits every model on its own, so routed calls queue per model,
+# each model with the LLM_* limits above.
+model_schedulers: dict[str, Scheduler] = {}
+search_scheduler = Scheduler(
+    "search",
+    requests_per_minute=_env_number("SEARCH_REQUESTS_PER_MINUTE", 100),
+    max_in_flight=int(_env_number("SEARCH_MAX_IN_FLIGHT", 10)),
+)
+
+
+def model_scheduler(model: str) -> Scheduler:
+    """The scheduler for calls to one model."""
+    limiter = model_schedulers.get(model)
+    if limiter is None:
+        limiter = model_schedulers.setdefault(model, _llm_scheduler(f"llm {model}"))
+    return limiter
@@ -0,0 +1,317 @@
+"""A cross-report index of researched sections, for near-duplicate topics.
+
+The section memo only matches a section with exactly the same outline, and
+planners phrase the same section a little differently for every paraphrase of
+a topic. Here researched sections are kept with the sources they were written
+from, under an embedding of their topic and description, so a section named
+differently in a paraphrased outline still finds them. A fresh match under
+exactly the same name is reused, any other is refreshed from its sources in a
+single writing call, without research. Sections of the run doing the lookup
+are never candidates, and neither is a section whose description is the same
+template filled in for a differently named subject, so siblings do not stand
+in for each other.
+
+Small indexes are searched exhaustively with NumPy. From ANN_MIN_ENTRIES
+entries on, random hyperplane LSH narrows the search to a few buckets.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Sequence
+
+from . import cache, ranking, sources
+from .author import Section
+from .research import terms
+
+try:
+    import numpy as np
+except ImportError:  # the index needs numpy, without it nothing is reused
+    np = None  # type: ignore[assignment]
+
+_LOGGER = logging.getLogger(__name__)
+
+if np is None:
+    _LOGGER.warning("numpy is not installed, sections are not reused across reports.")
+
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE", "1") == "1"
+# Cosine similarity of topic and section text a match needs.
+SIMILARITY_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.9"))
+# A match younger than this is reused as it is, an older one is refreshed, and
+# one older than MAX_AGE_SECONDS is ignored and eventually deleted.
+FRESH_SECONDS = float(os.getenv("SEMANTIC_CACHE_FRESH", str(24 * 3600)))
+MAX_AGE_SECONDS = float(os.getenv("SEMANTIC_CACHE_MAX_AGE", str(7 * 24 * 3600)))
+ANN_MIN_ENTRIES = int(os.getenv("SEMANTIC_CACHE_ANN_MIN", "4096"))
+LSH_TABLES = 16
+LSH_BITS = 10
+# Without an embedding model, texts are embedded as hashed word and word pair
+# counts, which only finds near-verbatim repeats.
+HASHED_DIMENSIONS = 1024
+CANDIDATES = 5
+
+INDEX_PATH = cache.CACHE_DIR / "semantic_sections.sqlite"
+
+
+@dataclass
+class Match:
+    section: Section
+    sources: list[sources.SourceRecord]
+    similarity: float
+    age: float
+
+    @property
+    def fresh(self) -> bool:
+        return self.age <= FRESH_SECONDS
+
+
+def _hashed(texts: Sequence[str]) -> Any:
+    vectors = np.zeros((len(texts), HASHED_DIMENSIONS), dtype=np.float32)
+    for row, text in enumerate(texts):
+        words = terms(text)
+        for feature in [*words, *map(" ".join, zip(words, words[1:]))]:
+            digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+            value = int.from_bytes(digest, "big")
+            sign = 1.0 if value >> 63 else -1.0
+            vectors[row, value % HASHED_DIMENSIONS] += sign
+    norms = np.linalg.norm(vectors, axis=1)
+    norms[norms == 0] = 1.0
+    return vectors / norms[:, None]
+
+
+def embed(texts: Sequence[str]) -> tuple[str, Any]:
+    """The name of the embedder used and the unit-length vectors of texts."""
+    vectors = ranking.embed(texts)
+    if vectors is not None:
+        return ranking.EMBEDDING_MODEL, vectors
+    return "hashed-terms", _hashed(texts)
+
+
+def _text(topic: str, section: Section) -> str:
+    # the name only stands in for a missing description
+    return f"{topic}\n{section.description or section.name}"
+
+
+def normalize_name(name: str) -> str:
+    """A section name without case, punctuation or spacing differences."""
+    return " ".join(re.findall(r"\w+", name.lower()))
+
+
+def same_subject(stored: Section, section: Section) -> bool:
+    """Whether a stored section with a close description is about section.
+
+    Descriptions filled in from one template for several subjects match
+    closely, and only the names tell those sections apart.
+    """
+    if normalize_name(stored.name) == normalize_name(section.name):
+        return True
+    if normalize_name(stored.description) != normalize_name(section.description):
+        return True
+    _, vectors = embed([stored.name, section.name])
+    return float(vectors[0] @ vectors[1]) >= SIMILARITY_THRESHOLD
+
+
+class _LSH:
+    """Random hyperplane buckets of vectors, for approximate cosine search."""
+
+    def __init__(self, dimensions: int):
+        rng = np.random.default_rng(0)
+        self.planes = rng.standard_normal(
+            (LSH_TABLES, LSH_BITS, dimensions), dtype=np.float32
+        )
+        self.weights = 1 << np.arange(LSH_BITS)
+        self.buckets: list[dict[int, list[int]]] = [{} for _ in range(LSH_TABLES)]
+
+    def _signatures(self, vectors: Any) -> Any:
+        bits = np.einsum("tbd,nd->ntb", self.planes, vectors) > 0
+        return bits @ self.weights
+
+    def add(self, start: int, vectors: Any) -> None:
+        for offset, signatures in enumerate(self._signatures(vectors)):
+            for table, signature in enumerate(signatures):
+                self.buckets[table].setdefault(int(signature), []).append(
+                    start + offset
+                )
+
+    def candidates(self, vector: Any) -> list[int]:
+        found: set[int] = set()
+        for table, signature in enumerate(self._signatures(vector[None, :])[0]):
+            found.update(self.buckets[table].get(int(signature), ()))
+        return sorted(found)
+
+
+class SectionIndex:
+    """Researched sections by embedding, in a SQLite file shared by processes."""
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._conn: sqlite3.Connection | None = None
+        self._model: str | None = None
+        self._ids: list[int] = []
+        self._created: list[float] = []
+        self._vectors: Any = None
+        self._last_id = 0
+        self._lsh: _LSH | None = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sections ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " key TEXT UNIQUE NOT NULL,"
+                " model TEXT NOT NULL,"
+                " vector BLOB NOT NULL,"
+                " section TEXT NOT NULL,"
+                " sources TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " run TEXT)"
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(sections)")}
+            if "run" not in columns:
+                conn.execute("ALTER TABLE sections ADD COLUMN run TEXT")
+            conn.execute(
+                "DELETE FROM sections WHERE created_at < ?",
+                (time.time() - MAX_AGE_SECONDS,),
+            )
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _load(self, model: str) -> None:
+        """Bring the in-memory vectors up to date with the file."""
+        conn = self._connect()
+        if model != self._model:
+            self._model, self._ids, self._created = model, [], []
+            self._vectors, self._last_id, self._lsh = None, 0, None
+        rows = conn.execute(
+            "SELECT id, vector, created_at FROM sections"
+            " WHERE id > ? AND model = ? ORDER BY id",
+            (self._last_id, model),
+        ).fetchall()
+        if not rows:
+            return
+        self._last_id = rows[-1][0]
+        added = np.stack([np.frombuffer(row[1], dtype=np.float32) for row in rows])
+        start = len(self._ids)
+        self._ids += [row[0] for row in rows]
+        self._created += [row[2] for row in rows]
+        self._vectors = (
+            added if self._vectors is None else np.concatenate([self._vectors, added])
+        )
+        if self._lsh is not None:
+            self._lsh.add(start, added)
+        elif len(self._ids) >= ANN_MIN_ENTRIES:
+            self._lsh = _LSH(self._vectors.shape[1])
+            self._lsh.add(0, self._vectors)
+
+    def _nearest(self, vector: Any) -> list[tuple[int, float]]:
+        """Row positions of the closest vectors and their similarity, best first."""
+        if self._vectors is None:
+            return []
+        if self._lsh is None:
+            positions = np.arange(len(self._ids))
+        else:
+            positions = np.asarray(self._lsh.candidates(vector), dtype=np.int64)
+        if not len(positions):
+            return []
+        similarities = self._vectors[positions] @ vector
+        order = np.argsort(-similarities)[:CANDIDATES]
+        return [(int(positions[i]), float(similarities[i])) for i in order]
+
+    def lookup(
+        self, topic: str, section: Section, run: str | None = None
+    ) -> Match | None:
+        """The stored section closest to section's description, if close enough.
+
+        Sections added by run, the report doing the lookup, are left out.
+        """
+        if not SEMANTIC_CACHE_ENABLED or np is None:
+            return None
+        model, vectors = embed([_text(topic, section)])
+        try:
+            return self._lookup(model, vectors[0], section, run)
+        except (OSError, sqlite3.Error) as err:
+            _LOGGER.warning("Section index unavailable: %s", err)
+            return None
+
+    def _lookup(
+        self, model: str, vector: Any, section: Section, run: str | None
+    ) -> Match | None:
+        now = time.time()
+        with self._lock:
+            self._load(model)
+            for position, similarity in self._nearest(vector):
+                if similarity < SIMILARITY_THRESHOLD:
+                    break
+                age = now - self._created[position]
+                if age > MAX_AGE_SECONDS:
+                    continue
+                row = (
+                    self._connect()
+                    .execute(
+                        "SELECT section, sources, run FROM sections WHERE id = ?",
+                        (self._ids[position],),
+                    )
+                    .fetchone()
+                )
+                # replaced by a newer version of the same section since
+                if row is None or (run is not None and row[2] == run):
+                    continue
+                stored = Section.model_validate_json(row[0])
+                if stored.research != section.research or not same_subject(
+                    stored, section
+                ):
+                    continue
+                return Match(stored, json.loads(row[1]), similarity, age)
+        return None
+
+    def add(
+        self,
+        topic: str,
+        section: Section,
+        messages: Sequence[Any],
+        run: str | None = None,
+    ) -> None:
+        """Remember a section written by run with the sources messages carried."""
+        if not SEMANTIC_CACHE_ENABLED or np is None or not section.content:
+            return
+        found: dict[str, sources.SourceRecord] = {}
+        for message in messages:
+            for source in sources.of(message):
+                found.setdefault(source["url"], source)
+        model, vectors = embed([_text(topic, section)])
+        try:
+            with self._lock:
+                conn = self._connect()
+                conn.execute(
+                    "INSERT OR REPLACE INTO sections"
+                    " (key, model, vector, section, sources, created_at, run)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        cache.make_key(
+                            "semantic", model, topic, section.name, section.description
+                        ),
+                        model,
+                        np.asarray(vectors[0], dtype=np.float32).tobytes(),
+                        section.model_dump_json(),
+                        json.dumps(list(found.values())),
+                        time.time(),
+                        run,
+                    ),
+                )
+                conn.commit()
+        except (OSError, sqlite3.Error) as err:
+            _LOGGER.warning("Could not add to the section index: %s", err)
+
+
+sections = SectionIndex(INDEX_PATH)
@@ -0,0 +1,502 @@
+"""An async HTTP service writing reports and answering questions.
+
+Run it from the code directory with ``python -m docgen_agent.server``. One
+warm process serves every client: report jobs go to a bounded queue and are
+written by a shared pool of workers, which also share the section writers,
+rate limiters, caches and pooled connections.
+
+    POST   /reports             {"topic", "report_structure"} -> 202, the job
+    GET    /reports/{id}        the job, with its report once it is done
+    GET    /reports/{id}/events the job's progress as Server-Sent Events
+    DELETE /reports/{id}        cancel the job
+    POST   /ask                 {"question", "document", "number_of_queries"}
+    GET    /metrics             Prometheus metrics
+    GET    /healthz
+
+Requests are made on behalf of the tenant named by the X-Tenant-ID header.
+Queued jobs are handed to workers round-robin across tenants, so a tenant
+submitting many reports waits its turn behind the others. A full queue, or a
+tenant's full share of it, is answered with a 429 and a Retry-After header.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextlib import AsyncExitStack
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator
+
+from aiohttp import web
+from langgraph.graph.state import CompiledStateGraph
+
+from . import (
+    REPORT_CONCURRENCY,
+    SECTION_CONCURRENCY,
+    ask,
+    checkpoint,
+    clients,
+    open_durable_graph,
+    report_events,
+    run_config,
+    scheduler,
+    telemetry,
+)
+from .agent import AgentState
+
+_LOGGER = logging.getLogger(__name__)
+
+HOST = os.getenv("DOCGEN_HOST", "0.0.0.0")
+PORT = int(os.getenv("DOCGEN_PORT", "8000"))
+# Report jobs waiting for a worker, in all and per tenant.
+QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "64"))
+TENANT_QUEUE_SIZE = int(os.getenv("TENANT_QUEUE_SIZE", "16"))
+ASK_CONCURRENCY = int(os.getenv("ASK_CONCURRENCY", "8"))
+# Ask requests waiting for one of the ASK_CONCURRENCY slots.
+ASK_QUEUE_SIZE = int(os.getenv("ASK_QUEUE_SIZE", "32"))
+# How long finished jobs stay around for clients to collect.
+JOB_TTL = float(os.getenv("JOB_TTL", "3600"))
+RETRY_AFTER = int(os.getenv("RETRY_AFTER", "10"))
+TENANT_HEADER = "X-Tenant-ID"
+# Token events a slow event stream may fall behind by before it misses some.
+_STREAM_BACKLOG = 1000
+_KEEP_ALIVE = 15.0
+_DONE = ("done", "failed", "cancelled")
+
+
+class QueueFull(Exception):
+    """The job queue, or the tenant's share of it, is full."""
+
+
+@dataclass
+class Job:
+    """A report job and the progress events it has published."""
+
+    id: str
+    tenant: str
+    topic: str
+    report_structure: str
+    status: str = "queued"
+    created: float = field(default_factory=time.time)
+    started: float | None = None
+    finished: float | None = None
+    report: str | None = None
+    error: str | None = None
+    summary: dict[str, Any] | None = None
+    # every event but the tokens, replayed to streams that connect late
+    events: list[dict[str, Any]] = field(default_factory=list)
+    task: asyncio.Task | None = None
+    _streams: set[asyncio.Queue] = field(default_factory=set)
+
+    def publish(self, event: dict[str, Any]) -> None:
+        token = event["type"] == "token"
+        if not token:
+            self.events.append(event)
+        for stream in self._streams:
+            if not (token and stream.qsize() >= _STREAM_BACKLOG):
+                stream.put_nowait(event)
+
+    def finish(self, status: str, error: str | None = None) -> None:
+        self.status = status
+        self.error = error
+        self.finished = time.time()
+        self.publish({"type": "status", **self.as_dict(report=False)})
+        for stream in self._streams:
+            stream.put_nowait(None)
+
+    async def follow(self) -> AsyncIterator[dict[str, Any] | None]:
+        """The job's events so far, then each new one until the job is done.
+
+        Yields None while nothing happens for a while, to keep the
+        connection alive.
+        """
+        stream: asyncio.Queue = asyncio.Queue()
+        self._streams.add(stream)
+        try:
+            for event in list(self.events):
+                yield event
+            if self.status in _DONE:
+                return
+            while True:
+                try:
+                    event = await asyncio.wait_for(stream.get(), _KEEP_ALIVE)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                if event is None:
+                    return
+                yield event
+        finally:
+            self._streams.discard(stream)
+
+    def as_dict(self, report: bool = True) -> dict[str, Any]:
+        job = {
+            "id": self.id,
+            "tenant": self.tenant,
+            "topic": self.topic,
+            "status": self.status,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "error": self.error,
+        }
+        if report:
+            job["report"] = self.report
+            job["summary"] = self.summary
+        return job
+
+
+class FairQueue:
+    """A bounded queue of jobs handed out round-robin across tenants."""
+
+    def __init__(self, max_size: int, tenant_size: int):
+        self.max_size = max_size
+        self.tenant_size = tenant_size
+        self._tenants: OrderedDict[str, deque[Job]] = OrderedDict()
+        self._size = 0
+        self._ready = asyncio.Semaphore(0)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def depth(self, tenant: str) -> int:
+        return len(self._tenants.get(tenant, ()))
+
+    def put(self, job: Job) -> None:
+        if self._size >= self.max_size:
+            raise QueueFull("The job queue is full.")
+        if self.depth(job.tenant) >= self.tenant_size:
+            raise QueueFull(f"Tenant {job.tenant} has its share of the queue.")
+        self._tenants.setdefault(job.tenant, deque()).append(job)
+        self._size += 1
+        self._gauge(job.tenant)
+        self._ready.release()
+
+    def remove(self, job: Job) -> bool:
+        """Take a job out of the queue, returning whether it was queued."""
+        jobs = self._tenants.get(job.tenant)
+        if jobs is None or job not in jobs:
+            return False
+        jobs.remove(job)
+        if not jobs:
+            del self._tenants[job.tenant]
+        self._size -= 1
+        self._gauge(job.tenant)
+        return True
+
+    async def get(self) -> Job:
+        """The next job of the tenant whose turn it is."""
+        await self._ready.acquire()
+        # a removed job leaves its permit behind
+        while not self._tenants:
+            await self._ready.acquire()
+        tenant, jobs = next(iter(self._tenants.items()))
+        job = jobs.popleft()
+        if jobs:
+            self._tenants.move_to_end(tenant)
+        else:
+            del self._tenants[tenant]
+        self._size -= 1
+        self._gauge(tenant)
+        return job
+
+    def _gauge(self, tenant: str) -> None:
+        telemetry.metrics.set(
+            "docgen_service_queued_jobs", self.depth(tenant), tenant=tenant
+        )
+
+
+class ReportService:
+    """The job queue and the workers writing its reports."""
+
+    def __init__(
+        self,
+        workers: int = REPORT_CONCURRENCY,
+        section_concurrency: int = SECTION_CONCURRENCY,
+        queue_size: int = QUEUE_SIZE,
+        tenant_queue_size: int = TENANT_QUEUE_SIZE,
+    ):
+        self.workers = workers
+        self.queue = FairQueue(queue_size, tenant_queue_size)
+        self.jobs: dict[str, Job] = {}
+        self.section_slots = scheduler.PrioritySlots(section_concurrency)
+        self._ask_slots = asyncio.Semaphore(ASK_CONCURRENCY)
+        self._asks = 0
+        self._order = 0
+        self.running = 0
+        self._stopped = False
+        self._tasks: list[asyncio.Task] = []
+        self._resources = AsyncExitStack()
+        self._graph: CompiledStateGraph | None = None
+
+    async def start(self) -> None:
+        self._graph = await self._resources.enter_async_context(open_durable_graph())
+        await clients.warm_up()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        _LOGGER.info("Started %d report workers.", self.workers)
+
+    async def stop(self) -> None:
+        self._stopped = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self._resources.aclose()
+        await clients.aclose()
+
+    def submit(self, tenant: str, topic: str, report_structure: str) -> Job:
+        """Queue a report job, raising QueueFull when there is no room."""
+        self._expire()
+        job = Job(uuid.uuid4().hex, tenant, topic, report_structure)
+        self.queue.put(job)
+        self.jobs[job.id] = job
+        telemetry.metrics.inc(
+            "docgen_service_jobs_total", tenant=tenant, status="queued"
+        )
+        return job
+
+    def cancel(self, job: Job) -> None:
+        if job.task is not None:
+            job.task.cancel()
+        elif job.status == "queued":
+            # its place and the tenant's share of the queue go to other jobs
+            self.queue.remove(job)
+            job.finish("cancelled")
+            telemetry.metrics.inc(
+                "docgen_service_jobs_total", tenant=job.tenant, status=job.status
+            )
+
+    async def ask(self, question: str, document: str, number_of_queries: int) -> str:
+        """Answer a question about a document, raising QueueFull when busy."""
+        if self._asks >= ASK_CONCURRENCY + ASK_QUEUE_SIZE:
+            raise QueueFull("Too many questions waiting.")
+        self._asks += 1
+        try:
+            async with self._ask_slots:
+                state = await ask.graph.ainvoke(
+                    ask.ResearcherState(
+                        topic=question,
+                        document=document,
+                        number_of_queries=number_of_queries,
+                    )
+                )
+        finally:
+            self._asks -= 1
+        return str(state["messages"][-1].content)
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self.queue.get()
+            if job.status != "queued":
+                continue
+            job.task = asyncio.current_task()
+            self.running += 1
+            telemetry.metrics.set("docgen_service_running_jobs", self.running)
+            try:
+                await self._run(job)
+            except asyncio.CancelledError:
+                job.finish("cancelled")
+                if self._stopped:
+                    raise
+                # only the job was cancelled, the worker carries on
+                job.task.uncancel()
+            finally:
+                job.task = None
+                self.running -= 1
+                telemetry.metrics.set("docgen_service_running_jobs", self.running)
+                telemetry.metrics.inc(
+                    "docgen_service_jobs_total", tenant=job.tenant, status=job.status
+                )
+
+    async def _run(self, job: Job) -> None:
+        assert self._graph is not None
+        job.status = "running"
+        job.started = time.time()
+        telemetry.metrics.observe(
+            "docgen_service_queue_seconds", job.started - job.created, tenant=job.tenant
+        )
+        job.publish({"type": "status", **job.as_dict(report=False)})
+        # reports are given section writers in the order they were started
+        self._order += 1
+        tracer = None
+        try:
+            async with telemetry.trace_run(job.id) as tracer:
+                config = run_config(job.id, tracer, self.section_slots, self._order)
+                state = AgentState(
+                    topic=job.topic, report_structure=job.report_structure
+                )
+                async for event in report_events(self._graph, state, config):
+                    job.publish(event)
+                snapshot = await self._graph.aget_state(config)
+            job.report = snapshot.values.get("report")
+            await asyncio.to_thread(checkpoint.clear, job.id)
+            job.publish({"type": "report", "report": job.report})
+            job.finish("done")
+        except Exception as err:
+            _LOGGER.error("Report job %s failed: %s", job.id, err)
+            job.finish("failed", str(err))
+        finally:
+            if tracer is not None:
+                job.summary = tracer.summary()
+
+    def _expire(self) -> None:
+        expired = time.time() - JOB_TTL
+        for job_id, job in list(self.jobs.items()):
+            if job.finished is not None and job.finished < expired:
+                del self.jobs[job_id]
+
+
+# ---------------------------
+# HTTP
+# ---------------------------
+def _tenant(request: web.Request) -> str:
+    return request.headers.get(TENANT_HEADER, "default")
+
+
+def _too_busy(request: web.Request, err: QueueFull) -> web.Response:
+    telemetry.metrics.inc(
+        "docgen_service_rejected_total", tenant=_tenant(request), path=request.path
+    )
+    return web.json_response(
+        {"error": str(err)},
+        status=429,
+        headers={"Retry-After": str(RETRY_AFTER)},
+    )
+
+
+async def _body(request: web.Request, *fields: str) -> dict[str, Any]:
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        raise web.HTTPBadRequest(reason="The request body is not JSON.")
+    if not isinstance(body, dict):
+        raise web.HTTPBadRequest(reason="The request body is not a JSON object.")
+    for name in fields:
+        if not isinstance(body.get(name), str) or not body[name].strip():
+            raise web.HTTPBadRequest(reason=f"{name} is required.")
+    return body
+
+
+def _job(request: web.Request) -> Job:
+    job = request.app["service"].jobs.get(request.match_info["job_id"])
+    if job is None:
+        raise web.HTTPNotFound(reason="No such job.")
+    return job
+
+
+async def submit_report(request: web.Request) -> web.Response:
+    body = await _body(request, "topic", "report_structure")
+    try:
+        job = request.app["service"].submit(
+            _tenant(request), body["topic"], body["report_structure"]
+        )
+    except QueueFull as err:
+        return _too_busy(request, err)
+    return web.json_response(
+        {**job.as_dict(report=False), "events": f"/reports/{job.id}/events"},
+        status=202,
+        headers={"Location": f"/reports/{job.id}"},
+    )
+
+
+async def get_report(request: web.Request) -> web.Response:
+    return web.json_response(_job(request).as_dict())
+
+
+async def cancel_report(request: web.Request) -> web.Response:
+    job = _job(request)
+    request.app["service"].cancel(job)
+    return web.json_response(job.as_dict(report=False), status=202)
+
+
+async def report_events(request: web.Request) -> web.StreamResponse:
+    job = _job(request)
+    stream = web.StreamResponse(
+        headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"}
+    )
+    await stream.prepare(request)
+    async for event in job.follow():
+        if event is None:
+            await stream.write(b": keep-alive\n\n")
+            continue
+        await stream.write(
+            f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode("utf-8")
+        )
+    await stream.write_eof()
+    return stream
+
+
+async def answer_question(request: web.Request) -> web.Response:
+    body = await _body(request, "question")
+    number_of_queries = body.get("number_of_queries", 0)
+    if not isinstance(number_of_queries, int) or number_of_queries < 0:
+        raise web.HTTPBadRequest(reason="number_of_queries must be a count.")
+    try:
+        answer = await request.app["service"].ask(
+            body["question"], str(body.get("document", "")), number_of_queries
+        )
+    except QueueFull as err:
+        return _too_busy(request, err)
+    return web.json_response({"answer": answer})
+
+
+async def get_metrics(request: web.Request) -> web.Response:
+    return web.Response(
+        text=telemetry.prometheus_text(),
+        content_type="text/plain",
+        headers={"X-Content-Type-Options": "nosniff"},
+    )
+
+
+async def healthz(request: web.Request) -> web.Response:
+    service = request.app["service"]
+    return web.json_response(
+        {"status": "ok", "queued": len(service.queue), "running": service.running}
+    )
+
+
+def create_app(service: ReportService | None = None) -> web.Application:
+    """The service's aiohttp application, starting the workers with the app."""
+    app = web.Application()
+    app["service"] = service or ReportService()
+
+    async def lifecycle(app: web.Application) -> AsyncIterator[None]:
+        await app["service"].start()
+        yield
+        await app["service"].stop()
+
+    app.cleanup_ctx.append(lifecycle)
+    app.add_routes(
+        [
+            web.post("/reports", submit_report),
+            web.get("/reports/{job_id}", get_report),
+            web.delete("/reports/{job_id}", cancel_report),
+            web.get("/reports/{job_id}/events", report_events),
+            web.post("/ask", answer_question),
+            web.get("/metrics", get_metrics),
+            web.get("/healthz", healthz),
+        ]
+    )
+    return app
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m docgen_agent.server",
+        description="Serve report jobs and questions over HTTP.",
+    )
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--workers", type=int, default=REPORT_CONCURRENCY)
+    parser.add_argument("--section-concurrency", type=int, default=SECTION_CONCURRENCY)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    service = ReportService(args.workers, args.section_concurrency)
+    web.run_app(create_app(service), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""Search results as typed source records, rendered to prompt text only once.
+
+Search tools return source records instead of formatted text. A message that
+carries records keeps them under "sources", next to its content, and
+context.fit renders them into the prompt when it assembles one, after it has
+compacted old rounds straight from the records.
+
+Token counts are approximate: they come from a general-purpose tokenizer, not
+the served model's own, and are only used for budgets with room to spare.
+"""
+
+import asyncio
+import logging
+import os
+import threading
+from typing import Any, Iterable, Sequence, TypedDict
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken only makes token counts closer
+    tiktoken = None  # type: ignore[assignment]
+
+_LOGGER = logging.getLogger(__name__)
+
+# Tokenizer for counting and truncating source content, an approximation of
+# the served model's. Until load_tokenizer has loaded it, or when its encoding
+# files cannot be downloaded, tokens are estimated at 4 characters each.
+TOKENIZER = os.getenv("SOURCE_TOKENIZER", "cl100k_base")
+
+_TRUNCATED = "... [truncated]"
+
+
+class SourceRecord(TypedDict):
+    url: str
+    title: str
+    # the excerpts of the source most relevant to the search
+    snippet: str
+    # the source's own content, cut to the token limit, or "" when not included
+    content: str
+    score: float
+    # tokens of the record as rendered into a prompt
+    tokens: int
+
+
+_encoding: Any = None
+_encoding_tried = False
+_encoding_lock = threading.Lock()
+
+
+def _load_encoding() -> None:
+    global _encoding, _encoding_tried
+    with _encoding_lock:
+        if _encoding_tried:
+            return
+        _encoding_tried = True
+        if tiktoken is None:
+            return
+        try:
+            # downloads the encoding files the first time
+            _encoding = tiktoken.get_encoding(TOKENIZER)
+        except Exception as err:
+            _LOGGER.warning("Tokenizer %s unavailable, estimating: %r", TOKENIZER, err)
+
+
+async def load_tokenizer() -> None:
+    """Load the tokenizer in a thread, once, keeping the event loop free."""
+    if not _encoding_tried:
+        await asyncio.to_thread(_load_encoding)
+
+
+def count_tokens(text: str) -> int:
+    """Approximate number of tokens of text."""
+    encoding = _encoding
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate(text: str, max_tokens: int) -> str:
+    """text cut to about max_tokens tokens, marked when it was cut."""
+    encoding = _encoding
+    if encoding is None:
+        limit = max_tokens * 4
+        return text if len(text) <= limit else text[:limit] + _TRUNCATED
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens]) + _TRUNCATED
+
+
+def _render_one(record: SourceRecord) -> str:
+    text = (
+        f"Source {record['title']}:\n===\n"
+        f"URL: {record['url']}\n===\n"
+        f"Most relevant content from source: {record['snippet']}\n===\n"
+    )
+    if record["content"]:
+        text += f"Full source content: {record['content']}\n"
+    return text
+
+
+def record(
+    url: str, title: str, snippet: str, content: str = "", score: float = 0.0
+) -> SourceRecord:
+    source = SourceRecord(
+        url=url, title=title, snippet=snippet, content=content, score=score, tokens=0
+    )
+    source["tokens"] = count_tokens(_render_one(source))
+    return source
+
+
+def render(records: Iterable[SourceRecord]) -> str:
+    """The prompt text of records."""
+    return "Sources:\n\n" + "\n".join(map(_render_one, records))
+
+
+def references(records: Sequence[SourceRecord]) -> str:
+    """References to records, standing in for their content."""
+    return "[Earlier search results, content removed to save space]\n" + "\n".join(
+        f"- {source['title']} ({source['url']})" for source in records
+    )
+
+
+def of(message: Any) -> list[SourceRecord]:
+    """The source records a message carries."""
+    if isinstance(message, dict):
+        return message.get("sources") or []
+    return (getattr(message, "additional_kwargs", None) or {}).get("sources") or []
+
+
+def text(message: Any) -> str:
+    """A message's content followed by the sources it carries, rendered."""
+    content = (
+        message.get("content", "")
+        if isinstance(message, dict)
+        else getattr(message, "content", "")
+    )
+    content = content if isinstance(content, str) else str(content)
+    records = of(message)
+    if not records:
+        return content
+    return f"{content}\n\n{render(records)}" if content else render(records)
+
+
+def without(message: Any, content: str) -> Any:
+    """message with new content and no source records."""
+    if isinstance(message, dict):
+        message = {**message, "content": content}
+        message.pop("sources", None)
+        return message
+    kwargs = {
+        key: value
+        for key, value in (message.additional_kwargs or {}).items()
+        if key != "sources"
+    }
+    return message.model_copy(update={"content": content, "additional_kwargs": kwargs})
+
+
+def assemble(messages: Sequence[Any]) -> list[Any]:
+    """messages as sent to the model, with their source records rendered."""
+    return [
+        without(message, text(message)) if of(message) else message
+        for message in messages
+    ]
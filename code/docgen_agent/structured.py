@@ -0,0 +1,271 @@
+"""Recover structured model output instead of regenerating it.
+
+A response that does not validate against its schema is parsed tolerantly,
+repaired where the fix is mechanical, and only the fields still missing or
+invalid are asked for again, in a short patch call. A malformed report plan
+then costs a patch call rather than a full regeneration of the plan.
+"""
+
+import json
+import logging
+import os
+import re
+from dataclasses import dataclass
+from typing import Any, Callable, Mapping, Sequence, TypeVar, get_args, get_origin
+
+from langchain_core.messages import BaseMessage
+from langchain_core.runnables import Runnable, RunnableConfig
+from langchain_core.utils.json import parse_partial_json
+from pydantic import BaseModel, TypeAdapter, ValidationError
+
+from . import routing, telemetry
+from .prompts import structured_patch_prompt
+
+_LOGGER = logging.getLogger(__name__)
+
+M = TypeVar("M", bound=BaseModel)
+
+# Constrain decoding to the schema where the endpoint supports it (NVIDIA NIM
+# guided_json); otherwise the schema is spelled out in the prompt.
+GUIDED_DECODING = os.getenv("GUIDED_DECODING", "1") == "1"
+PATCH_ATTEMPTS = int(os.getenv("STRUCTURED_PATCH_ATTEMPTS", "2"))
+
+_FENCE = re.compile(r"```(?:json)?\s*(.*?)(?:```|$)", re.DOTALL)
+_TRAILING_COMMA = re.compile(r",\s*([}\]])")
+
+
+def guided(schema: type[BaseModel]) -> Callable[[Runnable], Runnable]:
+    """Bind a chat model to answer in schema's JSON, keeping the raw message."""
+
+    def bind(llm: Runnable) -> Runnable:
+        if not GUIDED_DECODING:
+            return llm
+        return llm.bind(nvext={"guided_json": schema.model_json_schema()})
+
+    return bind
+
+
+def instructions(schema: type[BaseModel]) -> str:
+    """Prompt text asking for schema's JSON, for when decoding is not guided."""
+    if GUIDED_DECODING:
+        return ""
+    return (
+        "\n\nRespond with only a JSON object matching this JSON schema:\n"
+        + json.dumps(schema.model_json_schema())
+    )
+
+
+@dataclass
+class Parsed:
+    value: Any
+    # False when the response was cut off and its JSON had to be closed
+    complete: bool
+
+
+def parse_json(text: str) -> Parsed | None:
+    """The JSON value in a model response, tolerating what models wrap it in."""
+    # reasoning models think before they answer
+    text = text.rsplit("</think>", 1)[-1]
+    fenced = _FENCE.search(text)
+    if fenced:
+        text = fenced.group(1)
+    starts = [index for index in (text.find("{"), text.find("[")) if index >= 0]
+    if not starts:
+        return None
+    text = _TRAILING_COMMA.sub(r"\1", text[min(starts) :])
+    try:
+        # ignores whatever the model wrote after the JSON
+        return Parsed(json.JSONDecoder(strict=False).raw_decode(text)[0], True)
+    except json.JSONDecodeError:
+        pass
+    value = parse_partial_json(text)
+    return Parsed(value, False) if value is not None else None
+
+
+def _normalize(annotation: Any, value: Any) -> Any:
+    """value with its object keys matched to the field names of annotation."""
+    if get_origin(annotation) is list and isinstance(value, list):
+        (item,) = get_args(annotation)
+        return [_normalize(item, element) for element in value]
+    if not (
+        isinstance(annotation, type)
+        and issubclass(annotation, BaseModel)
+        and isinstance(value, dict)
+    ):
+        return value
+    fields = {name.lower(): name for name in annotation.model_fields}
+    normalized = {}
+    for key, element in value.items():
+        name = fields.get(str(key).strip().lower().replace(" ", "_"), key)
+        field = annotation.model_fields.get(name)
+        normalized[name] = (
+            _normalize(field.annotation, element) if field is not None else element
+        )
+    return normalized
+
+
+def _fill(annotation: Any, value: Any, defaults: Mapping[str, Any]) -> None:
+    """Set missing fields that have a known value, in place."""
+    if get_origin(annotation) is list and isinstance(value, list):
+        (item,) = get_args(annotation)
+        for element in value:
+            _fill(item, element, defaults)
+    elif (
+        isinstance(annotation, type)
+        and issubclass(annotation, BaseModel)
+        and isinstance(value, dict)
+    ):
+        for name, field in annotation.model_fields.items():
+            if name not in value and name in defaults:
+                value[name] = defaults[name]
+            elif name in value:
+                _fill(field.annotation, value[name], defaults)
+
+
+def _annotation_at(schema: type[BaseModel], path: Sequence[str | int]) -> Any:
+    """The type of the field at path in schema."""
+    annotation: Any = schema
+    for part in path:
+        if isinstance(part, int):
+            (annotation,) = get_args(annotation)
+        else:
+            annotation = annotation.model_fields[part].annotation
+    return annotation
+
+
+def _last_item(value: Any) -> tuple[str | int, ...] | None:
+    """The path of the last list item in value, the one a cut-off answer ends in."""
+    path: tuple[str | int, ...] = ()
+    last = None
+    while isinstance(value, (dict, list)) and value:
+        if isinstance(value, list):
+            path = (*path, len(value) - 1)
+            last = path
+            value = value[-1]
+        else:
+            key = next(reversed(value))
+            path = (*path, key)
+            value = value[key]
+    return last
+
+
+def _dotted(path: Sequence[str | int]) -> str:
+    return ".".join(map(str, path))
+
+
+def check(
+    schema: type[M], value: Any
+) -> tuple[M | None, dict[tuple[str | int, ...], str]]:
+    """Validate value, or list what is wrong with it by field path."""
+    try:
+        return schema.model_validate(value), {}
+    except ValidationError as err:
+        problems = {}
+        for error in err.errors():
+            path = tuple(error["loc"])
+            # a field of an item that is wrong as a whole needs no separate fix
+            if not any(path[: len(other)] == other for other in problems):
+                problems[path] = error["msg"]
+        return None, problems
+
+
+def _apply(value: Any, path: Sequence[str | int], patch: Any) -> None:
+    for part in path[:-1]:
+        value = value[part]
+    value[path[-1]] = patch
+
+
+async def _patch(
+    schema: type[BaseModel],
+    value: Any,
+    problems: dict[tuple[str | int, ...], str],
+    messages: Sequence[Any],
+    config: RunnableConfig | None,
+) -> dict[str, Any]:
+    """Ask the model for just the fields of value that problems lists."""
+    patch_schema = {
+        "type": "object",
+        "properties": {
+            _dotted(path): TypeAdapter(_annotation_at(schema, path)).json_schema()
+            for path in problems
+        },
+        "required": [_dotted(path) for path in problems],
+    }
+    prompt = structured_patch_prompt.format(
+        problems="\n".join(
+            f"- {_dotted(path)}: {msg}" for path, msg in problems.items()
+        ),
+        answer=json.dumps(value, indent=1),
+    )
+    # the system prompt says what the answer is for; the research the answer
+    # was written from is left out, the patch does not need it
+    system = [
+        message
+        for message in messages
+        if (message.get("role") if isinstance(message, dict) else message.type)
+        == "system"
+    ]
+    return await routing.invoke_model(
+        "structured_patch",
+        [*system, {"role": "user", "content": prompt}],
+        config,
+        bind=lambda llm: llm.with_structured_output(patch_schema),  # type: ignore
+        attempts=2,
+    )
+
+
+async def recover(
+    schema: type[M],
+    response: Any,
+    messages: Sequence[Any],
+    config: RunnableConfig | None = None,
+    *,
+    name: str,
+    defaults: Mapping[str, Any] | None = None,
+) -> M | None:
+    """The schema object in a model response, repaired and patched if need be.
+
+    messages are the ones the response answered; defaults are values for
+    fields, by name, that can be filled in without asking. Returns None when
+    nothing usable could be recovered, for the caller to regenerate.
+    """
+    text = response.content if isinstance(response, BaseMessage) else response
+    parsed = parse_json(text) if isinstance(text, str) else None
+    if parsed is None or not isinstance(parsed.value, dict):
+        _LOGGER.warning("No JSON object in the %s response.", name)
+        return None
+    value = _normalize(schema, parsed.value)
+    _fill(schema, value, defaults or {})
+    result, problems = check(schema, value)
+    if not parsed.complete:
+        # the last item may have been cut off anywhere, even between fields
+        # that happen to validate
+        last = _last_item(value)
+        if last is not None:
+            problems = {
+                path: msg for path, msg in problems.items() if path[: len(last)] != last
+            }
+            problems[last] = "cut off, give the whole item"
+            result = None
+    for attempt in range(PATCH_ATTEMPTS):
+        if result is not None:
+            return result
+        _LOGGER.info(
+            "Patching %d fields of the %s response: %s",
+            len(problems),
+            name,
+            ", ".join(map(_dotted, problems)),
+        )
+        telemetry.metrics.inc("docgen_structured_patches_total", node=name)
+        try:
+            patch = await _patch(schema, value, problems, messages, config)
+            for path in problems:
+                if isinstance(patch, dict) and _dotted(path) in patch:
+                    fixed = patch[_dotted(path)]
+                    _apply(value, path, _normalize(_annotation_at(schema, path), fixed))
+        except Exception as err:
+            _LOGGER.warning("Could not patch the %s response: %r", name, err)
+            return None
+        _fill(schema, value, defaults or {})
+        result, problems = check(schema, value)
+    return result
@@ -0,0 +1,768 @@
+"""Spans, token accounting and metrics for report runs.
+
+A RunTracer rides along in a run's callbacks and records a span for every
+graph node, section, model call and tool call. Finished spans feed the
+process-wide metrics, which can be read in the Prometheus text format or
+exported, together with the spans of a run, as OTLP JSON.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, AsyncIterator, Literal
+from uuid import UUID
+
+import httpx
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+from . import cache, resilience, scheduler
+
+_LOGGER = logging.getLogger(__name__)
+
+TELEMETRY_ENABLED = os.getenv("TELEMETRY", "1") == "1"
+# Where finished runs are exported: a directory to write metrics.prom,
+# metrics.json and traces.jsonl to, or the base URL of an OTLP/HTTP collector
+# such as http://localhost:4318. Nothing is exported when unset.
+TELEMETRY_EXPORT = os.getenv("TELEMETRY_EXPORT", "")
+SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "docgen-agent")
+# The run name agent._write_section gives each section's author graph run.
+SECTION_RUN_NAME = "section_writer"
+DURATION_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+SpanKind = Literal["run", "node", "section", "llm", "tool"]
+Labels = tuple[tuple[str, str], ...]
+
+_HELP = {
+    "docgen_reports_total": "Report runs by outcome.",
+    "docgen_report_duration_seconds": "Wall time of report runs.",
+    "docgen_node_duration_seconds": "Wall time of graph nodes, by node path.",
+    "docgen_section_duration_seconds": "Wall time of writing one section.",
+    "docgen_llm_requests_total": "Model calls by node, model and outcome.",
+    "docgen_llm_duration_seconds": "Latency of model calls, by node and model.",
+    "docgen_llm_tokens_total": "Prompt and completion tokens sent to the model.",
+    "docgen_tool_calls_total": "Tool calls by tool and outcome.",
+    "docgen_tool_duration_seconds": "Latency of tool calls, by tool.",
+    "docgen_model_fallbacks_total": "Calls moved to the next model of their route.",
+    "docgen_call_retries_total": "Retried attempts, by call site.",
+    "docgen_call_timeouts_total": "Timed out attempts, by call site.",
+    "docgen_call_hedges_total": "Hedged requests sent, by call site.",
+    "docgen_rate_limited_total": "Calls answered with a 429, by scheduler.",
+    "docgen_cache_hits_total": "Cache hits, by cache.",
+    "docgen_cache_misses_total": "Cache misses, by cache.",
+    "docgen_structured_patches_total": "Patch calls repairing structured output.",
+    "docgen_semantic_cache_total": "Cross-report section index lookups, by outcome.",
+    "docgen_service_jobs_total": "Report jobs of the HTTP service, by outcome.",
+    "docgen_service_rejected_total": "Requests turned away with a 429.",
+    "docgen_service_queue_seconds": "Time report jobs waited in the queue.",
+    "docgen_service_queued_jobs": "Report jobs waiting in the queue, by tenant.",
+    "docgen_service_running_jobs": "Report jobs being written.",
+}
+_OTLP_CLIENT_KINDS = ("llm", "tool")
+
+
+def _span_id() -> str:
+    return os.urandom(8).hex()
+
+
+def _trace_id(run_id: str) -> str:
+    """The run id when it is already a trace id, else one derived from it."""
+    if re.fullmatch(r"[0-9a-f]{32}", run_id):
+        return run_id
+    return hashlib.sha256(run_id.encode("utf-8")).hexdigest()[:32]
+
+
+def _node_path(checkpoint_ns: str) -> str:
+    """Turn "a:<task id>|<n>|b:<task id>" into "a/b"."""
+    return "/".join(
+        part.split(":")[0] for part in checkpoint_ns.split("|") if not part.isdigit()
+    )
+
+
+def _describe(error: BaseException) -> str:
+    if isinstance(error, asyncio.CancelledError):
+        return "cancelled"
+    return f"{type(error).__name__}: {error}"
+
+
+@dataclass
+class Span:
+    """One timed operation of a run."""
+
+    name: str
+    kind: SpanKind
+    span_id: str
+    parent_id: str | None
+    start: float
+    end: float | None = None
+    attributes: dict[str, Any] = field(default_factory=dict)
+    error: str | None = None
+
+    @property
+    def seconds(self) -> float:
+        return (self.end or time.time()) - self.start
+
+
+class _Histogram:
+    def __init__(self, buckets: tuple[float, ...]):
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+class Metrics:
+    """Process-wide counters and histograms, labelled like Prometheus series."""
+
+    def __init__(self, buckets: tuple[float, ...] = DURATION_BUCKETS):
+        self.buckets = buckets
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._counters: dict[str, dict[Labels, float]] = defaultdict(dict)
+        self._histograms: dict[str, dict[Labels, _Histogram]] = defaultdict(dict)
+        self._gauges: dict[str, dict[Labels, float]] = defaultdict(dict)
+
+    def inc(self, name: str, value: float = 1.0, **labels: Any) -> None:
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self._lock:
+            series = self._counters[name]
+            series[key] = series.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self._lock:
+            histogram = self._histograms[name].get(key)
+            if histogram is None:
+                histogram = self._histograms[name][key] = _Histogram(self.buckets)
+            bucket = next(
+                (i for i, bound in enumerate(self.buckets) if value <= bound),
+                len(self.buckets),
+            )
+            histogram.counts[bucket] += 1
+            histogram.sum += value
+            histogram.count += 1
+
+    def set(self, name: str, value: float, **labels: Any) -> None:
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self._lock:
+            self._gauges[name][key] = value
+
+    def counters(self) -> dict[str, dict[Labels, float]]:
+        """Every counter, including the ones kept by the call and cache layers."""
+        with self._lock:
+            counters = {name: dict(series) for name, series in self._counters.items()}
+        collected = [
+            (f"docgen_call_{counter}_total", (("call", call),), getattr(stats, counter))
+            for call, stats in resilience.stats.items()
+            for counter in ("retries", "timeouts", "hedges")
+        ]
+        collected += [
+            (
+                "docgen_rate_limited_total",
+                (("scheduler", limiter.name),),
+                limiter.rate_limited,
+            )
+            for limiter in (
+                scheduler.llm_scheduler,
+                scheduler.search_scheduler,
+                *scheduler.model_schedulers.values(),
+            )
+        ]
+        collected += [
+            (
+                f"docgen_cache_{counter}_total",
+                (("cache", name),),
+                getattr(backend.stats, counter),
+            )
+            for name, backend in _caches().items()
+            for counter in ("hits", "misses")
+        ]
+        for name, labels, value in collected:
+            counters.setdefault(name, {})[labels] = value
+        return counters
+
+    def histograms(self) -> dict[str, dict[Labels, _Histogram]]:
+        with self._lock:
+            return {name: dict(series) for name, series in self._histograms.items()}
+
+    def gauges(self) -> dict[str, dict[Labels, float]]:
+        with self._lock:
+            return {name: dict(series) for name, series in self._gauges.items()}
+
+
+metrics = Metrics()
+
+
+def _caches() -> dict[str, cache.CacheBackend]:
+    # imported here as tools pulls in the clients and the model settings
+    from . import memo, tools
+
+    return {
+        "llm_responses": cache.response_store,
+        "search": tools.search_cache,
+        "section_memo": memo.sections,
+    }
+
+
+class RunTracer(BaseCallbackHandler):
+    """Records the spans of one report run from its callbacks.
+
+    Nodes, sections, model calls and tool calls become spans; every other
+    runnable is skipped, its children hanging off the nearest recorded span.
+    A failed model call attempt is kept as a span with its error, so retries
+    show up as siblings of the attempt that succeeded.
+    """
+
+    # the callbacks only do bookkeeping, so run them on the event loop
+    run_inline = True
+
+    def __init__(self, run_id: str, name: str = "report"):
+        self.run_id = run_id
+        self.trace_id = _trace_id(run_id)
+        self.root = Span(
+            name, "run", _span_id(), None, time.time(), attributes={"run.id": run_id}
+        )
+        self.spans: list[Span] = [self.root]
+        self._open: dict[UUID, Span] = {}
+        # run id -> span id of its nearest recorded ancestor, or its own span
+        self._parents: dict[UUID, str] = {}
+
+    # ---------------------------
+    # SPAN BOOKKEEPING
+    # ---------------------------
+    def _parent(self, parent_run_id: UUID | None) -> str:
+        if parent_run_id is None:
+            return self.root.span_id
+        return self._parents.get(parent_run_id, self.root.span_id)
+
+    def _begin(
+        self,
+        run_id: UUID,
+        parent_run_id: UUID | None,
+        name: str,
+        kind: SpanKind,
+        metadata: dict[str, Any] | None,
+        **attributes: Any,
+    ) -> Span:
+        metadata = metadata or {}
+        if metadata.get("langgraph_checkpoint_ns"):
+            attributes["node.path"] = _node_path(metadata["langgraph_checkpoint_ns"])
+        if metadata.get("section_index") is not None:
+            attributes["section.index"] = metadata["section_index"]
+        span = Span(
+            name,
+            kind,
+            _span_id(),
+            self._parent(parent_run_id),
+            time.time(),
+            attributes=attributes,
+        )
+        self._open[run_id] = span
+        self._parents[run_id] = span.span_id
+        self.spans.append(span)
+        return span
+
+    def _finish(self, run_id: UUID, error: BaseException | None = None) -> Span | None:
+        self._parents.pop(run_id, None)
+        span = self._open.pop(run_id, None)
+        if span is not None:
+            span.end = time.time()
+            if error is not None:
+                span.error = _describe(error)
+        return span
+
+    # ---------------------------
+    # CALLBACKS
+    # ---------------------------
+    def on_chain_start(
+        self,
+        serialized: dict[str, Any] | None,
+        inputs: Any,
+        *,
+        run_id: UUID,
+        parent_run_id: UUID | None = None,
+        metadata: dict[str, Any] | None = None,
+        **kwargs: Any,
+    ) -> None:
+        metadata = metadata or {}
+        name = kwargs.get("name")
+        if name == SECTION_RUN_NAME:
+            self._begin(
+                run_id,
+                parent_run_id,
+                f"section {metadata.get('section_index')}",
+                "section",
+                metadata,
+                **{"section.description": metadata.get("section_description", "")},
+            )
+        # conditional edges run with their node's metadata but their own name
+        elif name and name == metadata.get("langgraph_node") and name[:2] != "__":
+            self._begin(run_id, parent_run_id, name, "node", metadata)
+        else:
+            self._parents[run_id] = self._parent(parent_run_id)
+
+    def on_chain_end(self, outputs: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end_chain(self._finish(run_id))
+
+    def on_chain_error(
+        self, error: BaseException, *, run_id: UUID, **kwargs: Any
+    ) -> None:
+        self._end_chain(self._finish(run_id, error))
+
+    def _end_chain(self, span: Span | None) -> None:
+        if span is None:
+            return
+        if span.kind == "section":
+            metrics.observe("docgen_section_duration_seconds", span.seconds)
+        else:
+            metrics.observe(
+                "docgen_node_duration_seconds",
+                span.seconds,
+                node=span.attributes.get("node.path", span.name),
+            )
+
+    def on_chat_model_start(
+        self,
+        serialized: dict[str, Any] | None,
+        messages: list[list[Any]],
+        *,
+        run_id: UUID,
+        parent_run_id: UUID | None = None,
+        metadata: dict[str, Any] | None = None,
+        **kwargs: Any,
+    ) -> None:
+        metadata = metadata or {}
+        model = metadata.get("ls_model_name") or "unknown"
+        self._begin(
+            run_id,
+            parent_run_id,
+            f"chat {model}",
+            "llm",
+            metadata,
+            **{"gen_ai.request.model": model, "route": metadata.get("route", "")},
+        )
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        span = self._finish(run_id)
+        if span is None:
+            return
+        message = getattr(response.generations[0][0], "message", None)
+        usage = getattr(message, "usage_metadata", None) or {}
+        cache_hit = bool(message and message.response_metadata.get("cache_hit"))
+        span.attributes.update(
+            {
+                "gen_ai.usage.input_tokens": usage.get("input_tokens", 0),
+                "gen_ai.usage.output_tokens": usage.get("output_tokens", 0),
+                "cache.hit": cache_hit,
+            }
+        )
+        labels = {
+            "node": span.attributes.get("node.path", ""),
+            "route": span.attributes["route"],
+            "model": span.attributes["gen_ai.request.model"],
+        }
+        metrics.inc(
+            "docgen_llm_requests_total",
+            status="cache_hit" if cache_hit else "ok",
+            **labels,
+        )
+        if cache_hit:
+            return
+        metrics.observe("docgen_llm_duration_seconds", span.seconds, **labels)
+        for kind, key in (("prompt", "input_tokens"), ("completion", "output_tokens")):
+            metrics.inc(
+                "docgen_llm_tokens_total", usage.get(key, 0), type=kind, **labels
+            )
+
+    def on_llm_error(
+        self, error: BaseException, *, run_id: UUID, **kwargs: Any
+    ) -> None:
+        span = self._finish(run_id, error)
+        if span is not None:
+            metrics.inc(
+                "docgen_llm_requests_total",
+                node=span.attributes.get("node.path", ""),
+                route=span.attributes["route"],
+                model=span.attributes["gen_ai.request.model"],
+                status="cancelled" if span.error == "cancelled" else "error",
+            )
+
+    def on_tool_start(
+        self,
+        serialized: dict[str, Any] | None,
+        input_str: str,
+        *,
+        run_id: UUID,
+        parent_run_id: UUID | None = None,
+        metadata: dict[str, Any] | None = None,
+        **kwargs: Any,
+    ) -> None:
+        tool = (serialized or {}).get("name") or kwargs.get("name") or "tool"
+        self._begin(
+            run_id, parent_run_id, tool, "tool", metadata, **{"tool.name": tool}
+        )
+
+    def on_tool_end(self, output: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end_tool(self._finish(run_id))
+
+    def on_tool_error(
+        self, error: BaseException, *, run_id: UUID, **kwargs: Any
+    ) -> None:
+        self._end_tool(self._finish(run_id, error))
+
+    def _end_tool(self, span: Span | None) -> None:
+        if span is None:
+            return
+        tool = span.attributes["tool.name"]
+        metrics.inc(
+            "docgen_tool_calls_total", tool=tool, status="error" if span.error else "ok"
+        )
+        metrics.observe("docgen_tool_duration_seconds", span.seconds, tool=tool)
+
+    # ---------------------------
+    # SUMMARY
+    # ---------------------------
+    def close(self, error: BaseException | None = None) -> None:
+        """End the run's span, and any span its callbacks never closed."""
+        if self.root.end is not None:
+            return
+        self.root.end = time.time()
+        if error is not None:
+            self.root.error = _describe(error)
+        for span in self._open.values():
+            span.end = self.root.end
+            span.error = span.error or "unfinished"
+        self._open.clear()
+        self._parents.clear()
+        metrics.inc("docgen_reports_total", status="error" if error else "ok")
+        metrics.observe("docgen_report_duration_seconds", self.root.seconds)
+
+    def summary(self) -> dict[str, Any]:
+        """Where the run's time went, and which section held up the others.
+
+        Sections are written concurrently and the report waits for all of
+        them, so the section that finished last is on the critical path;
+        held_up_seconds is how long the report waited for it alone.
+        """
+        work: dict[Any, dict[str, Any]] = defaultdict(
+            lambda: {
+                "llm_calls": 0,
+                "llm_seconds": 0.0,
+                "tool_calls": 0,
+                "tool_seconds": 0.0,
+                "failed_attempts": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "cache_hits": 0,
+            }
+        )
+        for span in self.spans:
+            if span.kind not in ("llm", "tool"):
+                continue
+            # the run's totals under None, each section's under its index
+            for key in {None, span.attributes.get("section.index")}:
+                totals = work[key]
+                totals[f"{span.kind}_calls"] += 1
+                totals[f"{span.kind}_seconds"] += span.seconds
+                totals["failed_attempts"] += span.error not in (None, "cancelled")
+                if span.attributes.get("cache.hit"):
+                    totals["cache_hits"] += 1
+                    continue
+                totals["prompt_tokens"] += span.attributes.get(
+                    "gen_ai.usage.input_tokens", 0
+                )
+                totals["completion_tokens"] += span.attributes.get(
+                    "gen_ai.usage.output_tokens", 0
+                )
+
+        sections = sorted(
+            (span for span in self.spans if span.kind == "section" and span.end),
+            key=lambda span: span.end or 0.0,
+        )
+        rows = [
+            {
+                "index": span.attributes.get("section.index"),
+                "description": span.attributes.get("section.description", ""),
+                "seconds": span.seconds,
+                "error": span.error,
+                **work[span.attributes.get("section.index")],
+            }
+            for span in sections
+        ]
+        straggler = None
+        if rows:
+            straggler = dict(rows[-1])
+            straggler["held_up_seconds"] = (
+                (sections[-1].end or 0.0) - (sections[-2].end or 0.0)
+                if len(sections) > 1
+                else sections[-1].seconds
+            )
+        return {
+            "run_id": self.run_id,
+            "seconds": self.root.seconds,
+            "error": self.root.error,
+            "nodes": [
+                {"node": span.name, "seconds": span.seconds, "error": span.error}
+                for span in self.spans
+                if span.kind == "node" and span.parent_id == self.root.span_id
+            ],
+            "totals": work[None],
+            # model calls by the route that chose the model, and the model
+            "routes": dict(
+                Counter(
+                    f"{span.attributes['route'] or '-'}: "
+                    f"{span.attributes['gen_ai.request.model']}"
+                    for span in self.spans
+                    if span.kind == "llm" and not span.error
+                )
+            ),
+            "sections": rows,
+            "straggler": straggler,
+        }
+
+
+def format_summary(summary: dict[str, Any]) -> str:
+    """A one-line account of a run summary for the logs."""
+    nodes = ", ".join(f"{n['node']} {n['seconds']:.1f}s" for n in summary["nodes"])
+    totals = summary["totals"]
+    line = (
+        f"Run {summary['run_id']} took {summary['seconds']:.1f}s ({nodes}); "
+        f"{totals['llm_calls']} model calls ({totals['cache_hits']} cached, "
+        f"{totals['failed_attempts']} failed attempts), {totals['prompt_tokens']} prompt "
+        f"and {totals['completion_tokens']} completion tokens, "
+        f"{totals['tool_calls']} tool calls."
+    )
+    straggler = summary["straggler"]
+    if straggler is not None:
+        line += (
+            f" Slowest section: {straggler['index']} ({straggler['description']}) "
+            f"took {straggler['seconds']:.1f}s, {straggler['llm_seconds']:.1f}s in "
+            f"{straggler['llm_calls']} model calls and {straggler['tool_seconds']:.1f}s "
+            f"in {straggler['tool_calls']} tool calls, holding up the report "
+            f"{straggler['held_up_seconds']:.1f}s."
+        )
+    return line
+
+
+# ---------------------------
+# EXPORT
+# ---------------------------
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _series(name: str, labels: Labels, extra: Labels = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return name
+    return name + "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def prometheus_text() -> str:
+    """The metrics in the Prometheus text exposition format."""
+    lines = []
+    for name, series in sorted(metrics.counters().items()):
+        lines += [f"# HELP {name} {_HELP.get(name, name)}", f"# TYPE {name} counter"]
+        lines += [f"{_series(name, k)} {v:g}" for k, v in sorted(series.items())]
+    for name, series in sorted(metrics.gauges().items()):
+        lines += [f"# HELP {name} {_HELP.get(name, name)}", f"# TYPE {name} gauge"]
+        lines += [f"{_series(name, k)} {v:g}" for k, v in sorted(series.items())]
+    for name, series in sorted(metrics.histograms().items()):
+        lines += [f"# HELP {name} {_HELP.get(name, name)}", f"# TYPE {name} histogram"]
+        for labels, histogram in sorted(series.items()):
+            cumulative = 0
+            bounds = [f"{bound:g}" for bound in metrics.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, histogram.counts):
+                cumulative += count
+                lines.append(
+                    f"{_series(name + '_bucket', labels, (('le', bound),))} {cumulative}"
+                )
+            lines.append(f"{_series(name + '_sum', labels)} {histogram.sum:g}")
+            lines.append(f"{_series(name + '_count', labels)} {histogram.count}")
+    return "\n".join(lines) + "\n"
+
+
+def _otlp_value(value: Any) -> dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: dict[str, Any] | Labels) -> list[dict[str, Any]]:
+    items = attributes.items() if isinstance(attributes, dict) else attributes
+    return [{"key": key, "value": _otlp_value(value)} for key, value in items]
+
+
+def _nanos(seconds: float) -> str:
+    return str(int(seconds * 1e9))
+
+
+def _otlp_resource(
+    scope_key: str, items_key: str, items: list[dict[str, Any]]
+) -> dict[str, Any]:
+    return {
+        "resource": {"attributes": _otlp_attributes({"service.name": SERVICE_NAME})},
+        scope_key: [{"scope": {"name": __package__}, items_key: items}],
+    }
+
+
+def otlp_traces(tracer: RunTracer) -> dict[str, Any]:
+    """The spans of a run as an OTLP/JSON ExportTraceServiceRequest."""
+    spans = []
+    for span in tracer.spans:
+        otlp_span = {
+            "traceId": tracer.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            # SPAN_KIND_CLIENT for calls leaving the process, else INTERNAL
+            "kind": 3 if span.kind in _OTLP_CLIENT_KINDS else 1,
+            "startTimeUnixNano": _nanos(span.start),
+            "endTimeUnixNano": _nanos(span.end or span.start),
+            "attributes": _otlp_attributes(
+                {"docgen.kind": span.kind, **span.attributes}
+            ),
+            "status": (
+                {"code": 2, "message": span.error} if span.error else {"code": 1}
+            ),
+        }
+        if span.parent_id is not None:
+            otlp_span["parentSpanId"] = span.parent_id
+        spans.append(otlp_span)
+    return {"resourceSpans": [_otlp_resource("scopeSpans", "spans", spans)]}
+
+
+def otlp_metrics() -> dict[str, Any]:
+    """The metrics as an OTLP/JSON ExportMetricsServiceRequest."""
+    start, now = _nanos(metrics.started), _nanos(time.time())
+    exported: list[dict[str, Any]] = []
+    for name, series in sorted(metrics.counters().items()):
+        points = [
+            {
+                "attributes": _otlp_attributes(labels),
+                "startTimeUnixNano": start,
+                "timeUnixNano": now,
+                "asDouble": float(value),
+            }
+            for labels, value in series.items()
+        ]
+        exported.append(
+            {
+                "name": name,
+                "description": _HELP.get(name, ""),
+                # AGGREGATION_TEMPORALITY_CUMULATIVE
+                "sum": {
+                    "dataPoints": points,
+                    "aggregationTemporality": 2,
+                    "isMonotonic": True,
+                },
+            }
+        )
+    for name, series in sorted(metrics.gauges().items()):
+        points = [
+            {
+                "attributes": _otlp_attributes(labels),
+                "timeUnixNano": now,
+                "asDouble": float(value),
+            }
+            for labels, value in series.items()
+        ]
+        exported.append(
+            {
+                "name": name,
+                "description": _HELP.get(name, ""),
+                "gauge": {"dataPoints": points},
+            }
+        )
+    for name, series in sorted(metrics.histograms().items()):
+        points = [
+            {
+                "attributes": _otlp_attributes(labels),
+                "startTimeUnixNano": start,
+                "timeUnixNano": now,
+                "count": str(histogram.count),
+                "sum": histogram.sum,
+                "bucketCounts": [str(count) for count in histogram.counts],
+                "explicitBounds": list(metrics.buckets),
+            }
+            for labels, histogram in series.items()
+        ]
+        exported.append(
+            {
+                "name": name,
+                "description": _HELP.get(name, ""),
+                "unit": "s",
+                "histogram": {"dataPoints": points, "aggregationTemporality": 2},
+            }
+        )
+    return {"resourceMetrics": [_otlp_resource("scopeMetrics", "metrics", exported)]}
+
+
+def _write_files(directory: Path, tracer: RunTracer | None) -> None:
+    directory.mkdir(parents=True, exist_ok=True)
+    (directory / "metrics.prom").write_text(prometheus_text(), encoding="utf-8")
+    (directory / "metrics.json").write_text(
+        json.dumps(otlp_metrics()), encoding="utf-8"
+    )
+    if tracer is not None:
+        with (directory / "traces.jsonl").open("a", encoding="utf-8") as traces:
+            traces.write(json.dumps(otlp_traces(tracer)) + "\n")
+
+
+async def export(tracer: RunTracer | None = None, target: str | None = None) -> None:
+    """Export the metrics, and the spans of tracer, to a directory or collector.
+
+    target defaults to TELEMETRY_EXPORT. A failed export is logged and
+    otherwise ignored, so telemetry never fails a report.
+    """
+    target = TELEMETRY_EXPORT if target is None else target
+    if not target:
+        return
+    try:
+        if target.startswith(("http://", "https://")):
+            async with httpx.AsyncClient(timeout=10) as client:
+                if tracer is not None:
+                    response = await client.post(
+                        f"{target.rstrip('/')}/v1/traces", json=otlp_traces(tracer)
+                    )
+                    response.raise_for_status()
+                response = await client.post(
+                    f"{target.rstrip('/')}/v1/metrics", json=otlp_metrics()
+                )
+                response.raise_for_status()
+        else:
+            await asyncio.to_thread(_write_files, Path(target), tracer)
+    except Exception as err:
+        _LOGGER.warning("Telemetry export to %s failed: %s", target, err)
+
+
+@asynccontextmanager
+async def trace_run(run_id: str) -> AsyncIterator[RunTracer | None]:
+    """Trace a run, then log where its time went and export its telemetry.
+
+    Yields None when TELEMETRY=0.
+    """
+    if not TELEMETRY_ENABLED:
+        yield None
+        return
+    tracer = RunTracer(run_id)
+    try:
+        yield tracer
+    except BaseException as err:
+        tracer.close(err)
+        raise
+    finally:
+        tracer.close()
+        _LOGGER.info(format_summary(tracer.summary()))
+        await export(tracer)
@@ -1,37 +1,64 @@
 """Tools for the report generation workflow."""
 
 import asyncio
+import functools
+import json
 import logging
 import os
-from typing import Literal
+from typing import Any, Literal
 
+from langchain_core.runnables import RunnableConfig
 from langchain_core.tools import tool
-from tavily import AsyncTavilyClient
+
+from . import cache, clients, ranking, research, resilience, scheduler, sources
 
 _LOGGER = logging.getLogger(__name__)
 
-tavily_client = AsyncTavilyClient(api_key=os.getenv("TAVILY_API_KEY"))
 INCLUDE_RAW_CONTENT = False
 MAX_TOKENS_PER_SOURCE = 1000
+# Token budget for the ranked content of one search tool call.
+SOURCE_TOKEN_BUDGET = 4000
 MAX_RESULTS = 5
 SEARCH_DAYS = 30
+SEARCH_TIMEOUT = 60
+# How many tool calls from one model turn run at once, and how long each may take.
+TOOL_CONCURRENCY = int(os.getenv("TOOL_CONCURRENCY", "4"))
+TOOL_TIMEOUTS = {"search_tavily": 3 * SEARCH_TIMEOUT}
+DEFAULT_TOOL_TIMEOUT = 120
+
+# Seconds a cached search response stays fresh, per Tavily topic.
+SEARCH_CACHE_TTL = {
+    "news": 60 * 60,
+    "finance": 60 * 60,
+    "general": 7 * 24 * 60 * 60,
+}
+SEARCH_CACHE_ENABLED = os.getenv("SEARCH_CACHE", "1") == "1"
+search_cache: cache.CacheBackend = cache.tiered_cache(
+    "search_tavily", max_entries=2048, max_bytes=128 * 1024 * 1024
+)
 
 
-def _deduplicate_and_format_sources(
-    search_response, max_tokens_per_source, include_raw_content=True
-):
+def source_records(
+    search_response,
+    max_tokens_per_source=MAX_TOKENS_PER_SOURCE,
+    include_raw_content=INCLUDE_RAW_CONTENT,
+    query=None,
+) -> list[sources.SourceRecord]:
     """
-    Takes either a single search response or list of responses from Tavily API and formats them.
-    Limits the raw_content to approximately max_tokens_per_source.
-    include_raw_content specifies whether to include the raw_content from Tavily in the formatted string.
+    Takes either a single search response or list of responses from Tavily API and
+    turns them into source records, deduplicated by URL.
+    Limits the raw_content to max_tokens_per_source tokens.
+    include_raw_content specifies whether to keep the raw_content from Tavily.
+    When a query is given, only the content most relevant to it is kept.
 
     Args:
         search_response: Either:
             - A dict with a 'results' key containing a list of search results
             - A list of dicts, each containing search results
+        query: Optional text to rank the sources against.
 
     Returns:
-        str: Formatted string with deduplicated sources
+        list[SourceRecord]: The deduplicated sources
     """
     # Convert input to list of results
     if isinstance(search_response, dict):
@@ -54,34 +81,95 @@ def _deduplicate_and_format_sources(
         if source["url"] not in unique_sources:
             unique_sources[source["url"]] = source
 
-    # Format output
-    formatted_text = "Sources:\n\n"
-    for i, source in enumerate(unique_sources.values(), 1):
-        formatted_text += f"Source {source['title']}:\n===\n"
-        formatted_text += f"URL: {source['url']}\n===\n"
-        formatted_text += (
-            f"Most relevant content from source: {source['content']}\n===\n"
+    if query is not None:
+        return _ranked_records(
+            list(unique_sources.values()), query, include_raw_content
         )
+
+    records = []
+    for source in unique_sources.values():
+        raw_content = ""
         if include_raw_content:
-            # Using rough estimate of 4 characters per token
-            char_limit = max_tokens_per_source * 4
-            # Handle None raw_content
-            raw_content = source.get("raw_content", "")
-            if raw_content is None:
-                raw_content = ""
-                print(f"Warning: No raw_content found for source {source['url']}")
-            if len(raw_content) > char_limit:
-                raw_content = raw_content[:char_limit] + "... [truncated]"
-            formatted_text += f"Full source content limited to {max_tokens_per_source} tokens: {raw_content}\n\n"
+            raw_content = source.get("raw_content") or ""
+            if not raw_content:
+                _LOGGER.warning("No raw_content found for source %s", source["url"])
+            raw_content = sources.truncate(raw_content, max_tokens_per_source)
+        records.append(
+            sources.record(
+                source["url"],
+                source["title"],
+                source["content"],
+                raw_content,
+                source.get("score") or 0.0,
+            )
+        )
+    return records
+
+
+async def _search(query: str, topic: str, days: int | None) -> dict:
+    """Run a single Tavily search, answering from the search cache when possible."""
+    key = cache.make_key("tavily", query, topic, days, MAX_RESULTS, INCLUDE_RAW_CONTENT)
+    # a memory miss reads SQLite and a set commits, so both leave the loop
+    if SEARCH_CACHE_ENABLED:
+        cached = await asyncio.to_thread(search_cache.get, key)
+        if cached is not None:
+            _LOGGER.info("Search cache hit for query: %s", query)
+            return cached
+
+    _LOGGER.info("Searching for query: %s", query)
+    response = await resilience.run(
+        "search_tavily",
+        lambda: scheduler.search_scheduler.run(
+            lambda: clients.tavily().search(
+                query,
+                max_results=MAX_RESULTS,
+                include_raw_content=INCLUDE_RAW_CONTENT,
+                topic=topic,  # type: ignore[arg-type]
+                days=days,  # type: ignore[arg-type]
+            )
+        ),
+        timeout=SEARCH_TIMEOUT,
+        breaker=resilience.breakers["search"],
+    )
+    if SEARCH_CACHE_ENABLED:
+        await asyncio.to_thread(
+            search_cache.set, key, response, SEARCH_CACHE_TTL.get(topic)
+        )
+    return response
+
+
+def _ranked_records(sources_list, query, include_raw_content):
+    """
+    Records of the source chunks most relevant to query, within SOURCE_TOKEN_BUDGET.
+    Near-duplicate sources are dropped and sources are ordered by their best chunk.
+    """
+    sources_list = ranking.collapse_near_duplicates(sources_list)
+    ranked = ranking.rank_chunks(query, sources_list, include_raw_content)
+    # chunks that share nothing with the query are only kept if nothing else does
+    relevant = [chunk for chunk in ranked if chunk.score > 0] or ranked
+    chunks = ranking.pack(relevant, SOURCE_TOKEN_BUDGET)
+
+    by_url = {}
+    for chunk in chunks:
+        by_url.setdefault(chunk.source["url"], []).append(chunk)
 
-    return formatted_text.strip()
+    return [
+        sources.record(
+            source_chunks[0].source["url"],
+            source_chunks[0].source["title"],
+            "\n...\n".join(chunk.text for chunk in source_chunks),
+            score=source_chunks[0].score,
+        )
+        for source_chunks in by_url.values()
+    ]
 
 
 @tool(parse_docstring=True)
 async def search_tavily(
     queries: list[str],
+    config: RunnableConfig,
     topic: Literal["general", "news", "finance"] = "news",
-) -> str:
+) -> list[sources.SourceRecord]:
     """Search the web using the Tavily API.
 
     Args:
@@ -92,7 +180,7 @@ async def search_tavily(
           finance - Finance search.
 
     Returns:
-        A string of the search results.
+        The sources found, as records.
     """
     _LOGGER.info("Searching the web using the Tavily API")
 
@@ -100,27 +188,89 @@ async def search_tavily(
     if topic == "news":
         days = SEARCH_DAYS
 
+    # within a report, queries any section already searched are not repeated
+    pool = research.get_pool(config)
     search_jobs = []
     for query in queries:
-        _LOGGER.info("Searching for query: %s", query)
-        search_jobs.append(
-            asyncio.create_task(
-                tavily_client.search(
-                    query,
-                    max_results=MAX_RESULTS,
-                    include_raw_content=INCLUDE_RAW_CONTENT,
-                    topic=topic,
-                    days=days,  # type: ignore[arg-type]
-                )
+        if pool is None:
+            job = _search(query, topic, days)
+        else:
+            job = pool.search(
+                query, topic, days, functools.partial(_search, query, topic, days)
             )
-        )
-
+        search_jobs.append(asyncio.create_task(job))
     search_docs = await asyncio.gather(*search_jobs)
+    # a no-op once warm_up, or an earlier search, has loaded it
+    await sources.load_tokenizer()
+
+    # rank against what the calling section is about, when it is known
+    section = config.get("metadata", {}).get("section_description", "")
+    # ranking may load an embedding model, so it runs in a thread
+    records = await asyncio.to_thread(
+        source_records, search_docs, query=" ".join([section, *queries])
+    )
+    _LOGGER.debug("Search results: %s", [source["url"] for source in records])
+    return records
+
+
+TOOLS = {"search_tavily": search_tavily}
+
 
-    formatted_search_docs = _deduplicate_and_format_sources(
-        search_docs,
-        max_tokens_per_source=MAX_TOKENS_PER_SOURCE,
-        include_raw_content=INCLUDE_RAW_CONTENT,
+async def _execute_tool_call(
+    tool_call: dict[str, Any], config: RunnableConfig, slots: asyncio.Semaphore
+) -> dict[str, Any]:
+    name = tool_call["name"]
+    records: list[sources.SourceRecord] = []
+    timeout = TOOL_TIMEOUTS.get(name, DEFAULT_TOOL_TIMEOUT)
+    async with slots:
+        _LOGGER.info("Executing tool call: %s", name)
+        try:
+            if name not in TOOLS:
+                raise ValueError(f"unknown tool {name}")
+            result = await asyncio.wait_for(
+                TOOLS[name].ainvoke(tool_call["args"], config), timeout
+            )
+            # source records travel as they are and are rendered into the
+            # prompt when it is assembled, see context.fit
+            if isinstance(result, list):
+                records, content = result, "" if result else "No sources found."
+            else:
+                content = result if isinstance(result, str) else json.dumps(result)
+        except asyncio.TimeoutError:
+            _LOGGER.error("Tool call %s timed out after %ss.", name, timeout)
+            content = f"Error: {name} timed out after {timeout} seconds."
+        except Exception as err:
+            # the model is told, so it can carry on with the other results
+            _LOGGER.error("Tool call %s failed: %s", name, err)
+            content = f"Error: {name} failed: {err}"
+    message = {
+        "role": "tool",
+        "content": content,
+        "name": name,
+        "tool_call_id": tool_call["id"],
+    }
+    if records:
+        message["sources"] = records
+    return message
+
+
+async def execute_tool_calls(
+    tool_calls: list[dict[str, Any]], config: RunnableConfig
+) -> list[dict[str, Any]]:
+    """Run a model turn's tool calls concurrently, returning results in call order.
+
+    At most TOOL_CONCURRENCY calls run at once and each is cut off after its
+    timeout. A failed or timed out call becomes an error message for the model
+    instead of failing the turn; cancelling the caller cancels every call.
+    """
+    slots = asyncio.Semaphore(TOOL_CONCURRENCY)
+    return await asyncio.gather(
+        *(_execute_tool_call(tool_call, config, slots) for tool_call in tool_calls)
     )
-    _LOGGER.debug("Search results: %s", formatted_search_docs)
-    return formatted_search_docs
+
+
+async def tool_node(state: Any, config: RunnableConfig) -> dict[str, Any]:
+    """Graph node executing the tool calls of the last model message."""
+    tool_calls = state.messages[-1].tool_calls
+    _LOGGER.info("Executing %d tool calls.", len(tool_calls))
+    return {"messages": await execute_tool_calls(tool_calls, config)}
@@ -0,0 +1,8 @@
+"""Keep the package's caches out of the repository while testing."""
+
+import os
+import tempfile
+
+# the package reads its settings at import
+os.environ.setdefault("DOCGEN_CACHE_DIR", tempfile.mkdtemp(prefix="docgen-test-"))
+os.environ.setdefault("NVIDIA_API_KEY", "test")
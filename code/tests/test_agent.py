@@ -0,0 +1,70 @@
+import asyncio
+import uuid
+
+import pytest
+
+from docgen_agent import agent, author, checkpoint
+
+
+def _plan(*names: str) -> agent.Report:
+    return agent.Report(
+        title="Accelerators",
+        sections=[
+            author.Section(name=name, description="", research=False, content="")
+            for name in names
+        ],
+    )
+
+
+async def _no_event(name, data, config=None):
+    pass
+
+
+def test_failed_section_fails_the_run_and_is_written_on_resume(monkeypatch):
+    attempts = []
+
+    async def write(state, index, section, seed, config):
+        attempts.append(section.name)
+        if section.name == "Body" and attempts.count("Body") == 1:
+            raise RuntimeError("model unavailable")
+        return section.model_copy(update={"content": f"## {section.name}"})
+
+    monkeypatch.setattr(agent, "_section", write)
+    monkeypatch.setattr(agent, "adispatch_custom_event", _no_event)
+    monkeypatch.setattr(agent.memo, "MEMO_ENABLED", False)
+    state = agent.AgentState(
+        topic="Accelerators",
+        report_structure="",
+        report_plan=_plan("Intro", "Body", "End"),
+    )
+    config = {"configurable": {"thread_id": "sections-failed"}}
+
+    with pytest.raises(agent.SectionsFailed, match="Body: model unavailable"):
+        asyncio.run(agent.section_author_orchestrator(state, config))
+    # the finished sections are kept, the failed one is left to the resume
+    assert sorted(checkpoint.section_store.load("sections-failed")) == [0, 2]
+
+    update = asyncio.run(agent.section_author_orchestrator(state, config))
+    assert [section.content for section in update["report_plan"].sections] == [
+        "## Intro",
+        "## Body",
+        "## End",
+    ]
+    assert sorted(attempts) == ["Body", "Body", "End", "Intro"]
+    checkpoint.section_store.clear("sections-failed")
+
+
+def test_plan_stream_skips_the_think_block():
+    started = []
+    stream = agent._PlanStream(lambda index, section: started.append(section.name))
+    run_id = uuid.uuid4()
+    response = (
+        '<think>The plan could be {"sections": [{"name": "Draft"',
+        "}]}, but better: </think>",
+        '{"title": "Accelerators", "sections": [',
+        '{"name": "Intro", "description": "", "research": false, "content": ""}',
+        ', {"name": "Body"',
+    )
+    for token in response:
+        stream.on_llm_new_token(token, run_id=run_id)
+    assert started == ["Intro"]
@@ -0,0 +1,62 @@
+import json
+
+from langchain_core.load import dumps
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration
+
+from docgen_agent import cache
+
+
+def test_disk_cache_evicts_least_recently_used_over_its_bound(tmp_path):
+    disk = cache.DiskCache(tmp_path / "cache.sqlite", max_bytes=100)
+    for key in "abcde":
+        disk.set(key, "x" * 30)  # 32 bytes as JSON
+    assert [disk.get(key) is not None for key in "abcde"] == [False] * 2 + [True] * 3
+    assert disk.stats.evictions == 2
+
+    # replacing an entry counts its new size only
+    disk.set("e", "y" * 30)
+    assert disk.get("c") is not None
+    assert disk._total == disk._size() == 96
+
+
+def test_disk_cache_sweeps_expired_entries(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "SWEEP_INTERVAL", 2)
+    disk = cache.DiskCache(tmp_path / "cache.sqlite")
+    disk.set("old", 1, ttl=-1)
+    disk.set("new", 2)
+    assert disk.stats.expirations == 1
+    assert disk._total == disk._size()
+
+
+def _prompt(content: str, message_id: str) -> str:
+    return dumps([HumanMessage(content, id=message_id)])
+
+
+def _llm_string(api_key: str, temperature: float) -> str:
+    model = {"lc": 1, "kwargs": {"model": "m", "api_key": api_key}}
+    return f"{json.dumps(model)}---{json.dumps({'temperature': temperature})}"
+
+
+def test_response_key_ignores_volatile_fields():
+    responses = cache.ResponseCache(cache.MemoryCache(), model={"model": "m"})
+    key = responses.key(_prompt("Hi", "run-1"), _llm_string("key-1", 0))
+
+    assert responses.key(_prompt("Hi", "run-2"), _llm_string("key-2", 0)) == key
+    assert responses.key(_prompt("Hello", "run-1"), _llm_string("key-1", 0)) != key
+    assert responses.key(_prompt("Hi", "run-1"), _llm_string("key-1", 1)) != key
+    other = cache.ResponseCache(cache.MemoryCache(), model={"model": "other"})
+    assert other.key(_prompt("Hi", "run-1"), _llm_string("key-1", 0)) != key
+
+
+def test_response_cache_skips_empty_responses_and_marks_hits():
+    responses = cache.ResponseCache(cache.MemoryCache())
+    prompt, llm_string = _prompt("Hi", "run"), _llm_string("key", 0)
+
+    responses.update(prompt, llm_string, [ChatGeneration(message=AIMessage(""))])
+    assert responses.lookup(prompt, llm_string) is None
+
+    responses.update(prompt, llm_string, [ChatGeneration(message=AIMessage("Hey"))])
+    (hit,) = responses.lookup(prompt, llm_string)
+    assert hit.message.content == "Hey"
+    assert hit.message.response_metadata["cache_hit"] is True
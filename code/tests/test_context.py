@@ -0,0 +1,51 @@
+from docgen_agent import context
+
+COMPACTED = "[Earlier tool output removed to save space.]"
+
+
+def _round(call: str, output: str) -> list[dict]:
+    return [
+        {"role": "assistant", "content": call, "tool_calls": [{"name": "search"}]},
+        {"role": "tool", "content": output},
+    ]
+
+
+def _messages(call: str = "search") -> list[dict]:
+    return [
+        {"role": "system", "content": "You are a researcher."},
+        {"role": "user", "content": "GPUs"},
+        *_round(call, "first " * 700),
+        *_round("search again", "second " * 600),
+    ]
+
+
+def test_within_budget_nothing_changes():
+    messages = _messages()
+    assert context.fit("researcher", messages, budget=10_000) == messages
+
+
+def test_old_tool_outputs_are_compacted_first():
+    messages = _messages()
+    fitted = context.fit("researcher", messages, budget=1_500)
+    assert [m["content"] for m in fitted] == [m["content"] for m in messages[:3]] + [
+        COMPACTED
+    ] + [m["content"] for m in messages[4:]]
+
+
+def test_old_rounds_are_dropped_when_compacting_is_not_enough():
+    messages = _messages(call="thinking " * 400)
+    fitted = context.fit("researcher", messages, budget=1_500)
+    # the most recent round is kept whole
+    assert fitted == messages[:2] + messages[4:]
+
+
+def test_longest_message_is_truncated_but_not_the_system_prompt():
+    messages = [
+        {"role": "system", "content": "rules " * 1_500},
+        {"role": "user", "content": "GPUs"},
+        *_round("search", "found " * 700),
+    ]
+    fitted = context.fit("researcher", messages, budget=2_500)
+    assert fitted[0] == messages[0]
+    assert fitted[3]["content"].endswith("\n... [truncated]")
+    assert context.scheduler.estimate_tokens(fitted) <= 2_500 + 10
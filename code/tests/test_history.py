@@ -0,0 +1,35 @@
+import asyncio
+
+import pytest
+
+from docgen_agent import history
+
+MESSAGES = [{"role": "user", "content": "Research GPUs."}]
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = history.TranscriptStore(tmp_path / "transcripts.sqlite")
+    monkeypatch.setattr(history, "_stored", store)
+    monkeypatch.setattr(history, "_loaded", history.cache.MemoryCache(1))
+    return store
+
+
+def test_transcript_outlives_the_memory_cache_until_released(store):
+    digest = asyncio.run(history.put(MESSAGES, "run"))
+    asyncio.run(history.put([{"role": "user", "content": "other"}], "run"))
+
+    assert history.load(digest)[0].content == "Research GPUs."
+    history.release("run")
+    history._loaded.clear()
+    with pytest.raises(LookupError):
+        history.load(digest)
+
+
+def test_shared_transcript_stays_pinned_by_the_other_run(store):
+    digest = asyncio.run(history.put(MESSAGES, "first"))
+    assert asyncio.run(history.put(MESSAGES, "second")) == digest
+
+    history.release("first")
+    history._loaded.clear()
+    assert history.load(digest)[0].content == "Research GPUs."
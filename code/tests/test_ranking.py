@@ -0,0 +1,49 @@
+import sys
+import types
+
+from docgen_agent import ranking
+
+TEXT = (
+    "The accelerator pairs eighty gigabytes of high bandwidth memory with a "
+    "faster interconnect, doubling training throughput on large language "
+    "models. Its tensor cores add support for eight bit floating point, "
+    "which halves memory traffic for inference, and the board draws seven "
+    "hundred watts under sustained load in dense server configurations."
+)
+
+
+def _source(url: str, content: str) -> dict:
+    return {"url": url, "title": url, "content": content}
+
+
+def test_near_duplicates_collapse():
+    kept = ranking.collapse_near_duplicates(
+        [_source("a", TEXT), _source("b", TEXT + " Subscribe.")]
+    )
+    assert [source["url"] for source in kept] == ["a"]
+
+
+def test_sources_too_short_to_fingerprint_are_kept():
+    assert ranking.simhash("") is None
+    kept = ranking.collapse_near_duplicates(
+        [_source("a", ""), _source("b", ""), _source("c", "GPU prices")]
+    )
+    assert [source["url"] for source in kept] == ["a", "b", "c"]
+
+
+def test_embedding_model_that_fails_to_load_falls_back_to_bm25(monkeypatch):
+    class SentenceTransformer:
+        def __init__(self, name):
+            raise OSError("cannot download the model")
+
+    module = types.ModuleType("sentence_transformers")
+    module.SentenceTransformer = SentenceTransformer
+    monkeypatch.setitem(sys.modules, "sentence_transformers", module)
+    monkeypatch.setattr(ranking, "_embedder", None)
+    monkeypatch.setattr(ranking, "_embedder_tried", False)
+    monkeypatch.setattr(ranking, "RANKING_MODE", "embedding")
+
+    documents = ["memory bandwidth of the accelerator", "list prices"]
+    assert ranking.score("memory bandwidth", documents) == ranking.bm25_scores(
+        "memory bandwidth", documents
+    )
@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+
+from docgen_agent import resilience
+
+
+class TransportError(Exception):
+    """Named like the httpx base class of transport errors."""
+
+
+@pytest.mark.parametrize(
+    "err, kind",
+    [
+        (resilience.EmptyResponseError(), "retryable"),
+        (asyncio.TimeoutError(), "retryable"),
+        (ConnectionResetError(), "retryable"),
+        (TransportError(), "retryable"),
+        (Exception("[429] Too Many Requests"), "retryable"),
+        (Exception("[503] Service Unavailable"), "retryable"),
+        (Exception("[400] Bad Request"), "fatal"),
+        (Exception("[401] Unauthorized"), "fatal"),
+        (ValueError("bad arguments"), "fatal"),
+        (resilience.CircuitOpenError(), "fatal"),
+    ],
+)
+def test_classify_error(err, kind):
+    assert resilience.classify_error(err) == kind
+
+
+def test_breaker_opens_then_lets_one_call_through(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(resilience.time, "monotonic", lambda: now[0])
+    breaker = resilience.CircuitBreaker(failure_threshold=2, reset_after=10)
+
+    breaker.record_failure()
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    with pytest.raises(resilience.CircuitOpenError):
+        breaker.before_call()
+
+    now[0] = 10.0
+    assert breaker.state == "half-open"
+    breaker.before_call()
+    # the trial call failing opens the breaker again
+    breaker.record_failure()
+    assert breaker.state == "open"
+    now[0] = 20.0
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+
+def test_run_retries_retryable_errors_only(monkeypatch):
+    monkeypatch.setattr(resilience, "BASE_DELAY", 0)
+    breaker = resilience.CircuitBreaker(failure_threshold=10)
+    calls = []
+
+    async def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise Exception("[503] Service Unavailable")
+        return "ok"
+
+    assert asyncio.run(resilience.run("flaky", flaky, breaker=breaker)) == "ok"
+    assert len(calls) == 3
+    assert breaker.state == "closed"
+
+    async def broken():
+        calls.append(1)
+        raise Exception("[400] Bad Request")
+
+    calls.clear()
+    with pytest.raises(Exception, match="400"):
+        asyncio.run(resilience.run("broken", broken, breaker=breaker))
+    assert len(calls) == 1
+
+
+def test_run_treats_empty_results_as_retryable(monkeypatch):
+    monkeypatch.setattr(resilience, "BASE_DELAY", 0)
+
+    async def empty():
+        return ""
+
+    with pytest.raises(resilience.EmptyResponseError):
+        asyncio.run(resilience.run("empty", empty, attempts=2))
+    assert resilience.stats["empty"].retries == 1
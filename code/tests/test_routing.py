@@ -0,0 +1,27 @@
+import asyncio
+
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableLambda
+
+from docgen_agent import clients, context, routing
+
+
+def test_routed_call_fits_its_messages_once(monkeypatch):
+    fitted = []
+    sent = []
+
+    def fit(node, messages, budget=None):
+        fitted.append(node)
+        return list(messages)
+
+    def chat_model(model, **settings):
+        return RunnableLambda(lambda messages: sent.append(messages) or AIMessage("ok"))
+
+    monkeypatch.setattr(context, "fit", fit)
+    monkeypatch.setattr(clients, "chat_model", chat_model)
+
+    response = asyncio.run(
+        routing.invoke_model("ask", [{"role": "user", "content": "Why?"}])
+    )
+    assert response.content == "ok"
+    assert fitted == ["ask"] and len(sent) == 1
@@ -0,0 +1,74 @@
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+from docgen_agent import runner, scheduler
+
+
+def _queue(tmp_path, jobs: int = 1, **kwargs) -> runner.LeaseQueue:
+    queue = runner.LeaseQueue(tmp_path / "queue.sqlite", **kwargs)
+    queue.load(
+        (f"job-{line}", line, {"topic": f"topic {line}", "report_structure": "s"})
+        for line in range(jobs)
+    )
+    return queue
+
+
+def test_job_that_kills_its_worker_fails_after_max_attempts(tmp_path):
+    queue = _queue(tmp_path, lease_seconds=0.01, max_attempts=2)
+    for attempt in (1, 2):
+        job = queue.lease(f"worker-{attempt}")
+        assert job is not None and job.attempt == attempt
+        time.sleep(0.02)  # the worker dies holding the lease
+    assert queue.lease("worker-3") is None
+    assert queue.progress() == {"failed": 1}
+
+
+def test_rerun_retries_failed_jobs_with_attempts_left(tmp_path):
+    queue = _queue(tmp_path, max_attempts=1)
+    job = queue.lease("worker")
+    assert queue.finish(job, "worker", "RuntimeError: boom")
+    assert queue.requeue_failed() == 0
+    queue.close()
+
+    queue = runner.LeaseQueue(tmp_path / "queue.sqlite", max_attempts=2)
+    assert queue.requeue_failed() == 1
+    assert queue.lease("worker").attempt == 2
+
+
+def test_worker_that_lost_its_lease_does_not_write(tmp_path):
+    queue = _queue(tmp_path, lease_seconds=0.3)
+    output = runner.ResultLog(tmp_path / "out.jsonl")
+    job = queue.lease("slow")
+
+    class Graph:
+        async def aget_state(self, config):
+            return SimpleNamespace(values={}, next=())
+
+        async def ainvoke(self, state, config):
+            # the lease runs out and another worker takes the job meanwhile
+            queue._conn.execute("UPDATE jobs SET lease_until = 0")
+            assert queue.lease("fast") is not None
+            await asyncio.sleep(1)
+            return {"report": "stale"}
+
+    asyncio.run(
+        runner._write(job, queue, output, "slow", Graph(), scheduler.PrioritySlots(1))
+    )
+    assert not output.path.exists()
+    assert queue.progress() == {"leased": 1}
+
+
+def test_main_keeps_a_queue_per_shard(tmp_path):
+    jobs = tmp_path / "jobs.jsonl"
+    jobs.write_text(
+        "".join(
+            json.dumps({"topic": f"t{line}", "report_structure": "s"}) + "\n"
+            for line in range(4)
+        )
+    )
+    for index in range(2):
+        runner.main(["status", str(jobs), "--shard", f"{index}/2"])
+    assert (tmp_path / "jobs.jsonl.shard-0-of-2.queue.sqlite").exists()
+    assert (tmp_path / "jobs.jsonl.shard-1-of-2.queue.sqlite").exists()
@@ -0,0 +1,63 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from docgen_agent import scheduler
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after: str | None = None):
+        super().__init__("[429] Too Many Requests")
+        headers = {"Retry-After": retry_after} if retry_after is not None else {}
+        self.response = SimpleNamespace(status_code=429, headers=headers)
+
+
+def test_status_code_and_retry_after_are_read_from_errors():
+    assert scheduler.status_code(RateLimited()) == 429
+    assert scheduler.status_code(Exception("[503] Service Unavailable")) == 503
+    assert scheduler.status_code(ValueError("no status")) is None
+    assert scheduler.retry_after(RateLimited("2.5")) == 2.5
+    assert scheduler.retry_after(RateLimited("soon")) is None
+    assert scheduler.retry_after(RateLimited()) is None
+
+
+def test_429_waits_out_retry_after_and_slows_down():
+    limiter = scheduler.Scheduler("test", requests_per_minute=6000)
+    calls = []
+
+    async def call():
+        calls.append(asyncio.get_running_loop().time())
+        if len(calls) == 1:
+            raise RateLimited("0.2")
+        return "ok"
+
+    assert asyncio.run(limiter.run(call)) == "ok"
+    assert calls[1] - calls[0] >= 0.2
+    assert limiter.rate_limited == 1
+    # halved by the 429, then a success restores a twentieth of the rate
+    assert limiter.requests.per_minute == 3000 + 300
+
+
+def test_429_is_raised_once_retries_run_out():
+    limiter = scheduler.Scheduler("test", requests_per_minute=6000, max_retries=1)
+
+    async def call():
+        raise RateLimited("0")
+
+    with pytest.raises(RateLimited):
+        asyncio.run(limiter.run(call))
+    assert limiter.rate_limited == 2
+
+
+def test_other_errors_are_left_to_the_caller():
+    limiter = scheduler.Scheduler("test", requests_per_minute=6000)
+    calls = []
+
+    async def call():
+        calls.append(1)
+        raise RuntimeError("[500] Internal Server Error")
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(limiter.run(call))
+    assert len(calls) == 1 and limiter.rate_limited == 0
@@ -0,0 +1,120 @@
+import asyncio
+
+import pytest
+
+from docgen_agent import agent, author, semantic
+
+TOPIC = "Datacenter accelerators for AI training"
+
+
+def _section(name: str, content: str = "") -> author.Section:
+    return author.Section(
+        name=name,
+        # planners fill one template in for every sibling
+        description="Memory capacity and bandwidth, interconnect, training "
+        "throughput on large language models, power draw, software ecosystem "
+        "support and list pricing of this accelerator compared with its "
+        "predecessor generation.",
+        research=True,
+        content=content,
+    )
+
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    index = semantic.SectionIndex(tmp_path / "sections.sqlite")
+    monkeypatch.setattr(semantic, "sections", index)
+    return index
+
+
+def test_siblings_are_close(index):
+    _, vectors = semantic.embed(
+        [
+            semantic._text(TOPIC, _section("NVIDIA H100")),
+            semantic._text(TOPIC, _section("AMD MI300X")),
+        ]
+    )
+    assert float(vectors[0] @ vectors[1]) >= semantic.SIMILARITY_THRESHOLD
+
+
+def test_siblings_do_not_match(index):
+    index.add(TOPIC, _section("NVIDIA H100", "## NVIDIA H100\n\n80 GB HBM3."), [])
+
+    # as close as a templated sibling gets, but about something else
+    assert index.lookup(TOPIC, _section("AMD MI300X")) is None
+    assert index.lookup(TOPIC, _section("AMD MI300X"), run="other") is None
+
+
+def test_sections_of_the_same_run_are_left_out(index):
+    index.add(TOPIC, _section("NVIDIA H100", "## NVIDIA H100\n\n80 GB."), [], "run")
+
+    assert index.lookup(TOPIC, _section("NVIDIA H100"), run="run") is None
+    match = index.lookup(TOPIC, _section("NVIDIA H100"), run="next")
+    assert match is not None and match.section.content.endswith("80 GB.")
+
+
+def test_sibling_sections_of_one_report_keep_their_own_content(index, monkeypatch):
+    written = {}
+
+    async def write(section_writer_state, config, memo_key):
+        section = section_writer_state.section
+        content = f"## {section.name}\n\nFacts about the {section.name}."
+        result = section.model_copy(update={"content": content})
+        index.add(section_writer_state.topic, result, [], "run")
+        written[section.name] = content
+        return result
+
+    monkeypatch.setattr(agent, "_write_section", write)
+    monkeypatch.setattr(agent.memo, "MEMO_ENABLED", False)
+    state = agent.AgentState(topic=TOPIC, report_structure="")
+    config = {"configurable": {"thread_id": "run"}}
+
+    async def run():
+        first = await agent._section(state, 0, _section("NVIDIA H100"), None, config)
+        second = await agent._section(state, 1, _section("AMD MI300X"), None, config)
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert "MI300X" not in first.content
+    assert "H100" not in second.content
+    assert set(written) == {"NVIDIA H100", "AMD MI300X"}
+
+
+def test_a_renamed_match_is_refreshed(index, monkeypatch):
+    index.add(TOPIC, _section("NVIDIA H100", "## NVIDIA H100\n\n80 GB."), [], "old")
+    refreshed = []
+
+    async def refresh(section, topic, previous, messages, config=None):
+        refreshed.append(previous)
+        return section.model_copy(update={"content": f"## {section.name}\n\n80 GB."})
+
+    monkeypatch.setattr(author, "refresh", refresh)
+    config = {"configurable": {"thread_id": "new"}}
+
+    section = asyncio.run(
+        agent._similar_section(TOPIC, _section("Nvidia H100"), [], config)
+    )
+    assert refreshed == ["## NVIDIA H100\n\n80 GB."]
+    assert section.content.startswith("## Nvidia H100")
+
+
+def test_a_paraphrased_outline_finds_the_section(index):
+    background = author.Section(
+        name="Background",
+        description="How datacenter accelerators evolved and why AI training "
+        "workloads outgrew general purpose processors.",
+        research=True,
+        content="## Background\n\nFrom GPUs to TPUs.",
+    )
+    index.add(TOPIC, background, [], "old")
+
+    context = background.model_copy(
+        update={
+            "name": "Context",
+            "description": "How datacenter accelerators evolved and why AI "
+            "training workloads outgrew general purpose CPUs.",
+            "content": "",
+        }
+    )
+    match = index.lookup(TOPIC, context, run="new")
+    assert match is not None and match.section.name == "Background"
@@ -0,0 +1,42 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from docgen_agent import server  # noqa: E402
+
+
+def test_cancelled_queued_job_gives_its_place_back():
+    async def main() -> None:
+        service = server.ReportService(workers=1, queue_size=8, tenant_queue_size=1)
+        first = service.submit("tenant", "GPUs", "intro, end")
+        with pytest.raises(server.QueueFull):
+            service.submit("tenant", "TPUs", "intro, end")
+
+        service.cancel(first)
+        assert first.status == "cancelled"
+        assert len(service.queue) == 0
+
+        second = service.submit("tenant", "TPUs", "intro, end")
+        assert await asyncio.wait_for(service.queue.get(), 1) is second
+
+    asyncio.run(main())
+
+
+def test_queue_skips_the_permit_of_a_removed_job():
+    async def main() -> None:
+        queue = server.FairQueue(max_size=8, tenant_size=8)
+        removed = server.Job("removed", "a", "GPUs", "intro")
+        queue.put(removed)
+        assert queue.remove(removed)
+        assert not queue.remove(removed)
+
+        getting = asyncio.create_task(queue.get())
+        await asyncio.sleep(0)
+        assert not getting.done()
+        kept = server.Job("kept", "b", "TPUs", "intro")
+        queue.put(kept)
+        assert await asyncio.wait_for(getting, 1) is kept
+
+    asyncio.run(main())
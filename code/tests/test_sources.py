@@ -0,0 +1,33 @@
+import asyncio
+import threading
+
+import pytest
+
+from docgen_agent import sources
+
+
+@pytest.fixture
+def unloaded(monkeypatch):
+    monkeypatch.setattr(sources, "_encoding", None)
+    monkeypatch.setattr(sources, "_encoding_tried", False)
+
+
+def test_tokenizer_loads_off_the_event_loop(unloaded, monkeypatch):
+    tiktoken = pytest.importorskip("tiktoken")
+    threads = []
+
+    def offline(name):
+        threads.append(threading.current_thread())
+        raise ConnectionError("no network")
+
+    monkeypatch.setattr(tiktoken, "get_encoding", offline)
+    # counting before the tokenizer is loaded estimates instead of loading it
+    assert sources.count_tokens("x" * 40) == 11
+    assert not threads
+
+    asyncio.run(sources.load_tokenizer())
+    asyncio.run(sources.load_tokenizer())
+    assert len(threads) == 1 and threads[0] is not threading.main_thread()
+    # a failed download falls back to the estimate
+    assert sources.count_tokens("x" * 40) == 11
+    assert sources.truncate("x" * 40, 2) == "x" * 8 + "... [truncated]"
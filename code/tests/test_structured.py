@@ -0,0 +1,84 @@
+import asyncio
+
+from docgen_agent import structured
+from docgen_agent.agent import Report
+
+
+def _recover(response: str, invoke_model=None, monkeypatch=None) -> Report | None:
+    if invoke_model is not None:
+        monkeypatch.setattr(structured.routing, "invoke_model", invoke_model)
+    return asyncio.run(
+        structured.recover(
+            Report, response, [], name="report_planner", defaults={"content": ""}
+        )
+    )
+
+
+def test_parse_json_tolerates_think_fences_and_trailing_commas():
+    parsed = structured.parse_json(
+        '<think>maybe {"a": 0}</think>Here it is:\n```json\n{"a": [1, 2,],}\n```'
+    )
+    assert parsed.value == {"a": [1, 2]} and parsed.complete
+    assert structured.parse_json("no json here") is None
+
+
+def test_fill_sets_defaults_of_nested_items_only_where_missing():
+    value = {
+        "title": "GPUs",
+        "sections": [{"name": "Intro"}, {"name": "Body", "content": "kept"}],
+    }
+    structured._fill(Report, value, {"content": "", "research": False})
+    assert value["sections"] == [
+        {"name": "Intro", "content": "", "research": False},
+        {"name": "Body", "content": "kept", "research": False},
+    ]
+    # defaults name fields, values that are not objects are left alone
+    structured._fill(Report, {"title": "GPUs", "sections": "none"}, {"content": ""})
+
+
+def test_recover_repairs_without_asking_the_model(monkeypatch):
+    async def unexpected(*args, **kwargs):
+        raise AssertionError("no patch call needed")
+
+    report = _recover(
+        '{"Title": "GPUs", "sections": [{"Name": "Intro", "description": "d",'
+        ' "research": false},]}',
+        unexpected,
+        monkeypatch,
+    )
+    assert report.title == "GPUs"
+    assert report.sections[0].name == "Intro" and report.sections[0].content == ""
+
+
+def test_recover_patches_only_the_invalid_fields(monkeypatch):
+    asked = []
+
+    async def patch(name, messages, config, **kwargs):
+        asked.append(messages[-1]["content"])
+        return {"sections.0.research": True}
+
+    report = _recover(
+        '{"title": "GPUs", "sections": [{"name": "Intro", "description": "d"}]}',
+        patch,
+        monkeypatch,
+    )
+    assert report.sections[0].research is True
+    assert len(asked) == 1 and "- sections.0.research:" in asked[0]
+    assert "- title" not in asked[0]
+
+
+def test_recover_asks_again_for_a_cut_off_item(monkeypatch):
+    async def patch(name, messages, config, **kwargs):
+        return {"sections.1": {"name": "Body", "description": "all", "research": True}}
+
+    report = _recover(
+        '{"title": "GPUs", "sections": [{"name": "Intro", "description": "d",'
+        ' "research": false}, {"name": "Body", "description": "the fir',
+        patch,
+        monkeypatch,
+    )
+    assert [section.description for section in report.sections] == ["d", "all"]
+
+
+def test_recover_gives_up_when_there_is_no_json():
+    assert _recover("I cannot help with that.") is None